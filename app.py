@@ -1,15 +1,38 @@
 import streamlit as st
-import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
-from io import BytesIO
-from PIL import Image
-import os
 import json
-import hashlib
-import zipfile
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import threading
+from urllib.parse import urlparse
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+import manga_extractor
+from manga_extractor import (
+    ASYNC_ENGINE_AVAILABLE,
+    ASYNC_MAX_IN_FLIGHT,
+    ASYNC_PER_HOST_LIMIT,
+    DOWNLOAD_ENGINE_ASYNCIO,
+    DOWNLOAD_ENGINE_THREAD,
+    IMAGE_CACHE_MAX_MB,
+    JOB_ERROR,
+    JOB_MODE_PIPELINE,
+    JOB_MODE_TWO_STAGE,
+    TRANSCODE_FORMATS,
+    TRANSCODE_QUALITY,
+    _ensure_output_dir,
+    _get_download_scheduler,
+    _get_thumbnail_cache,
+    _sha256_text,
+    build_image_items,
+    count_episode_images,
+    discard_job,
+    get_job,
+    image_bytes,
+    make_thumbnails,
+    parse_rate_limits,
+    save_run_output,
+    start_job,
+    transcode_available,
+)
 
 
 st.set_page_config(
@@ -22,573 +45,384 @@ st.title("🖼️ 漫画画像抽出ツール（抽出だけ）")
 st.markdown("URLから漫画画像を抽出し、一覧表示・ZIPダウンロードします（AI解析はしません）。")
 
 
-def _sha256_text(s: str) -> str:
-    return hashlib.sha256(s.encode("utf-8")).hexdigest()
-
-
-def _get_output_base_dir() -> str:
-    """保存先（リポジトリ内 output/）"""
-    try:
-        base = os.path.dirname(__file__)
-    except Exception:
-        base = os.getcwd()
-    return os.path.join(base, "output")
-
-
-def _ensure_output_dir() -> str:
-    base = _get_output_base_dir()
-    os.makedirs(base, exist_ok=True)
-    return base
-
-
-def _make_run_id() -> str:
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    rnd = hashlib.sha256(os.urandom(16)).hexdigest()[:8]
-    return f"{ts}_{rnd}"
-
-
-def _zip_bytes_from_files(file_map: dict[str, bytes]) -> bytes:
-    """{zip内パス: bytes} をZIP化して返す"""
-    buf = BytesIO()
-    with zipfile.ZipFile(buf, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for rel_path, data in file_map.items():
-            zf.writestr(rel_path, data)
-    return buf.getvalue()
-
-
-def get_request_headers(url: str) -> dict:
-    parsed_url = urlparse(url)
-    base_domain = f"{parsed_url.scheme}://{parsed_url.netloc}"
-    return {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
-        "Accept-Language": "ja,en-US;q=0.9,en;q=0.8",
-        "Referer": base_domain,
-    }
-
+def _show_event(level: str, message: str) -> None:
+    """コア処理からのデバッグ出力・エラーを画面に表示（スクリプト実行中のスレッドからだけ）"""
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return
+    if level == "error":
+        st.error(message)
+    else:
+        st.write(message)
 
-def get_pagination_urls(url: str, soup: BeautifulSoup, debug: bool = False) -> list[str]:
-    """ページネーションのURLを取得（同一記事内の /2 /3... を想定）"""
-    urls = [url]
-
-    pagination_selectors = [
-        ".pagination a",
-        ".page-numbers a",
-        ".pager a",
-        ".wp-pagenavi a",
-        "nav.navigation a",
-        ".post-page-numbers",
-        "a.page-link",
-        ".pages a",
-    ]
-
-    pagination_links = []
-    for selector in pagination_selectors:
-        links = soup.select(selector)
-        if links:
-            pagination_links.extend(links)
-            if debug:
-                st.write(f"ページネーション検出: {selector} ({len(links)}件)")
-            break
-
-    if not pagination_links:
-        # rel=next（同一記事の次ページを指すことが多い）
-        rel_next = soup.select_one('a[rel="next"], link[rel="next"]')
-        if rel_next and rel_next.get("href"):
-            href = rel_next.get("href")
-            # 後段の共通処理（hrefを読んでURL化）に乗せるため、擬似的にaとして扱う
-            rel_next.name = "a"
-            rel_next["href"] = href
-            pagination_links.append(rel_next)
-            if debug:
-                st.write(f"rel=next をページネーション候補として追加: {urljoin(url, href)}")
-
-    if not pagination_links:
-        all_links = soup.find_all("a")
-        base_path = urlparse(url).path.rstrip("/")
-        for link in all_links:
-            text = link.get_text(strip=True)
-            href = link.get("href", "")
-            if not href:
-                continue
-            if text.isdigit():
-                full_href = urljoin(url, href)
-                href_path = urlparse(full_href).path.rstrip("/")
-                if href_path.startswith(base_path):
-                    pagination_links.append(link)
-                    if debug:
-                        st.write(f"数字リンク検出: {text} -> {full_href}")
-
-    if not pagination_links:
-        # 「次のページ」等のテキストリンク（数字リンクが無いサイト向け）
-        for link in soup.find_all("a"):
-            text = link.get_text(" ", strip=True)
-            href = link.get("href", "")
-            if not href or not text:
-                continue
-            if any(k in text for k in ["次のページ", "次ページ", "next page", "Next Page"]):
-                full_href = urljoin(url, href)
-                if urlparse(full_href).netloc == urlparse(url).netloc:
-                    pagination_links.append(link)
-                    if debug:
-                        st.write(f"次ページテキストリンク検出: {text} -> {full_href}")
-                break
-
-    base_path = urlparse(url).path.rstrip("/")
-    seen = {url}
-    for link in pagination_links:
-        href = link.get("href")
-        if not href:
-            continue
-        full_url = urljoin(url, href)
-        if urlparse(full_url).netloc != urlparse(url).netloc:
-            continue
-        if full_url in seen:
-            continue
-        # 同一記事のページネーションだけに限定（次話/次記事ナビが混ざるのを防ぐ）
-        full_path = urlparse(full_url).path.rstrip("/")
-        if full_path != base_path and not _looks_like_intra_post_pagination(url, full_url):
-            continue
-
-        text = link.get_text(strip=True).lower()
-        if text in ["next", "prev", "previous", "»", "«", "›", "‹", "次へ", "前へ"]:
-            continue
-        urls.append(full_url)
-        seen.add(full_url)
-
-    def extract_page_num(u: str) -> int:
-        path = urlparse(u).path.rstrip("/")
-        if path == base_path:
-            return 1
-        if path.startswith(base_path + "/"):
-            suffix = path[len(base_path) + 1 :]
-            if suffix.isdigit():
-                return int(suffix)
-        return 999
-
-    urls.sort(key=extract_page_num)
-
-    if debug and len(urls) > 1:
-        st.write(f"検出されたページ: {len(urls)}ページ")
-        for u in urls:
-            st.write(f"  - {u}")
-
-    return urls
-
-
-def get_page_images(url: str, debug: bool = False) -> tuple[list[dict], BeautifulSoup | None]:
-    """ページから画像URLを抽出"""
-    headers = get_request_headers(url)
-
-    try:
-        response = requests.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
-    except requests.RequestException as e:
-        st.error(f"ページの取得に失敗しました: {e}")
-        return [], None
-
-    soup = BeautifulSoup(response.content, "html.parser")
-    images: list[dict] = []
 
-    if debug:
-        st.write(f"HTMLサイズ: {len(response.content)} bytes")
-
-    content_selectors = [
-        "article",
-        ".entry-content",
-        ".post-content",
-        ".article-content",
-        ".content",
-        ".single-content",
-        ".post-body",
-        ".article-body",
-        "main",
-        "#content",
-        "#main",
-        ".post",
-        ".entry",
-        ".ystd",
-        "#ystd",
-    ]
-
-    content_area = None
-    for selector in content_selectors:
-        content_area = soup.select_one(selector)
-        if content_area:
-            if debug:
-                st.write(f"コンテンツエリア検出: {selector}")
-            break
-
-    if not content_area:
-        content_area = soup.body if soup.body else soup
-        if debug:
-            st.write("コンテンツエリア: body全体")
-
-    img_tags = content_area.find_all("img")
-    if debug:
-        st.write(f"検出されたimgタグ数: {len(img_tags)}")
-
-    skip_patterns = [
-        "icon",
-        "logo",
-        "avatar",
-        "emoji",
-        "button",
-        "banner",
-        "advertisement",
-        "widget",
-        "gravatar",
-        "favicon",
-        "sprite",
-        "pixel",
-        "tracking",
-        "analytics",
-        "1x1",
-    ]
-
-    for img in img_tags:
-        src = (
-            img.get("src")
-            or img.get("data-src")
-            or img.get("data-lazy-src")
-            or img.get("data-original")
-            or img.get("data-full-url")
-            or img.get("data-lazy")
-            or img.get("data-image")
-            or (img.get("data-srcset", "").split()[0] if img.get("data-srcset") else None)
-            or (img.get("data-lazy-srcset", "").split()[0] if img.get("data-lazy-srcset") else None)
-            or (img.get("srcset", "").split()[0] if img.get("srcset") else None)
-        )
-        if not src:
-            if debug:
-                st.write(f"⚠️ src無し: {str(img)[:100]}...")
-            continue
-        if src.startswith("data:"):
-            if debug:
-                st.write("⚠️ data URI スキップ")
-            continue
-
-        img_url = urljoin(url, src)
-        if any(p in img_url.lower() for p in skip_patterns):
-            if debug:
-                st.write(f"⚠️ スキップパターン: {img_url[:80]}...")
-            continue
-
-        img_extensions = [".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif"]
-        has_img_ext = any(ext in img_url.lower() for ext in img_extensions)
-
-        img_path_patterns = ["/uploads/", "/images/", "/wp-content/", "/img/", "/photo/", "/manga/", "/comic/"]
-        has_img_path = any(p in img_url.lower() for p in img_path_patterns)
-
-        has_size_param = any(x in img_url.lower() for x in ["width=", "height=", "w=", "h=", "size=", "resize"])
-
-        if has_img_ext or has_img_path or has_size_param:
-            images.append({"url": img_url, "alt": img.get("alt", "")})
-            if debug:
-                st.write(f"✅ 画像追加: {img_url[:80]}...")
-        else:
-            if debug:
-                st.write(f"❌ 条件不一致でスキップ: {img_url[:80]}...")
-
-    # 重複除去
-    seen_urls: set[str] = set()
-    unique_images: list[dict] = []
-    for item in images:
-        u = item.get("url", "")
-        if not u or u in seen_urls:
-            continue
-        seen_urls.add(u)
-        unique_images.append(item)
-
-    return unique_images, soup
-
-
-def _looks_like_intra_post_pagination(current_url: str, candidate_url: str) -> bool:
-    """同一記事内ページネーション（/2 /3 ...）っぽいURLかどうか。
-
-    例:
-    - current: https://aikatu.jp/archives/1031854
-      cand:    https://aikatu.jp/archives/1031854/2
-    - current: https://w.grapps.me/original/624941/
-      cand:    https://w.grapps.me/original/624941/2/
+def _capture_script_run_ctx():
+    """ワーカースレッドに今のスクリプト実行コンテキストを引き継ぐ（ワーカー内から st.write できるように）"""
+    ctx = get_script_run_ctx(suppress_warning=True)
+    if ctx is None:
+        return None
+    return lambda: add_script_run_ctx(threading.current_thread(), ctx)
+
+
+manga_extractor.set_event_hook(_show_event)
+manga_extractor.set_thread_context_hook(_capture_script_run_ctx)
+
+# プレビュー用サムネイルの幅（表示モードごと, px）と1ページの枚数の選択肢
+THUMBNAIL_WIDTHS = {"縦1列": 720, "3列グリッド": 360}
+PREVIEW_PAGE_SIZES = [6, 12, 24, 48]
+# 実行中のジョブの進み具合を描き直す間隔（秒）
+JOB_POLL_SECONDS = 1.0
+# デバッグ情報の計測表での段階・区分の表示名
+PROFILE_STAGE_LABELS = {
+    "html_fetch": "HTML取得",
+    "parse": "HTMLパース",
+    "selector_match": "セレクタ照合",
+    "pagination": "ページ送り検出",
+    "image_download": "画像ダウンロード",
+    "validate": "画像検証（PIL）",
+    "transcode": "形式変換",
+    "zip": "ZIP作成",
+    "save": "保存",
+}
+PROFILE_KIND_LABELS = {"network": "通信", "parse": "HTML解析", "cpu": "画像処理・書き出し"}
+
+ENGINE_PIPELINE = "パイプライン（推奨）"
+ENGINE_TWO_STAGE = "2段階（巡回→ダウンロード）"
+DOWNLOAD_ENGINE_LABELS = {
+    "スレッド": DOWNLOAD_ENGINE_THREAD,
+    "asyncio": DOWNLOAD_ENGINE_ASYNCIO,
+}
+
+
+def _image_caption(img_info: dict) -> str:
+    ep = int(img_info.get("episode", 1) or 1)
+    page = int(img_info.get("page", 1) or 1)
+    return f"第{ep}話 P{page} / {img_info.get('width')}x{img_info.get('height')} / {int(img_info.get('size',0))/1024:.1f}KB"
+
+
+@st.fragment
+def _render_preview(manga_images: list[dict], display_mode: str, debug: bool = False):
+    """プレビューをページ単位で表示（ブラウザにはサムネイルだけ送り、原寸は画像ごとに切り替え）
+
+    フラグメントなので、ページ送りや原寸表示の切り替えではこの部分だけが再実行される。
     """
-    try:
-        cu = urlparse(current_url)
-        nu = urlparse(candidate_url)
-        if cu.netloc != nu.netloc:
-            return False
-        base = cu.path.rstrip("/")
-        cand = nu.path.rstrip("/")
-        if not cand.startswith(base + "/"):
-            return False
-        suffix = cand[len(base) + 1 :]
-        return suffix.isdigit()
-    except Exception:
-        return False
-
-
-def get_next_episode_url(soup: BeautifulSoup, base_url: str, debug: bool = False) -> str | None:
-    """「次の話>>」のURLを取得（特定サイト向けの緩い実装）"""
-    # 1) 旧ロジック（特定サイト向け）
-    next_episode_div = soup.find("div", class_="page-text-body", string=lambda t: t and "次の話" in t)
-    if next_episode_div:
-        parent = next_episode_div.find_parent("a")
-        if parent and parent.get("href"):
-            next_url = urljoin(base_url, parent["href"])
-            # /2など同一記事内ページネーションは「次話」ではない
-            if not _looks_like_intra_post_pagination(base_url, next_url):
-                if debug:
-                    st.write(f"🔗 次の話を検出(div): {next_url}")
-                return next_url
-        next_link = next_episode_div.find_next("a")
-        if next_link and next_link.get("href"):
-            next_url = urljoin(base_url, next_link["href"])
-            if not _looks_like_intra_post_pagination(base_url, next_url):
-                if debug:
-                    st.write(f"🔗 次の話を検出(div-next): {next_url}")
-                return next_url
-
-    # 2) WordPress系の「次の記事」ナビ（nav-next）
-    for sel in [
-        "nav.post-navigation .nav-next a",
-        "nav.navigation.post-navigation .nav-next a",
-        ".post-navigation .nav-next a",
-        ".navigation.post-navigation .nav-next a",
-    ]:
-        a = soup.select_one(sel)
-        if a and a.get("href"):
-            next_url = urljoin(base_url, a["href"])
-            if _looks_like_intra_post_pagination(base_url, next_url):
-                continue
-            if debug:
-                st.write(f"🔗 次の話を検出(nav-next): {next_url}")
-            return next_url
-
-    # 3) テキストで「次の話」を優先して探す（「次のページ」より優先）
-    keywords_strong = ["次の話", "次の話＞＞", "次の話>>", "次話", "次のエピソード"]
-    for a in soup.find_all("a"):
-        tx = a.get_text(" ", strip=True)
-        href = a.get("href")
-        if not tx or not href:
-            continue
-        if any(k in tx for k in keywords_strong):
-            next_url = urljoin(base_url, href)
-            if _looks_like_intra_post_pagination(base_url, next_url):
+    nav_cols = st.columns([1, 1, 2])
+    with nav_cols[0]:
+        page_size = st.selectbox("1ページの枚数", options=PREVIEW_PAGE_SIZES, index=1, key="preview_page_size")
+    total_pages = max(1, (len(manga_images) + page_size - 1) // page_size)
+    with nav_cols[1]:
+        page_no = st.number_input("ページ", min_value=1, max_value=total_pages, value=1, key=f"preview_page_{page_size}")
+    start = (int(page_no) - 1) * page_size
+    page_images = manga_images[start : start + page_size]
+    with nav_cols[2]:
+        st.caption(f"{start + 1}〜{start + len(page_images)}枚目 / 全{len(manga_images)}枚")
+
+    width = THUMBNAIL_WIDTHS.get(display_mode, THUMBNAIL_WIDTHS["3列グリッド"])
+    thumbs = make_thumbnails(page_images, width, cache=_get_thumbnail_cache())
+    cols_per_row = 1 if display_mode == "縦1列" else 3
+    sent_bytes = 0
+    for i in range(0, len(page_images), cols_per_row):
+        cols = st.columns(cols_per_row)
+        for j, col in enumerate(cols):
+            if i + j >= len(page_images):
                 continue
-            if debug:
-                st.write(f"🔗 次の話を検出(text): {tx[:40]} -> {next_url}")
-            return next_url
+            img_info = page_images[i + j]
+            idx = start + i + j
+            with col:
+                show_full = st.toggle("原寸", key=f"preview_full_{idx}")
+                data = image_bytes(img_info) if show_full or thumbs[i + j] is None else thumbs[i + j]
+                sent_bytes += len(data)
+                st.image(data, caption=_image_caption(img_info), use_container_width=True)
 
     if debug:
-        st.write("ℹ️ 「次の話」リンクは見つかりませんでした")
-    return None
+        full_bytes = sum(int(img.get("size", 0) or 0) for img in page_images)
+        st.write("このページの送信量:", f"{sent_bytes / 1024:.1f}KB（原寸なら {full_bytes / 1024:.1f}KB）")
+
+
+def _render_profile(profile: dict) -> None:
+    """段階ごとの計測値とホストごとの集計を表で表示"""
+    rows = []
+    for name, stage in profile["stages"].items():
+        rows.append(
+            {
+                "段階": PROFILE_STAGE_LABELS.get(name, name),
+                "回数": stage["count"],
+                "合計(秒)": stage["total_s"],
+                "平均(ms)": stage["mean_ms"],
+                "p50(ms)": stage["p50_ms"],
+                "p95(ms)": stage["p95_ms"],
+                "最大(ms)": stage["max_ms"],
+                "バイト": stage["bytes"],
+                "リトライ": stage["retries"],
+                "ステータス": ", ".join(f"{k}: {v}" for k, v in sorted(stage["status"].items())),
+            }
+        )
+    if rows:
+        st.table(rows)
+    by_kind = profile["time_by_kind"]
+    if by_kind:
+        main_kind = max(by_kind, key=by_kind.get)
+        st.write(
+            "時間の内訳（並列分は合算）:",
+            " / ".join(f"{PROFILE_KIND_LABELS.get(k, k)} {v:.2f}秒" for k, v in by_kind.items()),
+            f"→ 主に{PROFILE_KIND_LABELS.get(main_kind, main_kind)}に時間がかかっています",
+        )
+    if profile["hosts"]:
+        st.table(
+            [
+                {
+                    "ホスト": host,
+                    "リクエスト": h["requests"],
+                    "リトライ": h["retries"],
+                    "エラー": h["errors"],
+                    "バイト": h["bytes"],
+                    "平均(ms)": round(h["seconds"] / h["requests"] * 1000, 1) if h["requests"] else 0.0,
+                    "ステータス": ", ".join(f"{k}: {v}" for k, v in sorted(h["status"].items())),
+                }
+                for host, h in profile["hosts"].items()
+            ]
+        )
 
 
-def get_episode_images(url: str, episode_num: int = 1, debug: bool = False) -> tuple[list[dict], str | None]:
-    """1話分の画像を取得（ページネーション込み）"""
-    first_page_images, soup = get_page_images(url, debug)
-    if not soup:
-        return [], None
+def _show_job_events(job, debug: bool, last: int | None = None) -> None:
+    """ジョブが記録したエラー（常に）とデバッグ出力（debug のときだけ）を表示"""
+    events = list(job.events)
+    if not debug:
+        events = [e for e in events if e[0] == "error"]
+    for level, message in events[-last:] if last else events:
+        if level == "error":
+            st.error(message)
+        else:
+            st.write(message)
+
+
+def _render_live_preview(images: list[dict], pending: int, display_mode: str) -> None:
+    """実行中のプレビュー（そろった画像から順に、1ページ目の枠を埋めていく）"""
+    page_size = int(st.session_state.get("preview_page_size", PREVIEW_PAGE_SIZES[1]))
+    shown = images[:page_size]
+    slots = len(shown) + min(pending, page_size - len(shown))
+    width = THUMBNAIL_WIDTHS.get(display_mode, THUMBNAIL_WIDTHS["3列グリッド"])
+    thumbs = make_thumbnails(shown, width, cache=_get_thumbnail_cache())
+    cols_per_row = 1 if display_mode == "縦1列" else 3
+    for i in range(0, slots, cols_per_row):
+        cols = st.columns(cols_per_row)
+        for j, col in enumerate(cols):
+            idx = i + j
+            if idx >= slots:
+                continue
+            with col:
+                if idx < len(shown) and thumbs[idx] is not None:
+                    st.image(thumbs[idx], caption=_image_caption(shown[idx]), use_container_width=True)
+                else:
+                    st.container(border=True, height=120).caption("⏳ 読み込み中...")
+    if len(images) > page_size:
+        st.caption(f"ほか{len(images) - page_size}枚（抽出が終わると全ページを表示します）")
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def _render_job_progress(job, display_mode: str, debug: bool = False):
+    """実行中のジョブの進み具合（この部分だけ定期的に再実行し、終わったら画面全体を描き直す）"""
+    if job.done:
+        st.rerun()
+    progress = job.progress
+    completed, total = progress["completed"], progress["total"]
+    if progress["stage"] == "crawl":
+        text = f"ページ巡回中... 候補{total}件 / ダウンロード済み{completed}件"
+    elif progress["stage"] == "transcode":
+        text = f"画像の形式を変換中... {completed}/{total}"
+    else:
+        text = f"画像をダウンロード中... {completed}/{total}"
+    if job.resumed:
+        text += "（チェックポイントから再開）"
+    st.progress(completed / total if total else 0.0, text=text)
+    st.caption("抽出はバックグラウンドで実行しています。設定を変えたりページを再読み込みしても中断されません。")
+    _show_job_events(job, debug, last=20)
+
+    preview = list(job.preview)
+    if preview:
+        episode_counts = count_episode_images(preview)
+        episode_summary = "、".join([f"第{ep}話: {count}枚" for ep, count in sorted(episode_counts.items())])
+        st.write(f"取得済み {len(preview)}枚（{episode_summary}）")
+    if preview or total:
+        st.subheader("🖼️ 抽出結果（プレビュー）")
+        pending = max(0, total - completed) if progress["stage"] != "transcode" else 0
+        _render_live_preview(preview, pending, display_mode)
+    st.button("画像ZIPをダウンロード", disabled=True, use_container_width=True, help="抽出が終わると押せます")
+    if debug and job.first_image_at:
+        st.write("最初の画像まで:", f"{job.first_image_at - job.started_at:.1f}秒")
+
+
+def _render_job_result(job, display_mode: str, debug: bool = False):
+    """終わったジョブの結果（プレビュー・ダウンロード・保存）"""
+    params = job.params
+    url = params["url"]
+    max_images_total = int(params.get("max_images", 120))
+    images, manga_images = job.candidates, job.manga_images
+    _show_job_events(job, debug)
+
+    if job.status == JOB_ERROR:
+        st.error(f"抽出中にエラーが発生しました: {job.error}")
+    elif not images and params.get("update"):
+        st.info("前回から新しい画像はありませんでした。")
+    elif not images:
+        st.warning("画像が見つかりませんでした。デバッグモードをONにして詳細を確認してください。")
+    elif not manga_images:
+        st.warning("漫画画像が見つかりませんでした。フィルタ設定（最小サイズなど）を調整してください。")
+        if debug and images:
+            st.subheader("検出された画像URL一覧（フィルタ前）")
+            for img in images:
+                st.text(img["url"])
+    else:
+        if len(manga_images) > max_images_total:
+            st.warning(f"⚠️ 画像が{len(manga_images)}枚あります。上限により先頭{max_images_total}枚だけ扱います。")
+            manga_images = manga_images[:max_images_total]
+        elif job.stats.as_dict().get("budget_reached"):
+            st.info(f"ℹ️ 上限の{max_images_total}枚に達したため、それ以降の巡回とダウンロードを打ち切りました。")
+        duplicates = job.stats.as_dict().get("duplicates_collapsed", 0)
+        if duplicates:
+            st.info(f"🔁 見た目がほぼ同じ画像 {duplicates}件をまとめました（最初の1枚だけ残しています）。")
+        if params.get("update") and job.series_update:
+            st.info(
+                f"🔄 記録済み {job.series_update['known_episodes']}話に対して、新しい話 {job.series_update['new_episodes']}話・"
+                f"新しい画像 {job.series_update['new_images']}枚を取得しました（ZIP・画像一覧JSONは新しい画像だけです）。"
+            )
+        transcoded = job.transcode_summary
+        if transcoded:
+            st.info(
+                f"🗜️ {transcoded['transcoded']}枚を{transcoded['format'].upper()}に変換しました"
+                f"（うちグレースケール {transcoded['grayscale']}枚・元の方が小さいため変換しなかった画像 {transcoded['kept_original']}枚）: "
+                f"{transcoded['bytes_before'] / 1024 / 1024:.1f}MB → {transcoded['bytes_after'] / 1024 / 1024:.1f}MB"
+                f"（-{transcoded['reduction'] * 100:.0f}%、{transcoded['images_per_s']:.1f}枚/秒）"
+            )
 
-    next_episode_url = get_next_episode_url(soup, url, debug)
-    page_urls = get_pagination_urls(url, soup, debug)
+        # 話数ごとの枚数
+        episode_counts = count_episode_images(manga_images)
+        episode_summary = "、".join([f"第{ep}話: {count}枚" for ep, count in sorted(episode_counts.items())])
+        st.success(f"✅ {len(manga_images)}件の漫画画像を抽出しました（{episode_summary}）")
+
+        st.divider()
+        st.subheader("🖼️ 抽出結果（プレビュー）")
+        _render_preview(manga_images, display_mode, debug=debug)
+
+        st.divider()
+        st.subheader("⬇️ ダウンロード")
+
+        run_id = job.job_id
+        zip_path, name_map = job.images_zip()
+        with open(zip_path, "rb") as zip_file:
+            st.download_button(
+                "画像ZIPをダウンロード",
+                data=zip_file,
+                file_name=f"manga_images_{run_id}.zip",
+                mime="application/zip",
+                use_container_width=True,
+            )
 
-    all_images: list[dict] = []
-    seen_urls: set[str] = set()
+        # JSON（URLとメタ）
+        items = build_image_items(manga_images, name_map)
 
-    if debug:
-        st.write(f"📖 第{episode_num}話の取得開始")
-
-    for img in first_page_images:
-        if img["url"] in seen_urls:
-            continue
-        img["page"] = 1
-        img["episode"] = episode_num
-        all_images.append(img)
-        seen_urls.add(img["url"])
-
-    if len(page_urls) > 1:
-        for i, page_url in enumerate(page_urls[1:], start=2):
-            if debug:
-                st.write(f"  ページ {i} を取得中: {page_url}")
-            page_images, page_soup = get_page_images(page_url, debug)
-            for img in page_images:
-                if img["url"] in seen_urls:
-                    continue
-                img["page"] = i
-                img["episode"] = episode_num
-                all_images.append(img)
-                seen_urls.add(img["url"])
-            if page_soup and not next_episode_url:
-                next_episode_url = get_next_episode_url(page_soup, page_url, debug)
+        st.download_button(
+            "画像一覧JSONをダウンロード",
+            data=json.dumps(items, ensure_ascii=False, indent=2).encode("utf-8"),
+            file_name=f"manga_images_{run_id}.json",
+            mime="application/json",
+            use_container_width=True,
+        )
 
-    if debug:
-        st.write(f"📖 第{episode_num}話: {len(all_images)}枚の画像を取得")
-
-    return all_images, next_episode_url
-
-
-def get_multiple_episodes_images(url: str, num_episodes: int, debug: bool = False) -> list[dict]:
-    """複数話の画像を取得（次の話リンクを辿る）"""
-    all_images: list[dict] = []
-    current_url: str | None = url
-
-    for episode in range(1, num_episodes + 1):
-        if not current_url:
-            if debug:
-                st.write(f"⚠️ 第{episode}話のURLがありません。取得を終了します。")
-            break
-        if debug:
-            st.write(f"📚 第{episode}話を取得中: {current_url}")
-        episode_images, next_url = get_episode_images(current_url, episode_num=episode, debug=debug)
-        all_images.extend(episode_images)
-        current_url = next_url
-        if not next_url and episode < num_episodes:
-            if debug:
-                st.write(f"ℹ️ 第{episode}話が最終話です。{episode}話分を取得しました。")
-            break
+        with st.expander("💾 output/ に保存（任意）", expanded=False):
+            st.caption("サーバー上の `output/<run_id>/` に保存します（ローカル運用向け）。")
+            if st.button("保存する", use_container_width=True):
+                base = _ensure_output_dir()
+                meta = {
+                    "url": url,
+                    "num_episodes": int(params.get("num_episodes", 1)),
+                    "min_image_size_kb": int(params.get("min_size_kb", 30)),
+                    "max_images_total": max_images_total,
+                    "total_candidates": len(images),
+                    "total_extracted": len(manga_images),
+                    "duplicates_collapsed": duplicates,
+                    "episode_counts": episode_counts,
+                    "transcode": transcoded,
+                    "update": job.series_update if params.get("update") else None,
+                }
+                save_run_output(os.path.join(base, run_id), manga_images, name_map, meta, profile=job.profile)
+
+                st.success(f"保存しました: output/{run_id}/")
 
     if debug:
-        st.write(f"✅ 合計 {len(all_images)}枚の画像を取得")
-
-    return all_images
-
-
-def download_image(url: str, referer: str = "") -> bytes | None:
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        "Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
-        "Referer": referer,
-    }
-    try:
-        response = requests.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
-        return response.content
-    except requests.RequestException:
-        return None
-
-
-@st.cache_data(show_spinner=False, ttl=60 * 10)
-def _cached_download_image(url: str, referer: str = "") -> bytes | None:
-    return download_image(url, referer)
-
-
-def _download_and_validate_image(
-    img_info: dict,
-    min_size: int,
-    referer: str,
-) -> dict | None:
-    """1枚の画像をダウンロードしてバリデーション（並列処理用）"""
-    img_data = download_image(img_info["url"], referer)
-    if not img_data:
-        return None
-
-    if len(img_data) < min_size:
-        return None
-
-    try:
-        img = Image.open(BytesIO(img_data))
-        width, height = img.size
-        aspect_ratio = width / height if height > 0 else 0
-
-        if aspect_ratio > 3:
-            return None
-        if width < 200 or height < 200:
-            return None
-
-        return {
-            **img_info,
-            "data": img_data,
-            "width": width,
-            "height": height,
-            "size": len(img_data),
-        }
-    except Exception:
-        return None
-
-
-def filter_manga_images(
-    images: list[dict],
-    min_size: int = 50_000,
-    referer: str = "",
-    debug: bool = False,
-    max_workers: int = 10,
-    progress_callback=None,
-) -> list[dict]:
-    """漫画画像をフィルタリング（サイズ/縦横/アスペクト比）- 並列ダウンロード対応"""
-    manga_images: list[dict] = []
-    total = len(images)
-    completed = 0
-
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_img = {
-            executor.submit(_download_and_validate_image, img_info, min_size, referer): img_info
-            for img_info in images
-        }
-
-        results_map: dict[str, dict] = {}
-
-        for future in as_completed(future_to_img):
-            img_info = future_to_img[future]
-            completed += 1
-
-            if progress_callback:
-                progress_callback(completed, total)
-
-            try:
-                result = future.result()
-                if result:
-                    results_map[img_info["url"]] = result
-                    if debug:
-                        st.write(f"✅ 取得成功: {img_info['url'][:60]}...")
-                else:
-                    if debug:
-                        st.write(f"❌ フィルタ除外: {img_info['url'][:60]}...")
-            except Exception as e:
-                if debug:
-                    st.write(f"⚠️ エラー: {img_info['url'][:60]}... - {e}")
-
-    for img_info in images:
-        if img_info["url"] in results_map:
-            manga_images.append(results_map[img_info["url"]])
-
-    return manga_images
-
-
-def _guess_ext(img_bytes: bytes, fallback_ext: str = ".jpg") -> str:
-    try:
-        img = Image.open(BytesIO(img_bytes))
-        fmt = (img.format or "").upper()
-        if fmt == "JPEG":
-            return ".jpg"
-        if fmt == "PNG":
-            return ".png"
-        if fmt == "WEBP":
-            return ".webp"
-        if fmt == "GIF":
-            return ".gif"
-        if fmt == "AVIF":
-            return ".avif"
-    except Exception:
-        pass
-    return fallback_ext
-
-
-def build_images_zip(manga_images: list[dict]) -> tuple[bytes, dict[str, str]]:
-    """画像をZIP化して返す。戻り値は(zip_bytes, filename_map[url]=zip内パス)"""
-    file_map: dict[str, bytes] = {}
-    name_map: dict[str, str] = {}
-
-    for idx, img in enumerate(manga_images, start=1):
-        ep = int(img.get("episode", 1) or 1)
-        page = int(img.get("page", 1) or 1)
-        ext = _guess_ext(img.get("data") or b"")
-        rel = f"images/ep{ep:02d}_p{page:03d}_{idx:04d}{ext}"
-        file_map[rel] = img["data"]
-        name_map[img.get("url", f"idx:{idx}")] = rel
-
-    zip_bytes = _zip_bytes_from_files(file_map)
-    return zip_bytes, name_map
+        st.divider()
+        st.subheader("🔎 デバッグ情報")
+        st.write("ジョブID:", job.job_id, "（チェックポイントから再開）" if job.resumed else "")
+        st.write("候補画像（フィルタ前）:", len(images))
+        st.write("抽出画像（フィルタ後）:", len(manga_images))
+        st.write("入力URLのドメイン:", urlparse(url).netloc)
+        st.write("URLのハッシュ:", _sha256_text(url)[:16])
+        if job.finished_at:
+            st.write("処理時間:", f"{job.finished_at - job.started_at:.1f}秒")
+        if job.first_image_at:
+            st.write("最初の画像まで:", f"{job.first_image_at - job.started_at:.1f}秒")
+        st.write("⏱️ 段階ごとの計測:")
+        _render_profile(job.profile.as_dict())
+        counts = job.stats.as_dict()
+        st.write("ダウンロード量:", f"{counts.get('bytes_downloaded', 0) / 1024:.1f}KB")
+        if params.get("engine", DOWNLOAD_ENGINE_THREAD) == DOWNLOAD_ENGINE_THREAD:
+            scheduler = _get_download_scheduler().counts()
+            st.write(
+                "共有ダウンロード枠:",
+                f"他のセッションと同時に取得した画像の相乗り {counts.get('coalesced', 0)}件 / "
+                f"現在 実行中 {scheduler['running']}件・待ち {scheduler['queued']}件"
+                f"（上限 {scheduler['max_workers']}件、利用中のジョブ {scheduler['clients']}件）",
+            )
+        st.write("画像の置き場所:", f"{job.store.root}（{sum(1 for img in manga_images if img['stored'].on_disk)}件）")
+        if params.get("probe", True):
+            st.write(
+                "先頭バイト判定で除外:",
+                f"{counts.get('probe_rejected', 0)}件（節約 {counts.get('bytes_saved', 0) / 1024:.1f}KB）",
+            )
+        if job.limiter:
+            st.write("ホストごとの同時接続数:")
+            for gate in job.limiter.gates():
+                st.write(
+                    f"- {gate.host}: 最終 {int(gate.limit)} / 最大 {max(n for _, n in gate.trajectory)} / "
+                    f"上限 {gate.max_limit} / 絞った回数 {gate.backoffs}"
+                )
+                if len(gate.trajectory) > 1:
+                    st.line_chart(
+                        {
+                            "経過秒": [t for t, _ in gate.trajectory],
+                            "同時接続数": [n for _, n in gate.trajectory],
+                        },
+                        x="経過秒",
+                        y="同時接続数",
+                    )
+        if job.cache:
+            cache_counts = job.cache.stats.as_dict()
+            run_counts = {k: v - job.cache_counts_before.get(k, 0) for k, v in cache_counts.items()}
+            st.write(
+                "画像キャッシュ:",
+                f"ヒット {run_counts.get('hits', 0)}件 / ミス {run_counts.get('misses', 0)}件 / "
+                f"キャッシュから {run_counts.get('bytes_served', 0) / 1024:.1f}KB / "
+                f"保存 {run_counts.get('bytes_stored', 0) / 1024:.1f}KB / "
+                f"追い出し {run_counts.get('evictions', 0)}件 / "
+                f"合計 {job.cache.total_bytes / 1024 / 1024:.1f}MB",
+            )
+        if job.page_cache:
+            page_counts = job.page_cache.stats.as_dict()
+            run_counts = {k: v - job.page_cache_counts_before.get(k, 0) for k, v in page_counts.items()}
+            st.write(
+                "ページキャッシュ:",
+                f"変更なし（304）で再利用 {run_counts.get('hits', 0)}ページ / 取得して保存 {run_counts.get('misses', 0)}ページ / "
+                f"受信しなかったHTML {run_counts.get('bytes_saved', 0) / 1024:.1f}KB / "
+                f"追い出し {run_counts.get('evictions', 0)}件 / "
+                f"合計 {job.page_cache.entries}ページ・{job.page_cache.total_bytes / 1024:.1f}KB",
+            )
+        site_profile = job.site_profiles.lookup(url) if job.site_profiles else None
+        if site_profile:
+            st.write(
+                "サイトプロファイル:",
+                f"本文 {site_profile.get('content') or '-'} / ページ送り {site_profile.get('pagination') or '-'} / "
+                f"次の話 {site_profile.get('next_episode') or '-'} / 画像URL {site_profile.get('src_attr') or '-'}"
+                f"（これまでに一致 {site_profile.get('hits', 0)}ページ / 判定し直し {site_profile.get('misses', 0)}ページ）",
+            )
 
 
 with st.sidebar:
@@ -610,12 +444,114 @@ with st.sidebar:
         step=5,
         help="多いほど重くなります（表示/ZIPも大きくなります）",
     )
-    parallel_downloads = st.slider(
-        "並列ダウンロード数",
-        min_value=1,
-        max_value=20,
-        value=10,
-        help="同時にダウンロードする画像数。大きいほど速いですがサーバー負荷が上がります",
+    download_engine_label = st.radio(
+        "ダウンロード方式",
+        options=list(DOWNLOAD_ENGINE_LABELS),
+        index=0,
+        horizontal=True,
+        help="asyncio: 少ないスレッドで大量の同時リクエストを処理します（aiohttp が必要）",
+    )
+    download_engine = DOWNLOAD_ENGINE_LABELS[download_engine_label]
+    per_host_limit = ASYNC_PER_HOST_LIMIT
+    if download_engine == DOWNLOAD_ENGINE_ASYNCIO:
+        parallel_downloads = st.slider(
+            "同時リクエスト数",
+            min_value=10,
+            max_value=500,
+            value=ASYNC_MAX_IN_FLIGHT,
+            step=10,
+            help="同時に処理する画像リクエスト数（全ホスト合計）",
+        )
+        per_host_limit = st.slider(
+            "ホストごとの同時接続数",
+            min_value=1,
+            max_value=64,
+            value=ASYNC_PER_HOST_LIMIT,
+            help="1つのサーバーに同時に張る接続数の上限",
+        )
+        if not ASYNC_ENGINE_AVAILABLE:
+            st.warning("aiohttp がインストールされていないため asyncio 方式は使えません")
+    else:
+        parallel_downloads = st.slider(
+            "並列ダウンロード数",
+            min_value=1,
+            max_value=20,
+            value=10,
+            help="同時にダウンロードする画像数。大きいほど速いですがサーバー負荷が上がります（自動調整が ON のときは上限）",
+        )
+    adaptive_concurrency = st.checkbox(
+        "ホストごとに同時接続数を自動調整",
+        value=True,
+        help="応答が速くエラーが無い間は同時接続数を少しずつ増やし、429/503/タイムアウトが出たら半分に減らします",
+    )
+    rate_limits_text = st.text_area(
+        "ドメインごとのレート上限（リクエスト/秒）",
+        value="",
+        placeholder="example.com=2\ncdn.example.net=20",
+        help="1行に「ドメイン=回数」。サブドメインにも適用されます",
+    )
+    engine = st.radio(
+        "処理方式",
+        options=[ENGINE_PIPELINE, ENGINE_TWO_STAGE],
+        index=0,
+        help="パイプライン: ページ巡回と画像ダウンロードを同時に進めます / 2段階: 全ページ巡回後にダウンロードします",
+    )
+    use_image_cache = st.checkbox(
+        "画像をディスクにキャッシュ",
+        value=True,
+        help="取得した画像を output/.cache/images/ に保存し、次回は条件付きリクエスト（304）で再利用します",
+    )
+    image_cache_mb = IMAGE_CACHE_MAX_MB
+    if use_image_cache:
+        image_cache_mb = st.number_input(
+            "キャッシュ上限 (MB)",
+            min_value=50,
+            max_value=20_000,
+            value=IMAGE_CACHE_MAX_MB,
+            step=50,
+            help="超えた分は最後に使われたのが古い画像から削除します",
+        )
+    use_page_cache = st.checkbox(
+        "記事ページの抽出結果をキャッシュ",
+        value=True,
+        help="ページごとの抽出結果を output/.cache/pages/ に保存し、次回は条件付きリクエストで変わっていなければ（304）HTMLを受信・解析しません",
+    )
+    dedupe_images = st.checkbox(
+        "見た目が同じ画像をまとめる",
+        value=True,
+        help="話ごとに繰り返される扉絵・告知バナーなど、URLが違っても見た目がほぼ同じ画像は最初の1枚だけ残します",
+    )
+    transcode_labels = {"元のまま": None} | {
+        fmt.upper(): fmt for fmt in TRANSCODE_FORMATS if transcode_available(fmt)
+    }
+    transcode_label = st.radio(
+        "出力形式",
+        options=list(transcode_labels),
+        index=0,
+        horizontal=True,
+        help="ZIP・保存する画像を再エンコードします（元の方が小さい画像はそのまま）",
+    )
+    transcode_format = transcode_labels[transcode_label]
+    transcode_quality, transcode_max_width, transcode_grayscale = TRANSCODE_QUALITY, 0, True
+    if transcode_format:
+        transcode_quality = st.slider("画質", min_value=30, max_value=100, value=TRANSCODE_QUALITY)
+        transcode_max_width = st.number_input(
+            "最大幅 (px)",
+            min_value=0,
+            max_value=10_000,
+            value=0,
+            step=100,
+            help="これより広い画像は縮小します（0 で縮小しない）",
+        )
+        transcode_grayscale = st.checkbox(
+            "白黒のページはグレースケールで保存",
+            value=True,
+            help="色がほぼ無いページを1チャンネルで書き出し、サイズを減らします",
+        )
+    probe_headers = st.checkbox(
+        "先頭バイトで事前判定",
+        value=True,
+        help="画像の先頭数KBで縦横サイズを読み取り、条件に合わない画像は本体をダウンロードしません",
     )
     st.divider()
     st.subheader("🖼️ 表示設定")
@@ -640,6 +576,12 @@ with st.sidebar:
         num_episodes = 3
     else:
         num_episodes = 1
+    update_mode = st.checkbox(
+        "前回の続きから更新分だけ取得",
+        value=False,
+        help="同じURLで前に取得した話は巡回せず、最後の話から新しい話・画像だけを取得します（話数は新しく取得する話の上限）。"
+        "ZIP・画像一覧JSONも新しい画像だけになります",
+    )
 
 
 url = st.text_input(
@@ -657,157 +599,52 @@ if extract_button:
     if not url:
         st.error("URLを入力してください")
     else:
-        with st.spinner("ページから画像を取得中..."):
-            images = get_multiple_episodes_images(url, num_episodes=int(num_episodes), debug=debug_mode)
-
-        if not images:
-            st.warning("画像が見つかりませんでした。デバッグモードをONにして詳細を確認してください。")
-        else:
-            st.info(f"📷 {len(images)}件の画像候補を検出しました。並列ダウンロード中（{parallel_downloads}並列）...")
-
-            progress_bar = st.progress(0, text="画像をダウンロード中...")
-
-            def update_progress(completed: int, total: int):
-                progress = completed / total
-                progress_bar.progress(progress, text=f"画像をダウンロード中... {completed}/{total}")
-
-            manga_images = filter_manga_images(
-                images,
-                min_size=int(min_image_size_kb) * 1000,
-                referer=url,
-                debug=debug_mode,
-                max_workers=int(parallel_downloads),
-                progress_callback=update_progress,
-            )
-
-            progress_bar.empty()
-
-            if not manga_images:
-                st.warning("漫画画像が見つかりませんでした。フィルタ設定（最小サイズなど）を調整してください。")
-                if debug_mode and images:
-                    st.subheader("検出された画像URL一覧（フィルタ前）")
-                    for img in images:
-                        st.text(img["url"])
-            else:
-                if len(manga_images) > int(max_images_total):
-                    st.warning(f"⚠️ 画像が{len(manga_images)}枚あります。上限により先頭{int(max_images_total)}枚だけ扱います。")
-                    manga_images = manga_images[: int(max_images_total)]
-
-                # 話数ごとの枚数
-                episode_counts: dict[int, int] = {}
-                for img in manga_images:
-                    ep = int(img.get("episode", 1) or 1)
-                    episode_counts[ep] = episode_counts.get(ep, 0) + 1
-                episode_summary = "、".join([f"第{ep}話: {count}枚" for ep, count in sorted(episode_counts.items())])
-                st.success(f"✅ {len(manga_images)}件の漫画画像を抽出しました（{episode_summary}）")
-
-                st.divider()
-                st.subheader("🖼️ 抽出結果（プレビュー）")
-
-                if display_mode == "縦1列":
-                    for idx, img_info in enumerate(manga_images):
-                        ep = int(img_info.get("episode", 1) or 1)
-                        page = int(img_info.get("page", 1) or 1)
-                        st.image(
-                            img_info["data"],
-                            caption=f"第{ep}話 P{page} / {img_info.get('width')}x{img_info.get('height')} / {int(img_info.get('size',0))/1024:.1f}KB",
-                            use_container_width=True,
-                        )
-                else:
-                    cols_per_row = 3
-                    for i in range(0, len(manga_images), cols_per_row):
-                        cols = st.columns(cols_per_row)
-                        for j, col in enumerate(cols):
-                            idx = i + j
-                            if idx >= len(manga_images):
-                                continue
-                            img_info = manga_images[idx]
-                            with col:
-                                ep = int(img_info.get("episode", 1) or 1)
-                                page = int(img_info.get("page", 1) or 1)
-                                st.image(
-                                    img_info["data"],
-                                    caption=f"第{ep}話 P{page} / {img_info.get('width')}x{img_info.get('height')} / {int(img_info.get('size',0))/1024:.1f}KB",
-                                    use_container_width=True,
-                                )
-
-                st.divider()
-                st.subheader("⬇️ ダウンロード")
-
-                zip_bytes, name_map = build_images_zip(manga_images)
-                run_id = _make_run_id()
-                st.download_button(
-                    "画像ZIPをダウンロード",
-                    data=zip_bytes,
-                    file_name=f"manga_images_{run_id}.zip",
-                    mime="application/zip",
-                    use_container_width=True,
-                )
-
-                # JSON（URLとメタ）
-                items = []
-                for img in manga_images:
-                    items.append(
-                        {
-                            "episode": int(img.get("episode", 1) or 1),
-                            "page": int(img.get("page", 1) or 1),
-                            "url": img.get("url", ""),
-                            "alt": img.get("alt", ""),
-                            "width": int(img.get("width", 0) or 0),
-                            "height": int(img.get("height", 0) or 0),
-                            "size_bytes": int(img.get("size", 0) or 0),
-                            "zip_path": name_map.get(img.get("url", ""), ""),
-                        }
-                    )
-
-                st.download_button(
-                    "画像一覧JSONをダウンロード",
-                    data=json.dumps(items, ensure_ascii=False, indent=2).encode("utf-8"),
-                    file_name=f"manga_images_{run_id}.json",
-                    mime="application/json",
-                    use_container_width=True,
-                )
-
-                with st.expander("💾 output/ に保存（任意）", expanded=False):
-                    st.caption("サーバー上の `output/<run_id>/` に保存します（ローカル運用向け）。")
-                    if st.button("保存する", use_container_width=True):
-                        base = _ensure_output_dir()
-                        run_dir = os.path.join(base, run_id)
-                        img_dir = os.path.join(run_dir, "images")
-                        os.makedirs(img_dir, exist_ok=True)
-
-                        # 画像ファイル保存
-                        for img in manga_images:
-                            zp = name_map.get(img.get("url", ""), "")
-                            if not zp.startswith("images/"):
-                                continue
-                            rel_name = zp[len("images/") :]
-                            out_path = os.path.join(img_dir, rel_name)
-                            with open(out_path, "wb") as f:
-                                f.write(img["data"])
-
-                        meta = {
-                            "url": url,
-                            "num_episodes": int(num_episodes),
-                            "min_image_size_kb": int(min_image_size_kb),
-                            "max_images_total": int(max_images_total),
-                            "total_candidates": len(images),
-                            "total_extracted": len(manga_images),
-                            "episode_counts": episode_counts,
-                        }
-                        with open(os.path.join(run_dir, "images.json"), "w", encoding="utf-8") as f:
-                            json.dump(items, f, ensure_ascii=False, indent=2)
-                        with open(os.path.join(run_dir, "meta.json"), "w", encoding="utf-8") as f:
-                            json.dump(meta, f, ensure_ascii=False, indent=2)
-
-                        st.success(f"保存しました: output/{run_id}/")
-
-                if debug_mode:
-                    st.divider()
-                    st.subheader("🔎 デバッグ情報")
-                    st.write("候補画像（フィルタ前）:", len(images))
-                    st.write("抽出画像（フィルタ後）:", len(manga_images))
-                    st.write("入力URLのドメイン:", urlparse(url).netloc)
-                    st.write("URLのハッシュ:", _sha256_text(url)[:16])
-
-
+        # 同じセッションの前回のジョブ（終わっていれば）は片付けてから始める
+        if st.session_state.get("job_id"):
+            discard_job(st.session_state["job_id"])
+        # 前回の抽出結果に対するページ番号・原寸表示の状態は引き継がない
+        for key in [k for k in st.session_state if str(k).startswith("preview_")]:
+            del st.session_state[key]
+        job = start_job(
+            {
+                "url": url,
+                "mode": JOB_MODE_PIPELINE if engine == ENGINE_PIPELINE else JOB_MODE_TWO_STAGE,
+                "num_episodes": int(num_episodes),
+                "min_size_kb": int(min_image_size_kb),
+                "max_images": int(max_images_total),
+                "engine": download_engine,
+                "max_workers": int(parallel_downloads),
+                "per_host_limit": int(per_host_limit),
+                "probe": probe_headers,
+                "dedupe": dedupe_images,
+                "transcode": transcode_format,
+                "transcode_quality": int(transcode_quality),
+                "transcode_max_width": int(transcode_max_width),
+                "transcode_grayscale": transcode_grayscale,
+                "cache": use_image_cache,
+                "cache_mb": int(image_cache_mb),
+                "page_cache": use_page_cache,
+                "adaptive": adaptive_concurrency,
+                "rate_limits": parse_rate_limits(rate_limits_text),
+                "update": update_mode,
+                "debug": debug_mode,
+            }
+        )
+        st.session_state["job_id"] = job.job_id
+        # URL にも残しておき、ブラウザの再接続・再読み込みでも同じジョブに戻れるようにする
+        st.query_params["job"] = job.job_id
+
+
+job_id = st.session_state.get("job_id") or st.query_params.get("job")
+job = get_job(job_id) if job_id else None
+if job_id and job is None:
+    st.warning("前回のジョブが見つかりませんでした（保持期間を過ぎたか、削除されました）。")
+    st.session_state.pop("job_id", None)
+    if "job" in st.query_params:
+        del st.query_params["job"]
+elif job is not None:
+    st.session_state["job_id"] = job.job_id
+    if not job.done:
+        _render_job_progress(job, display_mode, debug=debug_mode)
+    else:
+        _render_job_result(job, display_mode, debug=debug_mode)
@@ -0,0 +1,97 @@
+"""ダウンロードエンジン（スレッド / asyncio）のスループット比較ベンチマーク
+
+ローカルの http.server に遅延付きの画像を置き、filter_manga_images を
+同時リクエスト数 10 / 50 / 200 で実行して images/s を比較します。
+
+    python benchmarks/bench_download_engines.py
+    python benchmarks/bench_download_engines.py --images 600 --latency-ms 100 --concurrency 10 50 200
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import manga_extractor  # noqa: E402
+from PIL import Image  # noqa: E402
+
+
+def _make_jpeg(width: int, height: int) -> bytes:
+    buf = BytesIO()
+    Image.new("RGB", (width, height), (240, 240, 240)).save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+
+class _ImageServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def start_image_server(body: bytes, latency: float) -> _ImageServer:
+    """全パスで同じ画像を latency 秒遅れで返すサーバーを起動"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = _ImageServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_once(base_url: str, num_images: int, engine: str, concurrency: int) -> tuple[float, int]:
+    images = [{"url": f"{base_url}/img/{engine}/{concurrency}/{i}.jpg"} for i in range(num_images)]
+    start = time.perf_counter()
+    result = manga_extractor.filter_manga_images(
+        images,
+        min_size=1,
+        max_workers=concurrency,
+        engine=engine,
+        per_host_limit=concurrency,
+    )
+    return time.perf_counter() - start, len(result)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=400, help="1回あたりの画像数")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="1リクエストあたりの擬似遅延")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 200])
+    args = parser.parse_args()
+
+    engines = [manga_extractor.DOWNLOAD_ENGINE_THREAD]
+    if manga_extractor.ASYNC_ENGINE_AVAILABLE:
+        engines.append(manga_extractor.DOWNLOAD_ENGINE_ASYNCIO)
+    else:
+        print("aiohttp が無いため asyncio エンジンはスキップします")
+
+    server = start_image_server(_make_jpeg(400, 600), args.latency_ms / 1000)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        print(f"images={args.images} latency={args.latency_ms:.0f}ms")
+        print(f"{'engine':<8} {'concurrency':>11} {'seconds':>8} {'images/s':>9} {'ok':>5}")
+        for concurrency in args.concurrency:
+            for engine in engines:
+                elapsed, ok = run_once(base_url, args.images, engine, concurrency)
+                print(f"{engine:<8} {concurrency:>11} {elapsed:>8.2f} {args.images / elapsed:>9.1f} {ok:>5}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
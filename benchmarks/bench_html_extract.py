@@ -0,0 +1,171 @@
+"""HTML抽出（パース + 画像/ページネーション/次話の検出）のマイクロベンチマーク
+
+benchmarks/fixtures/*.html を対象に、従来方式（html.parser + セレクタごとの全体走査）と
+1回走査方式（extract_page と同じ処理。lxml / html.parser）と、サイトプロファイルで照合するセレクタを
+絞った1回走査方式を比べ、
+1ページあたりの処理時間とピークメモリ（tracemalloc）を表示します。
+
+    python benchmarks/bench_html_extract.py
+    python benchmarks/bench_html_extract.py --repeat 50
+"""
+
+import argparse
+import functools
+import glob
+import os
+import sys
+import time
+import tracemalloc
+from urllib.parse import urljoin, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import manga_extractor  # noqa: E402
+from bs4 import BeautifulSoup  # noqa: E402
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+FIXTURE_URL = "https://example.com/archives/123456"
+
+
+def _legacy_extract(url: str, html: bytes) -> tuple[list[str], list[str], str | None]:
+    """変更前の処理と同じ走査（セレクタごと・find_all ごとにツリー全体を辿る）"""
+    soup = BeautifulSoup(html, "html.parser")
+
+    content_area = None
+    for selector in manga_extractor.CONTENT_SELECTORS:
+        content_area = soup.select_one(selector)
+        if content_area:
+            break
+    if not content_area:
+        content_area = soup.body if soup.body else soup
+    images = []
+    for img in content_area.find_all("img"):
+        # 属性の選び方は現行と同じにして、走査方式の差だけを比べる
+        src, _ = manga_extractor._img_src(img)
+        if not src or src.startswith("data:"):
+            continue
+        img_url = urljoin(url, src)
+        lowered = img_url.lower()
+        if any(p in lowered for p in manga_extractor.SKIP_PATTERNS):
+            continue
+        if (
+            any(ext in lowered for ext in manga_extractor.IMG_EXTENSIONS)
+            or any(p in lowered for p in manga_extractor.IMG_PATH_PATTERNS)
+            or any(x in lowered for x in manga_extractor.SIZE_PARAM_PATTERNS)
+        ) and img_url not in images:
+            images.append(img_url)
+
+    next_url = None
+    div = soup.find("div", class_="page-text-body", string=lambda t: t and "次の話" in t)
+    if div:
+        parent = div.find_parent("a")
+        link = parent if parent and parent.get("href") else div.find_next("a")
+        if link and link.get("href"):
+            next_url = urljoin(url, link["href"])
+    if not next_url:
+        for sel in manga_extractor.NEXT_EPISODE_NAV_SELECTORS:
+            a = soup.select_one(sel)
+            if a and a.get("href"):
+                next_url = urljoin(url, a["href"])
+                break
+    if not next_url:
+        for a in soup.find_all("a"):
+            tx = a.get_text(" ", strip=True)
+            if tx and a.get("href") and any(k in tx for k in ["次の話", "次話", "次のエピソード"]):
+                next_url = urljoin(url, a["href"])
+                break
+
+    links = []
+    for selector in manga_extractor.PAGINATION_SELECTORS:
+        links = soup.select(selector)
+        if links:
+            break
+    if not links:
+        rel_next = soup.select_one('a[rel="next"], link[rel="next"]')
+        if rel_next and rel_next.get("href"):
+            links = [rel_next]
+    if not links:
+        base_path = urlparse(url).path.rstrip("/")
+        for link in soup.find_all("a"):
+            if link.get("href") and link.get_text(strip=True).isdigit():
+                if urlparse(urljoin(url, link["href"])).path.rstrip("/").startswith(base_path):
+                    links.append(link)
+    if not links:
+        for link in soup.find_all("a"):
+            text = link.get_text(" ", strip=True)
+            if link.get("href") and text and "次のページ" in text:
+                links.append(link)
+                break
+    pages = [url]
+    for link in links:
+        href = link.get("href")
+        if href and manga_extractor._looks_like_intra_post_pagination(url, urljoin(url, href)):
+            full = urljoin(url, href)
+            if full not in pages and link.get_text(strip=True).lower() not in ["next", "»", "次へ"]:
+                pages.append(full)
+    return images, pages, next_url
+
+
+def _single_pass_extract(url: str, html: bytes, parser: str) -> tuple[list[str], list[str], str | None]:
+    scan = manga_extractor._PageScan(manga_extractor._make_soup(html, parser))
+    images = [img["url"] for img in manga_extractor._images_from_scan(url, scan)]
+    return images, manga_extractor._pagination_urls_from_scan(url, scan), manga_extractor._next_episode_url_from_scan(scan, url)
+
+
+@functools.lru_cache(maxsize=None)
+def _learned_profile(url: str, html: bytes, parser: str) -> dict:
+    """全候補で判定したときに当たった方法（サイトプロファイルに記録される内容）"""
+    return manga_extractor._extract_from_soup(url, manga_extractor._make_soup(html, parser), False, True)[1]
+
+
+def _profiled_extract(url: str, html: bytes, parser: str) -> tuple[list[str], list[str], str | None]:
+    """サイトプロファイルがある場合（覚えた方法だけで照合する）"""
+    profile = _learned_profile(url, html, parser)
+    page, _ = manga_extractor._extract_from_soup(url, manga_extractor._make_soup(html, parser), False, True, profile)
+    return [img["url"] for img in page.images], page.pagination_urls, page.next_episode_url
+
+
+def _measure(fn, html: bytes, repeat: int) -> tuple[float, float, tuple]:
+    """(1回あたりの秒数, ピークメモリMB, 結果)"""
+    result = fn(FIXTURE_URL, html)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(FIXTURE_URL, html)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    fn(FIXTURE_URL, html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    variants = [("legacy/html.parser", _legacy_extract)]
+    parsers = ["html.parser"] + (["lxml"] if manga_extractor.HTML_PARSER == "lxml" else [])
+    for p in parsers:
+        variants.append((f"single-pass/{p}", lambda u, h, p=p: _single_pass_extract(u, h, p)))
+    variants.append((f"profiled/{parsers[-1]}", lambda u, h: _profiled_extract(u, h, parsers[-1])))
+
+    print(f"{'fixture':<22} {'variant':<24} {'ms/page':>8} {'peak MB':>8}  result")
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, "*.html"))):
+        with open(path, "rb") as f:
+            html = f.read()
+        name = os.path.basename(path)
+        baseline = None
+        for label, fn in variants:
+            elapsed, peak_mb, result = _measure(fn, html, args.repeat)
+            if baseline is None:
+                baseline = result
+                note = f"{len(result[0])} imgs / {len(result[1])} pages / next={'yes' if result[2] else 'no'}"
+            else:
+                note = "same" if result == baseline else "DIFFERENT"
+            print(f"{name:<22} {label:<24} {elapsed * 1000:>8.2f} {peak_mb:>8.2f}  {note}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""抽出処理のエンドツーエンド・ベンチマーク（巡回 → ダウンロード/フィルタ → ZIP）
+
+ローカルのスタンドインサーバー（standin_site.py）に WordPress 風の漫画サイトを立て、
+get_multiple_episodes_images / filter_manga_images / build_images_zip をそれぞれ計測します
+（filter は最初の画像がそろうまでの時間 first_image_s も）。
+段階ごとに処理時間・リクエスト数・転送バイト数・ピークRSS を JSON で出力するので、
+変更前後の結果を保存して --compare で比べられます。
+
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --episodes 5 --pages 6 --latency-ms 30 --error-rate 0.02 -o after.json
+    python benchmarks/bench_pipeline.py --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import manga_extractor  # noqa: E402
+from standin_site import SiteConfig, start_site  # noqa: E402
+
+RSS_SAMPLE_INTERVAL = 0.005
+
+
+def _current_rss() -> int | None:
+    """現在の RSS（バイト）。/proc が無い環境では None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _max_rss() -> int:
+    """プロセス開始からのピーク RSS（バイト）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class _RssSampler:
+    """計測中の RSS を一定間隔で読み、その区間のピークを求める（/proc が無ければ ru_maxrss で代用）"""
+
+    def __init__(self):
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _current_rss() or 0)
+            self._stop.wait(RSS_SAMPLE_INTERVAL)
+
+    def __enter__(self) -> "_RssSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _current_rss() or 0) or _max_rss()
+
+
+def _measure(site, fn):
+    """fn() の (結果, 計測値)。リクエスト数・転送量はサーバー側で数えた差分"""
+    before = site.counters()
+    with _RssSampler() as rss:
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+    after = site.counters()
+    return result, {
+        "wall_s": round(elapsed, 4),
+        "requests": after["requests"] - before["requests"],
+        "bytes": after["bytes"] - before["bytes"],
+        "errors_injected": after["errors"] - before["errors"],
+        "peak_rss_mb": round(rss.peak / 1024 / 1024, 1),
+    }
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_once(site, args) -> dict:
+    url = site.url + "/archives/1/"
+    stages = {}
+
+    candidates, stages["crawl"] = _measure(
+        site, lambda: manga_extractor.get_multiple_episodes_images(
+            url, num_episodes=args.episodes, prefetch_episodes=args.prefetch_episodes
+        )
+    )
+    stages["crawl"]["candidates"] = len(candidates)
+
+    stats = manga_extractor.DownloadStats()
+    store = manga_extractor.ImageStore(memory_budget=args.store_mb * 1024 * 1024 if args.store_mb >= 0 else None)
+    # 最初の画像がプレビューに出せるようになるまで（on_ready に最初に渡されるまで）の時間
+    first_ready: list[float] = []
+    started = time.perf_counter()
+
+    def on_ready(images: list[dict]) -> None:
+        if not first_ready:
+            first_ready.append(time.perf_counter())
+
+    manga_images, stages["filter"] = _measure(
+        site,
+        lambda: manga_extractor.filter_manga_images(
+            candidates,
+            min_size=args.min_size_kb * 1000,
+            referer=url,
+            max_workers=args.workers,
+            engine=args.engine,
+            per_host_limit=args.workers,
+            probe=args.probe,
+            stats=stats,
+            store=store,
+            on_ready=on_ready,
+        ),
+    )
+    stages["filter"]["images"] = len(manga_images)
+    stages["filter"]["first_image_s"] = round(first_ready[0] - started, 4) if first_ready else None
+
+    (zip_bytes, _), stages["zip"] = _measure(site, lambda: manga_extractor.build_images_zip(manga_images))
+    stages["zip"]["zip_bytes"] = len(zip_bytes)
+    store.cleanup()
+
+    total = {key: sum(s[key] for s in stages.values()) for key in ("wall_s", "requests", "bytes", "errors_injected")}
+    total["wall_s"] = round(total["wall_s"], 4)
+    total["peak_rss_mb"] = max(s["peak_rss_mb"] for s in stages.values())
+    return {"stages": stages, "total": total}
+
+
+def _median_run(runs: list[dict]) -> dict:
+    """処理時間の中央値の回（段階ごとの値の組み合わせが崩れないように回ごと選ぶ）"""
+    ordered = sorted(runs, key=lambda r: r["total"]["wall_s"])
+    return ordered[len(ordered) // 2]
+
+
+def _print_comparison(current: dict, baseline: dict) -> None:
+    print(f"{'stage':<8} {'metric':<12} {'before':>12} {'after':>12} {'change':>8}", file=sys.stderr)
+    for stage in ("crawl", "filter", "zip", "total"):
+        before = baseline["result"]["stages"].get(stage) if stage != "total" else baseline["result"]["total"]
+        after = current["result"]["stages"].get(stage) if stage != "total" else current["result"]["total"]
+        if not before or not after:
+            continue
+        for metric in ("wall_s", "first_image_s", "requests", "bytes", "peak_rss_mb"):
+            b, a = before.get(metric), after.get(metric)
+            if b is None or a is None:
+                continue
+            change = f"{(a - b) / b * 100:+.1f}%" if b else "-"
+            print(f"{stage:<8} {metric:<12} {b:>12} {a:>12} {change:>8}", file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--episodes", type=int, default=3)
+    parser.add_argument("--pages", type=int, default=4, help="1話あたりのページ数")
+    parser.add_argument("--images-per-page", type=int, default=5)
+    parser.add_argument("--image-size", default="800x1200", help="画像の幅x高さ")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="1リクエストあたりの擬似遅延")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="503 を返す割合（0〜1）")
+    parser.add_argument(
+        "--engine",
+        default=manga_extractor.DOWNLOAD_ENGINE_THREAD,
+        choices=[manga_extractor.DOWNLOAD_ENGINE_THREAD, manga_extractor.DOWNLOAD_ENGINE_ASYNCIO],
+    )
+    parser.add_argument("--workers", type=int, default=10, help="並列ダウンロード数")
+    parser.add_argument("--min-size-kb", type=int, default=30)
+    parser.add_argument(
+        "--store-mb",
+        type=int,
+        default=manga_extractor.IMAGE_STORE_MEMORY_BUDGET_MB,
+        help="メモリに置く画像の上限（-1 で無制限）",
+    )
+    parser.add_argument("--no-probe", dest="probe", action="store_false", help="先頭バイト判定を使わない")
+    parser.add_argument("--repeat", type=int, default=3, help="繰り返し回数（処理時間が中央値の回を結果にする）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--prefetch-episodes",
+        type=int,
+        default=manga_extractor.EPISODE_PREFETCH_WORKERS,
+        help="次の話以降を先読みする数（0 で「次の話」リンクを1話ずつ辿る）",
+    )
+    parser.add_argument("--srcset", default="", help="srcset に並べる縮小版の幅（例: 300,768,1024）")
+    parser.add_argument("--output", "-o", help="結果の JSON を書き出すファイル（省略時は標準出力）")
+    parser.add_argument("--compare", help="比較する以前の結果（JSON）")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+    config = SiteConfig(
+        episodes=args.episodes,
+        pages=args.pages,
+        images_per_page=args.images_per_page,
+        image_width=width,
+        image_height=height,
+        latency=args.latency_ms / 1000,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        srcset_widths=tuple(int(w) for w in args.srcset.split(",") if w.strip()),
+    )
+    site = start_site(config)
+    try:
+        runs = [run_once(site, args) for _ in range(max(1, args.repeat))]
+    finally:
+        site.shutdown()
+
+    report = {
+        "benchmark": "pipeline",
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "html_parser": manga_extractor.HTML_PARSER,
+        "config": {
+            **vars(config),
+            "engine": args.engine,
+            "workers": args.workers,
+            "min_size_kb": args.min_size_kb,
+            "store_mb": args.store_mb,
+            "probe": args.probe,
+            "prefetch_episodes": args.prefetch_episodes,
+            "repeat": args.repeat,
+        },
+        "result": _median_run(runs),
+        "runs": runs,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            _print_comparison(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""ベンチマーク用のスタンドインサーバー（WordPress 風の漫画サイトをローカルで再現）
+
+/archives/<話>/ と /archives/<話>/<ページ>/ に記事ページ、/wp-content/uploads/ 以下に画像を置きます。
+記事ページには .entry-content 内の画像・.post-page-numbers のページ送り・「次の話」リンク・
+カテゴリ一覧（/category/series/。全話へのリンクを新しい順に並べたページ）へのリンクがあり、
+ロゴや小さなアイコンなどフィルタで落ちるべき画像も混ぜてあります。srcset_widths を指定すると、
+記事の画像に WordPress 風の縮小版（/wp-content/uploads/.../p1_0-300x450.jpg）を並べた srcset が付きます。
+
+    from standin_site import SiteConfig, start_site
+    site = start_site(SiteConfig(episodes=3, pages=4, images_per_page=5, latency=0.02))
+    url = site.url + "/archives/1/"
+    ...
+    print(site.counters())
+    site.shutdown()
+
+記事ページ・カテゴリ一覧と画像には内容から作った ETag を付け、If-None-Match が一致すれば 304 を返します
+（image_etags=False なら画像には付けません）。
+外部サイトにはアクセスしません。応答の遅延とエラー（503）の割合は設定で変えられます。
+"""
+
+import hashlib
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+
+@dataclass
+class SiteConfig:
+    episodes: int = 3
+    pages: int = 4
+    images_per_page: int = 5
+    image_width: int = 800
+    image_height: int = 1200
+    image_variants: int = 8  # 同じ内容を使い回す画像の種類数（生成時間の節約）
+    latency: float = 0.0  # 1リクエストあたりの遅延（秒）
+    error_rate: float = 0.0  # 503 を返す割合（記事ページ・画像とも）
+    seed: int = 0
+    srcset_widths: tuple[int, ...] = ()  # 指定すると WordPress 風の縮小版（-<幅>x<高さ>.jpg）を srcset に並べる
+    image_etags: bool = True  # 画像にも ETag を付ける（False なら再検証できない応答になる）
+    missing_images: tuple[str, ...] = ()  # 404 を返す画像のパス（/wp-content/uploads/ep1/p1_0.jpg など）
+
+
+def _make_jpeg(width: int, height: int, seed: int) -> bytes:
+    """ノイズ入りの JPEG（単色より実際の漫画画像に近いサイズになる）"""
+    rng = random.Random(seed)
+    noise = Image.effect_noise((width, height), 40 + rng.randint(0, 40)).convert("RGB")
+    tint = Image.new("RGB", (width, height), tuple(rng.randint(150, 250) for _ in range(3)))
+    buf = BytesIO()
+    Image.blend(noise, tint, 0.5).save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+
+def _srcset(config: SiteConfig, path: str) -> str:
+    """縮小版と元画像を並べた srcset（縮小版が先。WordPress と同じ並び）"""
+    stem = path[: -len(".jpg")]
+    candidates = [
+        f"{stem}-{w}x{w * config.image_height // config.image_width}.jpg {w}w"
+        for w in sorted(config.srcset_widths)
+        if w < config.image_width
+    ]
+    return ", ".join(candidates + [f"{path} {config.image_width}w"])
+
+
+def _page_html(config: SiteConfig, episode: int, page: int) -> bytes:
+    imgs = ""
+    for i in range(config.images_per_page):
+        path = f"/wp-content/uploads/ep{episode}/p{page}_{i}.jpg"
+        srcset = f' srcset="{_srcset(config, path)}"' if config.srcset_widths else ""
+        imgs += f'<img src="{path}"{srcset} alt="第{episode}話 {page}-{i}">'
+
+    # フィルタで落ちるべき画像（小さいアイコン・広告）
+    imgs += '<img src="/wp-content/uploads/icon-share.png" alt=""><img data-src="/wp-content/uploads/thumb-small.jpg">'
+    links = "".join(
+        f'<a class="post-page-numbers{" current" if p == page else ""}" href="/archives/{episode}/{p}/">{p}</a>'
+        for p in range(1, config.pages + 1)
+    )
+    next_link = ""
+    if episode < config.episodes:
+        next_link = f'<a href="/archives/{episode + 1}/"><div class="page-text-body">次の話</div></a>'
+    return (
+        "<!DOCTYPE html><html><head><meta charset='utf-8'>"
+        f"<title>第{episode}話（{page}）</title></head><body>"
+        '<div class="cat-links"><a href="/category/series/" rel="category tag">シリーズ</a></div>'
+        '<header><img src="/wp-content/themes/site/logo.png" alt="logo"></header>'
+        f'<article><div class="entry-content">{imgs}</div>'
+        f'<div class="page-links">{links}</div></article>'
+        f"<nav>{next_link}</nav>"
+        '<aside class="sidebar"><img src="/wp-content/uploads/banner-ad.gif"></aside>'
+        "</body></html>"
+    ).encode("utf-8")
+
+
+def _category_html(config: SiteConfig) -> bytes:
+    """カテゴリ一覧（WordPress と同じく新しい話が先）"""
+    items = "".join(
+        f'<li><a href="/archives/{episode}/">第{episode}話</a></li>' for episode in range(config.episodes, 0, -1)
+    )
+    return (
+        "<!DOCTYPE html><html><head><meta charset='utf-8'><title>シリーズ</title></head><body>"
+        f'<main><ul class="posts">{items}</ul></main></body></html>'
+    ).encode("utf-8")
+
+
+class StandinSite:
+    """起動中のスタンドインサーバー。counters() でリクエスト数・送信バイト数・返したエラー数を返す"""
+
+    def __init__(self, config: SiteConfig):
+        self.config = config
+        self._lock = threading.Lock()
+        self._rng = random.Random(config.seed)
+        self._counts = {"requests": 0, "bytes": 0, "errors": 0}
+        self._images = [
+            _make_jpeg(config.image_width, config.image_height, config.seed * 1000 + i)
+            for i in range(max(1, config.image_variants))
+        ]
+        self._small = _make_jpeg(48, 48, config.seed)
+        self._resized: dict[tuple[int, int, int], bytes] = {}
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._server.request_queue_size = 1024
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def counters(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+    def shutdown(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _respond(self, path: str) -> tuple[int, str, bytes]:
+        with self._lock:
+            self._counts["requests"] += 1
+            failed = self._rng.random() < self.config.error_rate
+        if failed:
+            with self._lock:
+                self._counts["errors"] += 1
+            return 503, "text/plain", b"Service Unavailable"
+        m = re.match(r"^/archives/(\d+)(?:/(\d+))?/?$", path)
+        if m:
+            episode, page = int(m.group(1)), int(m.group(2) or 1)
+            if 1 <= episode <= self.config.episodes and 1 <= page <= self.config.pages:
+                return 200, "text/html; charset=utf-8", _page_html(self.config, episode, page)
+            return 404, "text/plain", b"Not Found"
+        if path.rstrip("/") == "/category/series":
+            return 200, "text/html; charset=utf-8", _category_html(self.config)
+        if path in self.config.missing_images:
+            return 404, "text/plain", b"Not Found"
+        m = re.match(r"^/wp-content/uploads/ep(\d+)/p(\d+)_(\d+)(?:-(\d+)x(\d+))?\.jpg$", path)
+        if m:
+            variant = hash((int(m.group(1)), int(m.group(2)), int(m.group(3)))) % len(self._images)
+            if m.group(4):
+                return 200, "image/jpeg", self._resized_image(variant, int(m.group(4)), int(m.group(5)))
+            return 200, "image/jpeg", self._images[variant]
+        if path.startswith("/wp-content/"):
+            return 200, "image/jpeg", self._small
+        return 404, "text/plain", b"Not Found"
+
+    def _resized_image(self, variant: int, width: int, height: int) -> bytes:
+        key = (variant, width, height)
+        with self._lock:
+            data = self._resized.get(key)
+        if data is None:
+            buf = BytesIO()
+            Image.open(BytesIO(self._images[variant])).resize((width, height)).save(buf, "JPEG", quality=85)
+            data = buf.getvalue()
+            with self._lock:
+                self._resized[key] = data
+        return data
+
+    def _handler_class(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                if site.config.latency:
+                    time.sleep(site.config.latency)
+                status, content_type, body = site._respond(self.path.split("?", 1)[0])
+                etag = None
+                validated = content_type.startswith("text/html") or site.config.image_etags
+                if status == 200 and validated:
+                    etag = f'"{hashlib.md5(body).hexdigest()}"'
+                    if self.headers.get("If-None-Match") == etag:
+                        status, body = 304, b""
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                if etag:
+                    self.send_header("ETag", etag)
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                with site._lock:
+                    site._counts["bytes"] += len(body)
+
+        return Handler
+
+
+def start_site(config: SiteConfig | None = None) -> StandinSite:
+    return StandinSite(config or SiteConfig())
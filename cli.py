@@ -0,0 +1,263 @@
+"""URLリストをまとめて処理するバッチ実行（Streamlit 不要）
+
+ジョブは JSONL（1行1ジョブ）で渡します。url 以外は省略可能です。
+
+    {"url": "https://example.com/archives/123", "num_episodes": 3, "min_size_kb": 30}
+
+    python cli.py jobs.jsonl
+    python cli.py jobs.jsonl --workers 4 --verbose
+
+ジョブはプロセスプールで並行に処理し、結果は画面版の「output/ に保存」と同じ
+output/<run_id>/（images/, images.json, meta.json）に書き出します。
+
+ジョブに指定できるキー:
+    url, num_episodes (1), min_size_kb (30), max_images (120), engine ("thread" / "asyncio"),
+    max_workers (10), per_host_limit, probe (true), cache (true), adaptive (true),
+    rate_limits ({"example.com": 2}), dedupe (true), site_profiles (true), page_cache (true),
+    srcset_width (1000: srcset から選ぶ画像の目標の幅。これ以上の候補のうち最小のものを使う),
+    transcode ("webp" / "avif"), transcode_quality (80), transcode_max_width, transcode_grayscale (true),
+    update (false: true なら前回の続きから新しい話・画像だけを取得し、num_episodes は新しい話の上限), run_id
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from manga_extractor import (
+    ASYNC_PER_HOST_LIMIT,
+    DOWNLOAD_ENGINE_ASYNCIO,
+    DOWNLOAD_ENGINE_THREAD,
+    IMAGE_STORE_MEMORY_BUDGET_MB,
+    DownloadStats,
+    HostConcurrencyController,
+    ImageStore,
+    TRANSCODE_QUALITY,
+    TRANSCODE_WORKERS,
+    RunProfile,
+    SRCSET_TARGET_WIDTH,
+    SeriesIndex,
+    _ensure_output_dir,
+    _get_image_cache,
+    _get_page_cache,
+    _get_site_profiles,
+    _make_run_id,
+    count_episode_images,
+    extract_manga_images,
+    image_name_map,
+    profile_run,
+    save_run_output,
+    transcode_images,
+)
+
+logger = logging.getLogger("manga_extractor.cli")
+
+
+def load_jobs(path: str) -> list[dict]:
+    """JSONL を読み込む（空行と # で始まる行は無視）"""
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    jobs = []
+    try:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise SystemExit(f"{path}:{line_no}: JSON として読めません: {e}")
+            if not isinstance(job, dict) or not job.get("url"):
+                raise SystemExit(f"{path}:{line_no}: url がありません")
+            jobs.append(job)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return jobs
+
+
+def run_job(job: dict, output_base: str, debug: bool = False) -> dict:
+    """1ジョブを実行して output/<run_id>/ に保存し、集計を返す（プロセスプールから呼ぶ）"""
+    run_id = str(job.get("run_id") or _make_run_id())
+    url = job["url"]
+    num_episodes = int(job.get("num_episodes", 1))
+    min_size_kb = int(job.get("min_size_kb", 30))
+    max_images = int(job.get("max_images", job.get("max_images_total", 120)))
+    engine = job.get("engine", DOWNLOAD_ENGINE_THREAD)
+    max_workers = int(job.get("max_workers", 10))
+    per_host_limit = int(job.get("per_host_limit", ASYNC_PER_HOST_LIMIT))
+    summary = {
+        "run_id": run_id,
+        "url": url,
+        "ok": False,
+        "images": 0,
+        "candidates": 0,
+        "duplicates": 0,
+        "bytes_downloaded": 0,
+        "transcode": None,
+        "update": None,
+    }
+
+    started = time.perf_counter()
+    stats = DownloadStats()
+    profile = RunProfile()
+    store = ImageStore(memory_budget=IMAGE_STORE_MEMORY_BUDGET_MB * 1024 * 1024)
+    rate_limits = job.get("rate_limits") or {}
+    limiter = None
+    if job.get("adaptive", True) or rate_limits:
+        limiter = HostConcurrencyController(
+            max_per_host=per_host_limit if engine == DOWNLOAD_ENGINE_ASYNCIO else max_workers,
+            adaptive=bool(job.get("adaptive", True)),
+            rate_limits={str(k).lower(): float(v) for k, v in rate_limits.items()},
+        )
+    # 巡回した話は開始URLごとの一覧に記録し、update なら記録済みの話を飛ばして続きだけ取得する
+    series_index = SeriesIndex.for_url(url)
+    update = bool(job.get("update", False))
+    completed_episodes, crawl_episodes = series_index.update_plan(num_episodes) if update else (None, num_episodes)
+    episode_records: list[dict] = []
+    try:
+        with profile_run(profile):
+            candidates, manga_images = extract_manga_images(
+                url,
+                num_episodes=crawl_episodes,
+                min_size=min_size_kb * 1000,
+                referer=url,
+                debug=debug,
+                max_workers=max_workers,
+                engine=engine,
+                per_host_limit=per_host_limit,
+                probe=bool(job.get("probe", True)),
+                stats=stats,
+                cache=_get_image_cache() if job.get("cache", True) else None,
+                store=store,
+                max_images=max_images,
+                limiter=limiter,
+                dedupe=bool(job.get("dedupe", True)),
+                site_profiles=_get_site_profiles() if job.get("site_profiles", True) else None,
+                page_cache=_get_page_cache() if job.get("page_cache", True) else None,
+                srcset_width=int(job.get("srcset_width", SRCSET_TARGET_WIDTH)),
+                completed_episodes=completed_episodes,
+                on_episode=episode_records.append,
+                exclude_urls=series_index.image_urls() if update else None,
+            )
+        profile.stop()
+        merged = series_index.merge(episode_records, manga_images, rejected_urls=stats.rejected_urls())
+        series_index.save()
+        if update:
+            summary["update"] = merged
+        duplicates = stats.as_dict().get("duplicates_collapsed", 0)
+        summary.update(images=len(manga_images), candidates=len(candidates), duplicates=duplicates)
+        if not candidates:
+            if update:
+                summary.update(ok=True, note="前回から新しい画像はありませんでした")
+                return summary
+            summary["error"] = "画像が見つかりませんでした"
+            return summary
+        if not manga_images:
+            summary["error"] = "漫画画像が見つかりませんでした（最小サイズなどを確認してください）"
+            return summary
+        if job.get("transcode"):
+            # ジョブ自体がプロセスプールのワーカーなので、変換はこのプロセスのスレッドで行う
+            # （ワーカーの中にさらにプロセスプールを作ると、終了時に子プロセスの終了待ちで止まる）。
+            # Pillow はエンコード中に GIL を手放すので、CPU の数まではスレッドでも並列に進む
+            with profile_run(profile), ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS) as executor:
+                summary["transcode"] = transcode_images(
+                    manga_images,
+                    fmt=job["transcode"],
+                    quality=int(job.get("transcode_quality", TRANSCODE_QUALITY)),
+                    max_width=int(job.get("transcode_max_width") or 0) or None,
+                    grayscale=bool(job.get("transcode_grayscale", True)),
+                    store=store,
+                    executor=executor,
+                )
+            profile.stop()
+        name_map = image_name_map(manga_images)
+        meta = {
+            "url": url,
+            "num_episodes": num_episodes,
+            "min_image_size_kb": min_size_kb,
+            "max_images_total": max_images,
+            "total_candidates": len(candidates),
+            "total_extracted": len(manga_images),
+            "duplicates_collapsed": duplicates,
+            "episode_counts": count_episode_images(manga_images),
+            "transcode": summary["transcode"],
+            "update": summary["update"],
+        }
+        save_run_output(os.path.join(output_base, run_id), manga_images, name_map, meta, profile=profile)
+        summary["ok"] = True
+    except Exception as e:
+        logger.exception("ジョブが失敗しました: %s", url)
+        summary["error"] = str(e)
+    finally:
+        store.cleanup()
+        if job.get("site_profiles", True):
+            _get_site_profiles().save(force=True)
+        summary["bytes_downloaded"] = stats.as_dict().get("bytes_downloaded", 0)
+        summary["seconds"] = time.perf_counter() - started
+    return summary
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("jobs", help="ジョブの JSONL ファイル（- で標準入力）")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="同時に処理するジョブ数（プロセス数）")
+    parser.add_argument("--output", default=None, help="保存先のベースディレクトリ（既定: output/）")
+    parser.add_argument("--verbose", "-v", action="store_true", help="デバッグ出力を表示")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+    if args.verbose:
+        logging.getLogger("manga_extractor").setLevel(logging.DEBUG)
+    jobs = load_jobs(args.jobs)
+    if not jobs:
+        print("ジョブがありません", file=sys.stderr)
+        return 1
+    output_base = args.output or _ensure_output_dir()
+    os.makedirs(output_base, exist_ok=True)
+
+    started = time.perf_counter()
+    summaries = []
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(jobs)))) as pool:
+        futures = [pool.submit(run_job, job, output_base, args.verbose) for job in jobs]
+        for future in as_completed(futures):
+            summary = future.result()
+            summaries.append(summary)
+            if summary["ok"]:
+                print(
+                    f"✅ {summary['run_id']}  {summary['images']}枚（候補{summary['candidates']}件・重複{summary['duplicates']}件） "
+                    f"{summary['seconds']:.1f}秒  {summary['url']}"
+                )
+                if summary.get("note"):
+                    print(f"   {summary['note']}")
+                elif summary["update"]:
+                    print(
+                        f"   更新: 記録済み{summary['update']['known_episodes']}話 / "
+                        f"新しい話{summary['update']['new_episodes']}話・新しい画像{summary['update']['new_images']}枚"
+                    )
+                transcoded = summary["transcode"]
+                if transcoded:
+                    print(
+                        f"   {transcoded['format']}: {transcoded['transcoded']}枚を変換 "
+                        f"{transcoded['bytes_before'] / 1024 / 1024:.1f}MB → {transcoded['bytes_after'] / 1024 / 1024:.1f}MB"
+                        f"（-{transcoded['reduction'] * 100:.0f}%） {transcoded['images_per_s']:.1f}枚/秒"
+                    )
+            else:
+                print(f"❌ {summary['run_id']}  {summary.get('error', '')}  {summary['url']}")
+    elapsed = time.perf_counter() - started
+
+    succeeded = sum(1 for s in summaries if s["ok"])
+    images = sum(s["images"] for s in summaries)
+    downloaded = sum(s["bytes_downloaded"] for s in summaries)
+    print(
+        f"\n{len(summaries)}ジョブ（成功 {succeeded} / 失敗 {len(summaries) - succeeded}） {elapsed:.1f}秒\n"
+        f"  {len(summaries) / elapsed * 60:.1f} ジョブ/分, {images / elapsed:.1f} 枚/秒, "
+        f"{downloaded / elapsed / 1024 / 1024:.2f} MB/秒（保存先: {output_base}）"
+    )
+    return 0 if succeeded == len(summaries) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
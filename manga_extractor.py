@@ -0,0 +1,4620 @@
+"""漫画画像抽出のコア処理（Streamlit に依存しない）
+
+ページ巡回・画像ダウンロード・フィルタ・ZIP/保存までをここにまとめ、
+app.py（Streamlit UI）と cli.py（バッチ実行）の両方から使う。
+デバッグ出力は logging（ロガー名 "manga_extractor"）と set_event_hook で登録したフックに送る。
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup
+from bs4.element import Tag
+
+try:
+    import aiohttp
+except ImportError:  # asyncio エンジンを使わない場合は不要
+    aiohttp = None
+try:
+    import fcntl
+except ImportError:  # Windows。サイトプロファイルの保存をプロセス間でロックしない
+    fcntl = None
+from urllib.parse import urljoin, urlparse
+from io import BytesIO
+import numpy as np
+from PIL import Image, features
+import os
+import json
+import logging
+import asyncio
+import functools
+import hashlib
+import mmap
+import multiprocessing
+import random
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
+import zipfile
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import BinaryIO, Callable
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+
+
+logger = logging.getLogger("manga_extractor")
+
+# イベントの通知先。(level, message) を受け取る。UI ならその場で表示、CLI なら何もしない（logging で十分）
+_event_hook: Callable[[str, str], None] | None = None
+# ワーカースレッドに呼び出し元の実行コンテキストを引き継ぐためのフック。
+# 呼び出し元のスレッドで呼ばれ、ワーカー開始時に実行する関数（不要なら None）を返す
+_thread_context_hook: Callable[[], Callable[[], None] | None] | None = None
+
+_LOG_LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "error": logging.ERROR}
+# 実行中の抽出に紐づくスレッドごとの状態。events があればイベントをフックではなくそこにため、
+# profile（RunProfile）があれば各段階の計測値を記録する。ワーカースレッドには _thread_pool で引き継ぐ
+_event_sink = threading.local()
+
+
+def set_event_hook(hook: Callable[[str, str], None] | None) -> None:
+    global _event_hook
+    _event_hook = hook
+
+
+def set_thread_context_hook(hook: Callable[[], Callable[[], None] | None] | None) -> None:
+    global _thread_context_hook
+    _thread_context_hook = hook
+
+
+def _emit(message: str, level: str = "debug") -> None:
+    """デバッグ表示・エラー通知（logging とイベントフック、またはジョブのイベント一覧に送る）"""
+    logger.log(_LOG_LEVELS.get(level, logging.INFO), message)
+    events = getattr(_event_sink, "events", None)
+    if events is not None:
+        events.append((level, message))
+    elif _event_hook is not None:
+        _event_hook(level, message)
+
+
+def _sha256_text(s: str) -> str:
+    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+
+def _get_output_base_dir() -> str:
+    """保存先（リポジトリ内 output/）"""
+    try:
+        base = os.path.dirname(__file__)
+    except Exception:
+        base = os.getcwd()
+    return os.path.join(base, "output")
+
+
+def _ensure_output_dir() -> str:
+    base = _get_output_base_dir()
+    os.makedirs(base, exist_ok=True)
+    return base
+
+
+def _make_run_id() -> str:
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    rnd = hashlib.sha256(os.urandom(16)).hexdigest()[:8]
+    return f"{ts}_{rnd}"
+
+
+def _thread_pool(max_workers: int) -> ThreadPoolExecutor:
+    """呼び出し元の実行コンテキストを引き継いだスレッドプール（ワーカー内からもイベントを表示できるように）"""
+    attach = _thread_context_hook() if _thread_context_hook is not None else None
+    events = getattr(_event_sink, "events", None)
+    profile = getattr(_event_sink, "profile", None)
+
+    def _initializer() -> None:
+        if attach is not None:
+            attach()
+        _event_sink.events = events
+        _event_sink.profile = profile
+
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=_initializer)
+
+
+def get_request_headers(url: str) -> dict:
+    parsed_url = urlparse(url)
+    base_domain = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    return {
+        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
+        "Accept-Language": "ja,en-US;q=0.9,en;q=0.8",
+        "Referer": base_domain,
+    }
+
+
+# 429/5xx はリトライ対象（Retry-After があればそれに従う）
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+HTTP_BACKOFF_MAX = 10.0
+HTTP_RETRY_AFTER_MAX = 30.0
+
+
+class _JitteredRetry(Retry):
+    """指数バックオフにジッターを加え、待ち時間に上限を設けたRetry"""
+
+    def get_backoff_time(self) -> float:
+        backoff = min(super().get_backoff_time(), HTTP_BACKOFF_MAX)
+        if backoff <= 0:
+            return 0
+        return random.uniform(backoff / 2, backoff)
+
+    def get_retry_after(self, response) -> float | None:
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, HTTP_RETRY_AFTER_MAX)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_http_session(pool_size: int = 10) -> requests.Session:
+    """プロセス内で共有するHTTPセッション（ホストごとの接続プール + keep-alive + リトライ）
+
+    Sessionの接続プールはスレッドセーフなので、並列ダウンロードのスレッドからそのまま使う。
+    pool_size は1ホストあたりの最大接続数（並列ダウンロード数に合わせる）。
+    """
+    retry = _JitteredRetry(
+        total=HTTP_MAX_RETRIES,
+        connect=HTTP_MAX_RETRIES,
+        read=HTTP_MAX_RETRIES,
+        status=HTTP_MAX_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=HTTP_RETRY_STATUSES,
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=max(1, int(pool_size)),
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # brotli がインストールされていれば "br" も含まれる
+    session.headers["Accept-Encoding"] = make_headers(accept_encoding=True)["accept-encoding"]
+    return session
+
+
+def _http_get(url: str, headers: dict, session: requests.Session | None = None, **kwargs) -> requests.Response:
+    """全ての取得処理はここを通す（共有セッション経由）"""
+    session = session or _get_http_session()
+    kwargs.setdefault("timeout", 30)
+    return session.get(url, headers=headers, **kwargs)
+
+
+try:
+    import lxml  # noqa: F401
+
+    HTML_PARSER = "lxml"
+except ImportError:  # lxml が無ければ標準の html.parser
+    HTML_PARSER = "html.parser"
+
+
+def _retry_count(response: requests.Response) -> int:
+    """urllib3 がこのレスポンスまでに内部で行ったリトライの回数"""
+    retries = getattr(response.raw, "retries", None)
+    return len(retries.history) if retries is not None else 0
+
+
+def _make_soup(content: bytes, parser: str | None = None) -> BeautifulSoup:
+    return BeautifulSoup(content, parser or HTML_PARSER)
+
+
+# 本文エリアの候補（上から優先）
+CONTENT_SELECTORS = [
+    "article",
+    ".entry-content",
+    ".post-content",
+    ".article-content",
+    ".content",
+    ".single-content",
+    ".post-body",
+    ".article-body",
+    "main",
+    "#content",
+    "#main",
+    ".post",
+    ".entry",
+    ".ystd",
+    "#ystd",
+]
+
+# ページネーションの候補（上から優先。最初にヒットしたものだけ使う）
+PAGINATION_SELECTORS = [
+    ".pagination a",
+    ".page-numbers a",
+    ".pager a",
+    ".wp-pagenavi a",
+    "nav.navigation a",
+    ".post-page-numbers",
+    "a.page-link",
+    ".pages a",
+]
+
+# WordPress系の「次の記事」ナビ
+NEXT_EPISODE_NAV_SELECTORS = [
+    "nav.post-navigation .nav-next a",
+    "nav.navigation.post-navigation .nav-next a",
+    ".post-navigation .nav-next a",
+    ".navigation.post-navigation .nav-next a",
+]
+
+SKIP_PATTERNS = [
+    "icon",
+    "logo",
+    "avatar",
+    "emoji",
+    "button",
+    "banner",
+    "advertisement",
+    "widget",
+    "gravatar",
+    "favicon",
+    "sprite",
+    "pixel",
+    "tracking",
+    "analytics",
+    "1x1",
+]
+IMG_EXTENSIONS = [".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif"]
+IMG_PATH_PATTERNS = ["/uploads/", "/images/", "/wp-content/", "/img/", "/photo/", "/manga/", "/comic/"]
+SIZE_PARAM_PATTERNS = ["width=", "height=", "w=", "h=", "size=", "resize"]
+
+
+def _parse_compound_selector(selector: str) -> tuple[str | None, frozenset[str], str | None]:
+    """"nav.navigation" / ".entry-content" / "#main" のような単純セレクタを (タグ, クラス, id) に分解"""
+    if selector.startswith("#"):
+        return None, frozenset(), selector[1:]
+    tag, *classes = selector.split(".")
+    return (tag or None), frozenset(classes), None
+
+
+def _matches_compound(spec: tuple[str | None, frozenset[str], str | None], name: str, classes, el_id) -> bool:
+    tag, cls, id_ = spec
+    if tag and tag != name:
+        return False
+    if id_ and id_ != el_id:
+        return False
+    return cls.issubset(classes)
+
+
+_CONTENT_SPECS = [_parse_compound_selector(s) for s in CONTENT_SELECTORS]
+# "<祖先> a" 形式のページネーションは祖先側の条件を、それ以外は要素自身の条件を持つ
+_PAGINATION_SPECS = [
+    (_parse_compound_selector(s[: -len(" a")]), True) if s.endswith(" a") else (_parse_compound_selector(s), False)
+    for s in PAGINATION_SELECTORS
+]
+# "<A> .nav-next a" の <A> 部分
+_NEXT_NAV_SPECS = [_parse_compound_selector(s.split(" ")[0]) for s in NEXT_EPISODE_NAV_SELECTORS]
+
+# 祖先条件をビットで持つ（子孫は親のビットを引き継ぐ）
+_BIT_BODY = 1
+_BIT_CONTENT = 1 << 1
+_BIT_PAGINATION = _BIT_CONTENT << len(_CONTENT_SPECS)
+_BIT_NEXT_NAV = _BIT_PAGINATION << len(_PAGINATION_SPECS)
+_BIT_NEXT_NAV_INNER = _BIT_NEXT_NAV << len(_NEXT_NAV_SPECS)
+
+_ALL_CONTENT_KS = tuple(range(len(_CONTENT_SPECS)))
+_ALL_PAGINATION_KS = tuple(range(len(_PAGINATION_SPECS)))
+_ALL_NEXT_NAV_KS = tuple(range(len(_NEXT_NAV_SPECS)))
+
+# ページ送り・次話の見つけ方（サイトプロファイルに記録する名前）。セレクタで見つけた場合は "selector:<セレクタ>" / "nav:<セレクタ>"
+PAGINATION_STRATEGIES = ("rel_next", "numeric", "text")
+NEXT_EPISODE_STRATEGIES = ("div", "text")
+
+
+def _scan_plan(profile: dict | None) -> tuple[tuple[int, ...], tuple[int, ...], tuple[int, ...]]:
+    """走査で照合するセレクタの番号（本文・ページ送り・次話ナビ）。プロファイルで方法が決まっていればそれだけにする
+
+    本文は記録されたセレクタより優先度の高いものも照合する。そちらが当たったページは、
+    プロファイルと違う本文エリアになるので外れ（全候補で判定し直し）になる。
+    """
+    content_ks, pagination_ks, nav_ks = _ALL_CONTENT_KS, _ALL_PAGINATION_KS, _ALL_NEXT_NAV_KS
+    if not profile:
+        return content_ks, pagination_ks, nav_ks
+    content = profile.get("content")
+    if content in CONTENT_SELECTORS:
+        content_ks = tuple(range(CONTENT_SELECTORS.index(content) + 1))
+    pagination = profile.get("pagination") or ""
+    if pagination.startswith("selector:") and pagination[len("selector:") :] in PAGINATION_SELECTORS:
+        pagination_ks = (PAGINATION_SELECTORS.index(pagination[len("selector:") :]),)
+    elif pagination in PAGINATION_STRATEGIES:
+        pagination_ks = ()
+    next_episode = profile.get("next_episode") or ""
+    if next_episode.startswith("nav:") and next_episode[len("nav:") :] in NEXT_EPISODE_NAV_SELECTORS:
+        nav_ks = (NEXT_EPISODE_NAV_SELECTORS.index(next_episode[len("nav:") :]),)
+    elif next_episode in NEXT_EPISODE_STRATEGIES:
+        nav_ks = ()
+    return content_ks, pagination_ks, nav_ks
+
+
+class _PageScan:
+    """HTMLツリーを1回だけ走査して集めた、画像・ページネーション・次話リンクの候補"""
+
+    __slots__ = (
+        "imgs",
+        "anchors",
+        "body_found",
+        "content_found",
+        "pagination_links",
+        "rel_next",
+        "next_div",
+        "next_div_following_a",
+        "next_nav_links",
+    )
+
+    def __init__(self, soup: BeautifulSoup, profile: dict | None = None):
+        self.imgs: list[tuple[Tag, int]] = []
+        self.anchors: list[Tag] = []
+        self.body_found = False
+        self.content_found = [False] * len(_CONTENT_SPECS)
+        self.pagination_links: list[list[Tag]] = [[] for _ in _PAGINATION_SPECS]
+        self.rel_next: Tag | None = None
+        self.next_div: Tag | None = None
+        self.next_div_following_a: int = -1
+        self.next_nav_links: list[Tag | None] = [None] * len(_NEXT_NAV_SPECS)
+        # サイトプロファイルがあれば、当たると分かっているセレクタだけを照合する
+        content_ks, pagination_ks, nav_ks = _scan_plan(profile)
+
+        masks: dict[int, int] = {}
+        for el in soup.descendants:
+            if not isinstance(el, Tag):
+                continue
+            parent_mask = masks.get(id(el.parent), 0)
+            name = el.name
+            classes = el.get("class") or ()
+            el_id = el.get("id")
+            own = 0
+
+            if name == "body" and not self.body_found:
+                self.body_found = True
+                own |= _BIT_BODY
+            for k in content_ks:
+                if not self.content_found[k] and _matches_compound(_CONTENT_SPECS[k], name, classes, el_id):
+                    self.content_found[k] = True
+                    own |= _BIT_CONTENT << k
+            for k in pagination_ks:
+                spec, is_ancestor = _PAGINATION_SPECS[k]
+                if _matches_compound(spec, name, classes, el_id):
+                    if is_ancestor:
+                        own |= _BIT_PAGINATION << k
+                    else:
+                        self.pagination_links[k].append(el)
+            for k in nav_ks:
+                if _matches_compound(_NEXT_NAV_SPECS[k], name, classes, el_id):
+                    own |= _BIT_NEXT_NAV << k
+                if "nav-next" in classes and parent_mask & (_BIT_NEXT_NAV << k):
+                    own |= _BIT_NEXT_NAV_INNER << k
+
+            if name == "img":
+                self.imgs.append((el, parent_mask))
+            elif name == "a":
+                for k in pagination_ks:
+                    if _PAGINATION_SPECS[k][1] and parent_mask & (_BIT_PAGINATION << k):
+                        self.pagination_links[k].append(el)
+                for k in nav_ks:
+                    if self.next_nav_links[k] is None and parent_mask & (_BIT_NEXT_NAV_INNER << k):
+                        self.next_nav_links[k] = el
+                self.anchors.append(el)
+            elif name == "div" and self.next_div is None and "page-text-body" in classes:
+                text = el.string
+                if text and "次の話" in text:
+                    self.next_div = el
+                    # find_next("a") 相当: この div 以降に最初に現れる a
+                    self.next_div_following_a = len(self.anchors)
+            if self.rel_next is None and name in ("a", "link") and " ".join(el.get("rel") or ()) == "next":
+                self.rel_next = el
+
+            masks[id(el)] = parent_mask | own
+
+    def content_mask(self) -> tuple[int, int | None]:
+        """(本文エリアのビット, 採用したセレクタの番号)。見つからなければ body / 文書全体"""
+        for k, found in enumerate(self.content_found):
+            if found:
+                return _BIT_CONTENT << k, k
+        return (_BIT_BODY if self.body_found else 0), None
+
+
+def _pagination_urls_from_scan(url: str, scan: _PageScan, debug: bool = False) -> list[str]:
+    return _pagination_from_scan(url, scan, debug)[0]
+
+
+def _pagination_from_scan(
+    url: str, scan: _PageScan, debug: bool = False, only: str | None = None
+) -> tuple[list[str], str | None]:
+    """(ページのURL一覧, 見つけた方法)。only を渡すとその方法だけを試す。2ページ目以降が無ければ方法は None"""
+    urls = [url]
+
+    pagination_links: list[Tag] = []
+    strategy = None
+    for selector, links in zip(PAGINATION_SELECTORS, scan.pagination_links):
+        if links and only in (None, f"selector:{selector}"):
+            pagination_links.extend(links)
+            strategy = f"selector:{selector}"
+            if debug:
+                _emit(f"ページネーション検出: {selector} ({len(links)}件)")
+            break
+
+    if not pagination_links and only in (None, "rel_next"):
+        # rel=next（同一記事の次ページを指すことが多い）
+        rel_next = scan.rel_next
+        if rel_next is not None and rel_next.get("href"):
+            pagination_links.append(rel_next)
+            strategy = "rel_next"
+            if debug:
+                _emit(f"rel=next をページネーション候補として追加: {urljoin(url, rel_next.get('href'))}")
+
+    if not pagination_links and only in (None, "numeric"):
+        base_path = urlparse(url).path.rstrip("/")
+        for link in scan.anchors:
+            text = link.get_text(strip=True)
+            href = link.get("href", "")
+            if not href:
+                continue
+            if text.isdigit():
+                full_href = urljoin(url, href)
+                href_path = urlparse(full_href).path.rstrip("/")
+                if href_path.startswith(base_path):
+                    pagination_links.append(link)
+                    strategy = "numeric"
+                    if debug:
+                        _emit(f"数字リンク検出: {text} -> {full_href}")
+
+    if not pagination_links and only in (None, "text"):
+        # 「次のページ」等のテキストリンク（数字リンクが無いサイト向け）
+        for link in scan.anchors:
+            text = link.get_text(" ", strip=True)
+            href = link.get("href", "")
+            if not href or not text:
+                continue
+            if any(k in text for k in ["次のページ", "次ページ", "next page", "Next Page"]):
+                full_href = urljoin(url, href)
+                if urlparse(full_href).netloc == urlparse(url).netloc:
+                    pagination_links.append(link)
+                    strategy = "text"
+                    if debug:
+                        _emit(f"次ページテキストリンク検出: {text} -> {full_href}")
+                break
+
+    base_path = urlparse(url).path.rstrip("/")
+    seen = {url}
+    for link in pagination_links:
+        href = link.get("href")
+        if not href:
+            continue
+        full_url = urljoin(url, href)
+        if urlparse(full_url).netloc != urlparse(url).netloc:
+            continue
+        if full_url in seen:
+            continue
+        # 同一記事のページネーションだけに限定（次話/次記事ナビが混ざるのを防ぐ）
+        full_path = urlparse(full_url).path.rstrip("/")
+        if full_path != base_path and not _looks_like_intra_post_pagination(url, full_url):
+            continue
+
+        text = link.get_text(strip=True).lower()
+        if text in ["next", "prev", "previous", "»", "«", "›", "‹", "次へ", "前へ"]:
+            continue
+        urls.append(full_url)
+        seen.add(full_url)
+
+    def extract_page_num(u: str) -> int:
+        path = urlparse(u).path.rstrip("/")
+        if path == base_path:
+            return 1
+        if path.startswith(base_path + "/"):
+            suffix = path[len(base_path) + 1 :]
+            if suffix.isdigit():
+                return int(suffix)
+        return 999
+
+    urls.sort(key=extract_page_num)
+
+    if debug and len(urls) > 1:
+        _emit(f"検出されたページ: {len(urls)}ページ")
+        for u in urls:
+            _emit(f"  - {u}")
+
+    return urls, (strategy if len(urls) > 1 else None)
+
+
+def get_pagination_urls(url: str, soup: BeautifulSoup, debug: bool = False) -> list[str]:
+    """ページネーションのURLを取得（同一記事内の /2 /3... を想定）"""
+    return _pagination_urls_from_scan(url, _PageScan(soup), debug)
+
+
+# 画像URLを持つ属性（上から優先）。遅延読み込みのサイトでは src がダミー（data: URI）で、本物は data-* 側にある
+IMG_SRC_ATTRS = [
+    "src",
+    "data-src",
+    "data-lazy-src",
+    "data-original",
+    "data-full-url",
+    "data-lazy",
+    "data-image",
+    "data-srcset",
+    "data-lazy-srcset",
+    "srcset",
+]
+
+
+# srcset 系の属性（候補をすべて比べて1つ選ぶ）
+SRCSET_ATTRS = ("data-srcset", "data-lazy-srcset", "srcset")
+# srcset から選ぶときの目標の幅（px）。これ以上の候補のうち最小のものを使う（None なら MIN_IMAGE_SIDE）
+SRCSET_TARGET_WIDTH = 1000
+# WordPress が生成する縮小版のファイル名（image-300x450.jpg）
+_WP_SIZE_SUFFIX = re.compile(r"-(\d+)x(\d+)\.[A-Za-z0-9]+$")
+
+
+def _parse_srcset(value: str) -> list[tuple[str, int | None, float | None]]:
+    """srcset を (URL, 幅の記述子, 密度の記述子) のリストにする（HTML の分割規則どおり、URL 中のカンマも扱う）"""
+    candidates = []
+    pos, n = 0, len(value)
+    while pos < n:
+        while pos < n and (value[pos].isspace() or value[pos] == ","):
+            pos += 1
+        start = pos
+        while pos < n and not value[pos].isspace():
+            pos += 1
+        url = value[start:pos]
+        descriptors = ""
+        if url.endswith(","):
+            url = url.rstrip(",")
+        else:
+            # 記述子は次のカンマまで（括弧内のカンマは区切りではない）
+            start, depth = pos, 0
+            while pos < n and (value[pos] != "," or depth):
+                if value[pos] == "(":
+                    depth += 1
+                elif value[pos] == ")":
+                    depth = max(0, depth - 1)
+                pos += 1
+            descriptors = value[start:pos]
+        width = density = None
+        for token in descriptors.split():
+            try:
+                if token.endswith("w"):
+                    width = int(token[:-1])
+                elif token.endswith("x"):
+                    density = float(token[:-1])
+            except ValueError:
+                continue
+        if url:
+            candidates.append((url, width, density))
+    return candidates
+
+
+def _filename_width(url: str) -> int | None:
+    """WordPress の縮小版ファイル名（-300x450.jpg）から幅を読む"""
+    m = _WP_SIZE_SUFFIX.search(urlparse(url).path)
+    return int(m.group(1)) if m else None
+
+
+def _choose_src_candidate(candidates: list[tuple[str, str, int | None]], target_width: int | None) -> tuple[str, str, int | None]:
+    """(URL, 属性, 幅) の候補から、目標の幅以上で最小のものを選ぶ
+
+    該当が無ければ幅の分からない候補（縮小されていない元画像のことが多い）、それも無ければ最大のもの。
+    """
+    target = max(MIN_IMAGE_SIDE, target_width or 0)
+    sized = [c for c in candidates if c[2]]
+    enough = [c for c in sized if c[2] >= target]
+    if enough:
+        return min(enough, key=lambda c: c[2])
+    unsized = [c for c in candidates if not c[2]]
+    if unsized:
+        return unsized[0]
+    return max(sized, key=lambda c: c[2])
+
+
+def _img_src(
+    img: Tag, preferred: str | None = None, target_width: int | None = SRCSET_TARGET_WIDTH
+) -> tuple[str | None, str | None]:
+    """(画像のURL, 取り出した属性)
+
+    src 系の属性（preferred を先に見る）の最初の1つと srcset 系の全候補を比べ、
+    目標の幅を満たす最小の候補を選ぶ（_choose_src_candidate）。data: URI は他に候補が無いときだけ返す。
+    """
+    try:
+        display_width = int(img.get("width") or 0)
+    except ValueError:
+        display_width = 0
+    base = None
+    srcset_candidates = []
+    placeholder = None
+    attrs = ([preferred] if preferred and preferred not in SRCSET_ATTRS else []) + IMG_SRC_ATTRS
+    for attr in attrs:
+        value = (img.get(attr) or "").strip()
+        if not value:
+            continue
+        if attr in SRCSET_ATTRS:
+            for url, width, density in _parse_srcset(value):
+                if url.startswith("data:"):
+                    placeholder = placeholder or (url, attr)
+                    continue
+                if not width and density and display_width:
+                    width = int(density * display_width)
+                srcset_candidates.append((url, attr, width or _filename_width(url)))
+        elif value.startswith("data:"):
+            placeholder = placeholder or (value, attr)
+        elif base is None:
+            base = (value, attr, _filename_width(value))
+    candidates = ([base] if base else []) + srcset_candidates
+    if not candidates:
+        return placeholder or (None, None)
+    url, attr, _ = _choose_src_candidate(candidates, target_width)
+    return url, attr
+
+
+def _images_from_scan(
+    url: str,
+    scan: _PageScan,
+    debug: bool = False,
+    src_attr: str | None = None,
+    attr_counts: dict[str, int] | None = None,
+    srcset_width: int | None = SRCSET_TARGET_WIDTH,
+) -> list[dict]:
+    """本文エリアの画像。src_attr を先に見る。attr_counts を渡すと、採用した画像のURLを取った属性ごとの件数を数える
+
+    srcset_width は srcset から選ぶときの目標の幅（_img_src の target_width）。
+    """
+    images: list[dict] = []
+
+    area_mask, selector_idx = scan.content_mask()
+    if debug:
+        if selector_idx is not None:
+            _emit(f"コンテンツエリア検出: {CONTENT_SELECTORS[selector_idx]}")
+        else:
+            _emit("コンテンツエリア: body全体")
+
+    img_tags = [img for img, mask in scan.imgs if not area_mask or mask & area_mask]
+    if debug:
+        _emit(f"検出されたimgタグ数: {len(img_tags)}")
+
+    for img in img_tags:
+        src, attr = _img_src(img, src_attr, srcset_width)
+        if not src:
+            if debug:
+                _emit(f"⚠️ src無し: {str(img)[:100]}...")
+            continue
+        if src.startswith("data:"):
+            if debug:
+                _emit("⚠️ data URI スキップ")
+            continue
+
+        img_url = urljoin(url, src)
+        lowered = img_url.lower()
+        if any(p in lowered for p in SKIP_PATTERNS):
+            if debug:
+                _emit(f"⚠️ スキップパターン: {img_url[:80]}...")
+            continue
+
+        has_img_ext = any(ext in lowered for ext in IMG_EXTENSIONS)
+        has_img_path = any(p in lowered for p in IMG_PATH_PATTERNS)
+        has_size_param = any(x in lowered for x in SIZE_PARAM_PATTERNS)
+
+        if has_img_ext or has_img_path or has_size_param:
+            images.append({"url": img_url, "alt": img.get("alt", "")})
+            if attr_counts is not None:
+                attr_counts[attr] = attr_counts.get(attr, 0) + 1
+            if debug:
+                _emit(f"✅ 画像追加: {img_url[:80]}...")
+        else:
+            if debug:
+                _emit(f"❌ 条件不一致でスキップ: {img_url[:80]}...")
+
+    # 重複除去
+    seen_urls: set[str] = set()
+    unique_images: list[dict] = []
+    for item in images:
+        u = item.get("url", "")
+        if not u or u in seen_urls:
+            continue
+        seen_urls.add(u)
+        unique_images.append(item)
+
+    return unique_images
+
+
+def _fetch_html(
+    url: str, debug: bool = False, session: requests.Session | None = None, quiet: bool = False
+) -> bytes | None:
+    """HTML を取得する。quiet なら取得の失敗をエラーとして通知しない（先読みなど、失敗してもよい取得用）"""
+    response = _fetch_html_response(url, debug, session=session, quiet=quiet)
+    return response.content if response is not None else None
+
+
+def _fetch_html_response(
+    url: str,
+    debug: bool = False,
+    session: requests.Session | None = None,
+    quiet: bool = False,
+    conditional: dict | None = None,
+) -> requests.Response | None:
+    """_fetch_html と同じだがレスポンスを返す。conditional（If-None-Match など）を付けると 304 も返りうる"""
+    headers = get_request_headers(url)
+    if conditional:
+        headers.update(conditional)
+
+    with _timed("html_fetch", host=urlparse(url).netloc) as rec:
+        try:
+            response = _http_get(url, headers, session=session)
+            rec.update(status=response.status_code, bytes=len(response.content), retries=_retry_count(response))
+            response.raise_for_status()
+        except requests.RequestException as e:
+            rec.setdefault("status", "error")
+            _emit(f"ページの取得に失敗しました: {e}", level="debug" if quiet else "error")
+            return None
+
+    if debug and response.status_code != 304:
+        _emit(f"HTMLサイズ: {len(response.content)} bytes")
+    return response
+
+
+def get_page_images(
+    url: str,
+    debug: bool = False,
+    session: requests.Session | None = None,
+) -> tuple[list[dict], BeautifulSoup | None]:
+    """ページから画像URLを抽出"""
+    html = _fetch_html(url, debug, session=session)
+    if html is None:
+        return [], None
+    with _timed("parse"):
+        soup = _make_soup(html)
+    with _timed("selector_match"):
+        return _images_from_scan(url, _PageScan(soup), debug), soup
+
+
+@dataclass
+class PageExtract:
+    """1ページ分の抽出結果（BeautifulSoup のツリーは保持しない）"""
+
+    url: str
+    images: list[dict]
+    pagination_urls: list[str] = field(default_factory=list)
+    next_episode_url: str | None = None
+    episode_links: dict[int, str] = field(default_factory=dict)  # find_episode_links のときだけ: 話数 -> URL
+    series_urls: list[str] = field(default_factory=list)  # find_episode_links のときだけ: カテゴリ・タグ一覧のURL
+
+
+def extract_page(
+    url: str,
+    debug: bool = False,
+    session: requests.Session | None = None,
+    find_pagination: bool = True,
+    parser: str | None = None,
+    site_profiles: "SiteProfileCache | None" = None,
+    find_episode_links: bool = False,
+    quiet: bool = False,
+    page_cache: "PageCache | None" = None,
+    srcset_width: int | None = SRCSET_TARGET_WIDTH,
+) -> PageExtract | None:
+    """ページを取得し、画像・ページネーション・「次の話」を1回の走査でまとめて抽出する
+
+    site_profiles を渡すと、そのドメインで前に当たった方法だけをまず試し、見つからなければ全候補で判定し直す。
+    find_episode_links なら、話の一覧（「第N話」のリンク）とカテゴリ・タグ一覧へのリンクも集める。
+    page_cache を渡すと、前回の抽出結果を条件付きリクエストで再検証し、304 ならパースせずにそれを返す。
+    srcset_width は srcset から画像を選ぶときの目標の幅（SRCSET_TARGET_WIDTH）。
+    """
+    entry = page_cache.lookup(url, find_pagination, find_episode_links, srcset_width) if page_cache is not None else None
+    response = _fetch_html_response(
+        url, debug, session=session, quiet=quiet, conditional=ImageDiskCache.conditional_headers(entry) if entry else None
+    )
+    if response is None:
+        return None
+    if entry is not None and response.status_code == 304:
+        if debug:
+            _emit(f"📦 ページキャッシュを使用（304）: {url}")
+        return page_cache.read_hit(entry)
+    with _timed("parse"):
+        soup = _make_soup(response.content, parser)
+    profile = site_profiles.lookup(url) if site_profiles is not None else None
+    page, found = _extract_from_soup(url, soup, debug, find_pagination, profile, srcset_width)
+    hit = profile is not None and _site_profile_matches(profile, found, find_pagination)
+    if profile is not None and not hit:
+        if debug:
+            _emit("🧭 サイトプロファイルの方法では見つからなかったため、全候補で判定し直します")
+        page, found = _extract_from_soup(url, soup, debug, find_pagination, srcset_width=srcset_width)
+    if site_profiles is not None:
+        site_profiles.record(url, found, hit=hit if profile is not None else None)
+    if find_episode_links:
+        with _timed("selector_match"):
+            page.episode_links, page.series_urls = _episode_links_from_soup(url, soup)
+    if page_cache is not None:
+        page_cache.store(page, response.headers, len(response.content), find_pagination, find_episode_links, srcset_width)
+    return page
+
+
+def _extract_from_soup(
+    url: str,
+    soup: BeautifulSoup,
+    debug: bool,
+    find_pagination: bool,
+    profile: dict | None = None,
+    srcset_width: int | None = SRCSET_TARGET_WIDTH,
+) -> tuple[PageExtract, dict]:
+    """(抽出結果, 当たった方法)。profile があればそこに記録された方法だけを試す"""
+    profile = profile or {}
+    attr_counts: dict[str, int] = {}
+    with _timed("selector_match"):
+        scan = _PageScan(soup, profile)
+        images = _images_from_scan(url, scan, debug, profile.get("src_attr"), attr_counts, srcset_width)
+        next_episode_url, next_strategy = _next_episode_from_scan(scan, url, debug, profile.get("next_episode"))
+    pagination_urls, pagination_strategy = [url], None
+    if find_pagination:
+        with _timed("pagination"):
+            pagination_urls, pagination_strategy = _pagination_from_scan(url, scan, debug, profile.get("pagination"))
+    _, content_idx = scan.content_mask()
+    found = {
+        "content": CONTENT_SELECTORS[content_idx] if content_idx is not None else None,
+        "pagination": pagination_strategy,
+        "next_episode": next_strategy,
+        "src_attr": max(attr_counts, key=attr_counts.get) if attr_counts else None,
+    }
+    page = PageExtract(
+        url=url,
+        images=images,
+        pagination_urls=pagination_urls,
+        next_episode_url=next_episode_url,
+    )
+    return page, found
+
+
+# 話の一覧・カテゴリページで「第N話」のリンクを拾う
+_EPISODE_TITLE_PATTERN = re.compile(r"第\s*(\d+)\s*話")
+
+
+def _episode_links_from_soup(url: str, soup: BeautifulSoup) -> tuple[dict[int, str], list[str]]:
+    """(話数 -> URL, カテゴリ・タグ一覧のURL)。同じドメインのリンクだけを見る"""
+    netloc = urlparse(url).netloc
+    episode_links: dict[int, str] = {}
+    series_urls: list[str] = []
+    for a in soup.find_all("a", href=True):
+        href = urljoin(url, a["href"])
+        if urlparse(href).netloc != netloc or _looks_like_intra_post_pagination(url, href):
+            continue
+        rel = a.get("rel") or ()
+        if ("category" in rel or "tag" in rel) and href not in series_urls:
+            series_urls.append(href)
+            continue
+        numbers = _EPISODE_TITLE_PATTERN.findall(a.get_text(" ", strip=True))
+        # 「第1話〜第3話」のような複数話をまとめたリンクは使わない
+        if len(numbers) == 1:
+            episode_links.setdefault(int(numbers[0]), href)
+    return episode_links, series_urls
+
+
+def _site_profile_matches(profile: dict, found: dict, find_pagination: bool) -> bool:
+    """プロファイルの方法で本文・ページ送り・次話がすべて見つかったか（画像URLの属性は画像ごとに他の属性へ戻るので見ない）"""
+    keys = ["content", "next_episode"] + (["pagination"] if find_pagination else [])
+    return all(not profile.get(key) or found[key] == profile[key] for key in keys)
+
+
+# サイトプロファイルの保存先。環境変数 MANGA_SITE_PROFILES_PATH で変更できる
+SITE_PROFILE_KEYS = ("content", "pagination", "next_episode", "src_attr")
+SITE_PROFILE_SAVE_INTERVAL = 5.0
+
+
+def _get_site_profiles_path() -> str:
+    return os.environ.get("MANGA_SITE_PROFILES_PATH") or os.path.join(_get_output_base_dir(), ".cache", "site_profiles.json")
+
+
+@contextmanager
+def _file_lock(path: str):
+    """path をロックファイルにしてプロセス間で排他する（fcntl の無い環境では何もしない）"""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class SiteProfileCache:
+    """ドメイン（netloc）ごとに、当たった本文セレクタ・ページ送りと次話の見つけ方・画像URLの属性を覚える JSON ファイル
+
+    extract_page はまず記録された方法だけを試し、見つからなければ全候補で判定し直して記録を更新する。
+    hits / misses はプロファイルの方法で済んだページ数・判定し直したページ数。
+    CLI では複数のプロセスが同じファイルに保存するので、保存のたびにファイルを読み直し、
+    前回の保存以降にこのプロセスで変わった分（_pending）だけを重ねる。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.profiles: dict[str, dict] = self._read()
+        # netloc → 前回の保存以降に変わった項目と、hits / misses の増分
+        self._pending: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+
+    def _read(self) -> dict[str, dict]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def lookup(self, url: str) -> dict | None:
+        with self._lock:
+            profile = self.profiles.get(urlparse(url).netloc)
+            return dict(profile) if profile else None
+
+    def record(self, url: str, found: dict, hit: bool | None = None) -> None:
+        """1ページ分の結果を記録（見つからなかった項目は前の記録を残す）。hit はプロファイルを使った場合だけ渡す"""
+        netloc = urlparse(url).netloc
+        if not netloc:
+            return
+        with self._lock:
+            profile = self.profiles.setdefault(netloc, {"hits": 0, "misses": 0})
+            pending = self._pending.setdefault(netloc, {"hits": 0, "misses": 0})
+            changed = False
+            for key in SITE_PROFILE_KEYS:
+                if found.get(key) and profile.get(key) != found[key]:
+                    profile[key] = pending[key] = found[key]
+                    changed = True
+            if hit is not None:
+                key = "hits" if hit else "misses"
+                profile[key] += 1
+                pending[key] += 1
+            if changed:
+                profile["updated_at"] = pending["updated_at"] = datetime.now().isoformat(timespec="seconds")
+        self.save(force=changed)
+
+    def save(self, force: bool = False) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if not self._pending or (not force and now - self._last_save < SITE_PROFILE_SAVE_INTERVAL):
+                return
+            self._last_save = now
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with _file_lock(f"{self.path}.lock"):
+                # 他のプロセスが保存した分を読み直し、このプロセスの変更を重ねる
+                profiles = self._read()
+                for netloc, pending in self._pending.items():
+                    profile = profiles.setdefault(netloc, {"hits": 0, "misses": 0})
+                    for key, value in pending.items():
+                        profile[key] = profile.get(key, 0) + value if key in ("hits", "misses") else value
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(profiles, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, self.path)
+            self.profiles = profiles
+            self._pending = {}
+
+
+@functools.lru_cache(maxsize=None)
+def _get_site_profiles() -> SiteProfileCache:
+    return SiteProfileCache(_get_site_profiles_path())
+
+
+# 記事ページの抽出結果キャッシュ（保存先は環境変数 MANGA_PAGE_CACHE_DIR で変更できる）
+PAGE_CACHE_MAX_MB = 64
+# 抽出処理を変えて結果が変わるときに上げる（古い形式のエントリは使わない）
+PAGE_CACHE_VERSION = 1
+# キャッシュの SQLite を別プロセス（CLI のジョブ）が書き込み中のとき、待つ最長時間（秒）
+CACHE_DB_TIMEOUT = 30.0
+
+
+def _get_page_cache_dir() -> str:
+    return os.environ.get("MANGA_PAGE_CACHE_DIR") or os.path.join(_get_output_base_dir(), ".cache", "pages")
+
+
+class PageCache:
+    """URL → 記事ページの抽出結果（画像候補・ページ送り・次話・話の一覧）の SQLite キャッシュ
+
+    ETag / Last-Modified と一緒に保存し、次回は条件付きリクエストで再検証する（304 ならパースしない）。
+    検証用ヘッダの無いページは保存しない。抽出結果の合計サイズが max_bytes を超えたら、
+    最終アクセスが古いものから削除する（LRU）。同じファイルを複数のプロセスが使うので、合計は毎回 SQLite から数える。stats は hits（304）・misses（保存）・bytes_saved（受信しなかった HTML）・evictions。
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self.stats = DownloadStats()
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(root, "index.sqlite"), timeout=CACHE_DB_TIMEOUT, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                payload TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                html_size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pages_last_access ON pages (last_access)")
+        self._conn.commit()
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._total_locked()
+
+    def _total_locked(self) -> int:
+        return int(self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0])
+
+    @property
+    def entries(self) -> int:
+        with self._lock:
+            return int(self._conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0])
+
+    def lookup(
+        self,
+        url: str,
+        find_pagination: bool = True,
+        find_episode_links: bool = False,
+        srcset_width: int | None = SRCSET_TARGET_WIDTH,
+    ) -> dict | None:
+        """再検証に使えるエントリ。求める項目（ページ送り・話の一覧）を抽出していないもの、
+        srcset の目標の幅が違うもの（選ぶ画像URLが変わる）は使わない"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified, payload, html_size FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+        if not row:
+            return None
+        etag, last_modified, payload, html_size = row
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return None
+        if data.get("version") != PAGE_CACHE_VERSION or data.get("srcset_width") != srcset_width:
+            return None
+        if (find_pagination and data.get("pagination_urls") is None) or (
+            find_episode_links and data.get("episode_links") is None
+        ):
+            return None
+        return {"url": url, "etag": etag, "last_modified": last_modified, "data": data, "html_size": html_size}
+
+    def read_hit(self, entry: dict) -> PageExtract:
+        """304 を受けたときに保存しておいた抽出結果を返す"""
+        data = entry["data"]
+        with self._lock:
+            self._conn.execute("UPDATE pages SET last_access = ? WHERE url = ?", (time.time(), entry["url"]))
+            self._conn.commit()
+        self.stats.add("hits")
+        self.stats.add("bytes_saved", entry["html_size"])
+        return PageExtract(
+            url=entry["url"],
+            images=[dict(img) for img in data["images"]],
+            pagination_urls=list(data.get("pagination_urls") or [entry["url"]]),
+            next_episode_url=data.get("next_episode_url"),
+            episode_links={int(n): u for n, u in (data.get("episode_links") or {}).items()},
+            series_urls=list(data.get("series_urls") or []),
+        )
+
+    def store(
+        self,
+        page: PageExtract,
+        headers,
+        html_size: int,
+        find_pagination: bool,
+        find_episode_links: bool,
+        srcset_width: int | None = SRCSET_TARGET_WIDTH,
+    ) -> None:
+        """200 で取得・抽出した結果を保存する（抽出しなかった項目は None として残す）"""
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        if not (etag or last_modified):
+            return
+        payload = json.dumps(
+            {
+                "version": PAGE_CACHE_VERSION,
+                "images": [{"url": img["url"], "alt": img.get("alt", "")} for img in page.images],
+                "pagination_urls": page.pagination_urls if find_pagination else None,
+                "next_episode_url": page.next_episode_url,
+                "episode_links": page.episode_links if find_episode_links else None,
+                "series_urls": page.series_urls if find_episode_links else None,
+                "srcset_width": srcset_width,
+            },
+            ensure_ascii=False,
+        )
+        size = len(payload.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages (url, etag, last_modified, payload, size, html_size, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (page.url, etag, last_modified, payload, size, html_size, time.time()),
+            )
+            evicted = self._evict_locked()
+            self._conn.commit()
+        self.stats.add("misses")
+        if evicted:
+            self.stats.add("evictions", evicted)
+
+    def _evict_locked(self) -> int:
+        # 書き込み中のトランザクション内で数えるので、他のプロセスの分も含めた合計になる
+        total = self._total_locked()
+        if total <= self.max_bytes:
+            return 0
+        evicted = 0
+        for url, size in self._conn.execute("SELECT url, size FROM pages ORDER BY last_access ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+            total -= size
+            evicted += 1
+        return evicted
+
+
+@functools.lru_cache(maxsize=None)
+def _get_page_cache(max_mb: int = PAGE_CACHE_MAX_MB) -> PageCache:
+    return PageCache(_get_page_cache_dir(), max_bytes=int(max_mb) * 1024 * 1024)
+
+
+def _looks_like_intra_post_pagination(current_url: str, candidate_url: str) -> bool:
+    """同一記事内ページネーション（/2 /3 ...）っぽいURLかどうか。
+
+    例:
+    - current: https://aikatu.jp/archives/1031854
+      cand:    https://aikatu.jp/archives/1031854/2
+    - current: https://w.grapps.me/original/624941/
+      cand:    https://w.grapps.me/original/624941/2/
+    """
+    try:
+        cu = urlparse(current_url)
+        nu = urlparse(candidate_url)
+        if cu.netloc != nu.netloc:
+            return False
+        base = cu.path.rstrip("/")
+        cand = nu.path.rstrip("/")
+        if not cand.startswith(base + "/"):
+            return False
+        suffix = cand[len(base) + 1 :]
+        return suffix.isdigit()
+    except Exception:
+        return False
+
+
+def _next_episode_url_from_scan(scan: _PageScan, base_url: str, debug: bool = False) -> str | None:
+    return _next_episode_from_scan(scan, base_url, debug)[0]
+
+
+def _next_episode_from_scan(
+    scan: _PageScan, base_url: str, debug: bool = False, only: str | None = None
+) -> tuple[str | None, str | None]:
+    """(「次の話」のURL, 見つけた方法)。only を渡すとその方法だけを試す"""
+    # 1) 旧ロジック（特定サイト向け）
+    next_episode_div = scan.next_div
+    if next_episode_div is not None and only in (None, "div"):
+        parent = next_episode_div.find_parent("a")
+        if parent and parent.get("href"):
+            next_url = urljoin(base_url, parent["href"])
+            # /2など同一記事内ページネーションは「次話」ではない
+            if not _looks_like_intra_post_pagination(base_url, next_url):
+                if debug:
+                    _emit(f"🔗 次の話を検出(div): {next_url}")
+                return next_url, "div"
+        if scan.next_div_following_a < len(scan.anchors):
+            next_link = scan.anchors[scan.next_div_following_a]
+            if next_link.get("href"):
+                next_url = urljoin(base_url, next_link["href"])
+                if not _looks_like_intra_post_pagination(base_url, next_url):
+                    if debug:
+                        _emit(f"🔗 次の話を検出(div-next): {next_url}")
+                    return next_url, "div"
+
+    # 2) WordPress系の「次の記事」ナビ（nav-next）
+    for selector, a in zip(NEXT_EPISODE_NAV_SELECTORS, scan.next_nav_links):
+        if only not in (None, f"nav:{selector}"):
+            continue
+        if a is not None and a.get("href"):
+            next_url = urljoin(base_url, a["href"])
+            if _looks_like_intra_post_pagination(base_url, next_url):
+                continue
+            if debug:
+                _emit(f"🔗 次の話を検出(nav-next): {next_url}")
+            return next_url, f"nav:{selector}"
+
+    # 3) テキストで「次の話」を優先して探す（「次のページ」より優先）
+    keywords_strong = ["次の話", "次の話＞＞", "次の話>>", "次話", "次のエピソード"]
+    for a in scan.anchors if only in (None, "text") else ():
+        tx = a.get_text(" ", strip=True)
+        href = a.get("href")
+        if not tx or not href:
+            continue
+        if any(k in tx for k in keywords_strong):
+            next_url = urljoin(base_url, href)
+            if _looks_like_intra_post_pagination(base_url, next_url):
+                continue
+            if debug:
+                _emit(f"🔗 次の話を検出(text): {tx[:40]} -> {next_url}")
+            return next_url, "text"
+
+    if debug:
+        _emit("ℹ️ 「次の話」リンクは見つかりませんでした")
+    return None, None
+
+
+def get_next_episode_url(soup: BeautifulSoup, base_url: str, debug: bool = False) -> str | None:
+    """「次の話>>」のURLを取得（特定サイト向けの緩い実装）"""
+    return _next_episode_url_from_scan(_PageScan(soup), base_url, debug)
+
+
+# 同一話内ページ（/2 /3 ...）を同時に取得する数
+PAGE_FETCH_WORKERS = 6
+
+
+def get_episode_images(
+    url: str,
+    episode_num: int = 1,
+    debug: bool = False,
+    max_page_workers: int = PAGE_FETCH_WORKERS,
+    on_images=None,
+    should_stop=None,
+    site_profiles: SiteProfileCache | None = None,
+    prefetched: list[PageExtract | None] | None = None,
+    page_cache: PageCache | None = None,
+    srcset_width: int | None = SRCSET_TARGET_WIDTH,
+) -> tuple[list[dict], str | None]:
+    """1話分の画像を取得（ページネーション込み）
+
+    2ページ目以降は並列に取得するが、結果はページ順に処理するので
+    画像の並び・重複除去・「次の話」リンクの採用順は逐次取得の場合と同じになる。
+    on_images を渡すと、ページごとに新しく見つかった画像リストをページ順に通知する。
+    should_stop() が True を返したら残りのページは処理せずに打ち切る。
+    prefetched（先読み済みのページ。1ページ目から順）があればそれを使い、無いページ・取れなかったページだけを取得する。
+    page_cache を渡すと、前回から変わっていないページはキャッシュした抽出結果を使う（extract_page）。
+    srcset_width は extract_page と同じ（srcset から選ぶときの目標の幅）。
+    """
+    prefetched = prefetched or [None]
+    first_page = prefetched[0] or extract_page(
+        url, debug, site_profiles=site_profiles, page_cache=page_cache, srcset_width=srcset_width
+    )
+    if first_page is None:
+        return [], None
+
+    next_episode_url = first_page.next_episode_url
+    page_urls = first_page.pagination_urls
+
+    all_images: list[dict] = []
+    seen_urls: set[str] = set()
+
+    if debug:
+        _emit(f"📖 第{episode_num}話の取得開始")
+
+    for img in first_page.images:
+        if img["url"] in seen_urls:
+            continue
+        img["page"] = 1
+        img["page_url"] = url
+        img["episode"] = episode_num
+        all_images.append(img)
+        seen_urls.add(img["url"])
+    if on_images:
+        on_images(list(all_images))
+
+    if len(page_urls) > 1:
+        rest_urls = page_urls[1:]
+        ready = {u: page for u, page in zip(rest_urls, prefetched[1:]) if page is not None}
+        if debug:
+            _emit(f"  ページ 2〜{len(page_urls)} を並列取得中（{len(rest_urls)}件、うち先読み済み{len(ready)}件）")
+        with _thread_pool(max(1, min(max_page_workers, len(rest_urls)))) as executor:
+            # map は投入順に結果を返す
+            page_results = executor.map(
+                lambda u: ready.get(u)
+                or extract_page(
+                    u,
+                    debug,
+                    find_pagination=False,
+                    site_profiles=site_profiles,
+                    page_cache=page_cache,
+                    srcset_width=srcset_width,
+                ),
+                rest_urls,
+            )
+            for i, (page_url, page) in enumerate(zip(rest_urls, page_results), start=2):
+                if should_stop and should_stop():
+                    if debug:
+                        _emit(f"  ⏹️ 画像が上限に達したため、ページ {i} 以降は取得しません")
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    break
+                page_images = page.images if page else []
+                if debug:
+                    _emit(f"  ページ {i}: {page_url}（{len(page_images)}件）")
+                new_images: list[dict] = []
+                for img in page_images:
+                    if img["url"] in seen_urls:
+                        continue
+                    img["page"] = i
+                    img["page_url"] = page_url
+                    img["episode"] = episode_num
+                    new_images.append(img)
+                    seen_urls.add(img["url"])
+                all_images.extend(new_images)
+                if on_images:
+                    on_images(new_images)
+                if page and not next_episode_url:
+                    next_episode_url = page.next_episode_url
+
+    if debug:
+        _emit(f"📖 第{episode_num}話: {len(all_images)}枚の画像を取得")
+
+    return all_images, next_episode_url
+
+
+# 次の話以降を先読みする数（同時に取得する話数）。0 なら「次の話」リンクを1話ずつ辿る
+EPISODE_PREFETCH_WORKERS = 3
+_NUMERIC_PATH_PATTERN = re.compile(r"^(.*?)(\d+)(/?)$")
+
+
+def _episode_key(url: str) -> str:
+    return url.rstrip("/")
+
+
+def _episodes_from_links(episode_links: dict[int, str], url: str, next_url: str, count: int) -> list[str]:
+    """話の一覧から、url の次の話以降 count 話分のURL（url か next_url が一覧に無ければ空）"""
+    numbers = {_episode_key(u): n for n, u in episode_links.items()}
+    current = numbers.get(_episode_key(url))
+    if current is None and _episode_key(next_url) in numbers:
+        current = numbers[_episode_key(next_url)] - 1
+    if current is None:
+        return []
+    return [episode_links[n] for n in range(current + 1, current + count + 1) if n in episode_links]
+
+
+def _predict_numeric_urls(url: str, next_url: str, count: int) -> list[str]:
+    """URL末尾の番号が url → next_url で1つ増えていれば、同じ並びで next_url から count 話分のURLを予測する
+
+    WordPress の記事ID（/archives/123456）は話ごとに連番とは限らないので、差が1のときだけ使う。
+    """
+    current, following = urlparse(url), urlparse(next_url)
+    if current.netloc != following.netloc or current.query or following.query:
+        return []
+    m1 = _NUMERIC_PATH_PATTERN.match(current.path)
+    m2 = _NUMERIC_PATH_PATTERN.match(following.path)
+    if not m1 or not m2 or m1.group(1) != m2.group(1) or int(m2.group(2)) - int(m1.group(2)) != 1:
+        return []
+    prefix, digits, slash = m2.groups()
+    width = len(digits) if digits.startswith("0") else 0
+    return [
+        following._replace(path=f"{prefix}{str(int(digits) + k).zfill(width)}{slash}").geturl() for k in range(count)
+    ]
+
+
+def discover_episode_urls(
+    first_page: PageExtract, count: int, debug: bool = False, page_cache: PageCache | None = None
+) -> tuple[list[str], str | None]:
+    """(次の話から count 話分の候補URL, 見つけた方法)。「次の話」リンクを1話ずつ辿らずに分かる範囲で探す
+
+    ページ内の話の一覧（"toc"）→ カテゴリ・タグ一覧のページ（"category"）→ URL末尾の連番（"numeric"）の順に試す。
+    候補は先読みにだけ使い、実際に採用するかは巡回中に「次の話」リンクと一致するかで決める。
+    first_page は find_episode_links=True で取得したもの。
+    """
+    url, next_url = first_page.url, first_page.next_episode_url
+    if count <= 0 or not next_url:
+        return [], None
+    candidates = _episodes_from_links(first_page.episode_links, url, next_url, count)
+    if len(candidates) > 1:
+        return candidates, "toc"
+    for series_url in first_page.series_urls[:1]:
+        series_page = extract_page(
+            series_url, find_pagination=False, find_episode_links=True, quiet=True, page_cache=page_cache
+        )
+        if series_page is not None:
+            candidates = _episodes_from_links(series_page.episode_links, url, next_url, count)
+            if len(candidates) > 1:
+                return candidates, "category"
+    candidates = _predict_numeric_urls(url, next_url, count)
+    if len(candidates) > 1:
+        return candidates, "numeric"
+    if debug:
+        _emit("ℹ️ 次の話以降のURLは事前に分からなかったため、「次の話」リンクを1話ずつ辿ります")
+    return [], None
+
+
+def _fetch_episode_pages(
+    url: str,
+    site_profiles: SiteProfileCache | None = None,
+    page_cache: PageCache | None = None,
+    srcset_width: int | None = SRCSET_TARGET_WIDTH,
+) -> list[PageExtract | None]:
+    """1話分のページを1ページ目から順にすべて取得する（先読み用。失敗は通知せず None のまま返す）"""
+    first_page = extract_page(url, site_profiles=site_profiles, quiet=True, page_cache=page_cache, srcset_width=srcset_width)
+    rest_urls = first_page.pagination_urls[1:] if first_page else []
+    if not rest_urls:
+        return [first_page]
+    with _thread_pool(min(PAGE_FETCH_WORKERS, len(rest_urls))) as executor:
+        rest_pages = executor.map(
+            lambda u: extract_page(
+                u,
+                find_pagination=False,
+                site_profiles=site_profiles,
+                quiet=True,
+                page_cache=page_cache,
+                srcset_width=srcset_width,
+            ),
+            rest_urls,
+        )
+        return [first_page, *rest_pages]
+
+
+def get_multiple_episodes_images(
+    url: str,
+    num_episodes: int,
+    debug: bool = False,
+    on_images=None,
+    should_stop=None,
+    completed_episodes: list[dict] | None = None,
+    on_episode=None,
+    site_profiles: SiteProfileCache | None = None,
+    prefetch_episodes: int = EPISODE_PREFETCH_WORKERS,
+    page_cache: PageCache | None = None,
+    srcset_width: int | None = SRCSET_TARGET_WIDTH,
+) -> list[dict]:
+    """複数話の画像を取得（次の話リンクを辿る）
+
+    on_images はページ単位で見つかった画像リストを受け取るコールバック（パイプライン用）。
+    should_stop() が True を返したら、それ以降のページ・話は取得しない。
+    completed_episodes（on_episode に渡した記録のリスト）を渡すと、その話は取得し直さずに続きから巡回する。
+    "known": True の記録（前回までの実行で取得済みの話）は巡回し直さず、記録にある画像（取り直す画像だけが入っている）を返す。
+    site_profiles を渡すと、ドメインごとに覚えた本文セレクタ・ページ送り・次話の見つけ方を先に試す。
+    prefetch_episodes > 0 なら、最初の話で次の話以降のURLが分かれば（discover_episode_urls）その数ずつ並行に先読みする。
+    先読みした話は「次の話」リンクがそのURLを指したときだけ使うので、結果は1話ずつ辿った場合と同じになる。
+    page_cache を渡すと、記事ページの抽出結果を条件付きリクエストで再利用する。
+    srcset_width は srcset から画像を選ぶときの目標の幅（extract_page）。
+    """
+    all_images: list[dict] = []
+    current_url: str | None = url
+    first_episode = 1
+
+    for record in completed_episodes or []:
+        if first_episode > num_episodes:
+            break
+        all_images.extend(record["images"])
+        if on_images and record["images"]:
+            on_images(list(record["images"]))
+        current_url = record.get("next_url")
+        first_episode += 1
+    if debug and first_episode > 1:
+        _emit(f"♻️ 第{first_episode - 1}話までは前回の記録から再開しました")
+
+    prefetch: dict[str, Future] = {}
+    prefetch_used = 0
+    discovered = prefetch_episodes <= 0
+    with _thread_pool(max(1, prefetch_episodes)) as prefetcher:
+        try:
+            for episode in range(first_episode, num_episodes + 1):
+                if not current_url:
+                    if debug:
+                        _emit(f"⚠️ 第{episode}話のURLがありません。取得を終了します。")
+                    break
+                if should_stop and should_stop():
+                    if debug:
+                        _emit(f"⏹️ 画像が上限に達したため、第{episode}話以降は取得しません")
+                    break
+                if debug:
+                    _emit(f"📚 第{episode}話を取得中: {current_url}")
+
+                pages = None
+                future = prefetch.pop(_episode_key(current_url), None)
+                if future is not None:
+                    pages = future.result()
+                    prefetch_used += 1
+                elif prefetch:
+                    # 「次の話」リンクが候補と違うURLを指した: 残りの候補も当てにならない
+                    if debug:
+                        _emit("ℹ️ 「次の話」リンクが先読みの候補と一致しないため、残りの先読みを取り消します")
+                    for pending in prefetch.values():
+                        pending.cancel()
+                    prefetch.clear()
+                elif not discovered and episode < num_episodes:
+                    discovered = True
+                    first_page = extract_page(
+                        current_url,
+                        debug,
+                        site_profiles=site_profiles,
+                        find_episode_links=True,
+                        page_cache=page_cache,
+                        srcset_width=srcset_width,
+                    )
+                    pages = [first_page]
+                    candidates, source = (
+                        discover_episode_urls(first_page, num_episodes - episode, debug, page_cache)
+                        if first_page
+                        else ([], None)
+                    )
+                    if candidates:
+                        if debug:
+                            _emit(f"🔭 第{episode + 1}話以降の候補URLを{len(candidates)}件見つけました（{source}）。先読みします")
+                        for candidate in candidates:
+                            if _episode_key(candidate) not in prefetch:
+                                prefetch[_episode_key(candidate)] = prefetcher.submit(
+                                    _fetch_episode_pages, candidate, site_profiles, page_cache, srcset_width
+                                )
+
+                episode_images, next_url = get_episode_images(
+                    current_url,
+                    episode_num=episode,
+                    debug=debug,
+                    on_images=on_images,
+                    should_stop=should_stop,
+                    site_profiles=site_profiles,
+                    prefetched=pages,
+                    page_cache=page_cache,
+                    srcset_width=srcset_width,
+                )
+                all_images.extend(episode_images)
+                if on_episode:
+                    on_episode(
+                        {
+                            "episode": episode,
+                            "url": current_url,
+                            "next_url": next_url,
+                            "pages": list(dict.fromkeys(img["page_url"] for img in episode_images)),
+                            "images": episode_images,
+                        }
+                    )
+                current_url = next_url
+                if not next_url and episode < num_episodes:
+                    if debug:
+                        _emit(f"ℹ️ 第{episode}話が最終話です。{episode}話分を取得しました。")
+                    break
+        finally:
+            # 使わなかった先読みは、まだ始まっていなければ取り消す
+            for pending in prefetch.values():
+                pending.cancel()
+
+    if debug and prefetch_used:
+        _emit(f"🔭 先読みした話を{prefetch_used}話分使いました")
+    if debug:
+        _emit(f"✅ 合計 {len(all_images)}枚の画像を取得")
+
+    return all_images
+
+
+class DownloadStats:
+    """ダウンロード関連のカウンタ（スレッドセーフ）
+
+    フィルタ（サイズ・縦横・重複）で除いた画像の URL も集める（更新モードで取り直さない画像）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: dict[str, int] = {}
+        self._rejected: set[str] = set()
+
+    def add(self, key: str, value: int = 1) -> None:
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + value
+
+    def as_dict(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+    def reject(self, url: str) -> None:
+        with self._lock:
+            self._rejected.add(url)
+
+    def rejected_urls(self) -> set[str]:
+        with self._lock:
+            return set(self._rejected)
+
+
+# 計測する段階（表示順）と、時間の内訳をまとめる区分
+PROFILE_STAGES = {
+    "html_fetch": "network",
+    "parse": "parse",
+    "selector_match": "parse",
+    "pagination": "parse",
+    "image_download": "network",
+    "validate": "cpu",
+    "transcode": "cpu",
+    "zip": "cpu",
+    "save": "cpu",
+}
+# 処理時間のヒストグラムの区切り（ミリ秒）。最後の区間はそれより長いもの全部
+PROFILE_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class RunProfile:
+    """1回の抽出の段階ごとの計測値（処理時間・バイト数・ステータスコード）とホストごとの集計（スレッドセーフ）
+
+    並列に動く段階の時間はそのまま足すので、合計は実時間より長くなることがある。
+    wall_s は作成から stop() まで（stop() 前なら今まで）の実時間。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._stopped: float | None = None
+        self._stages: dict[str, dict] = {}
+        self._hosts: dict[str, dict] = {}
+
+    def stop(self) -> None:
+        self._stopped = time.perf_counter()
+
+    def observe(
+        self,
+        stage: str,
+        seconds: float,
+        nbytes: int = 0,
+        status=None,
+        host: str | None = None,
+        retries: int = 0,
+    ) -> None:
+        with self._lock:
+            st = self._stages.setdefault(stage, {"samples": [], "bytes": 0, "retries": 0, "status": {}})
+            st["samples"].append(seconds)
+            st["bytes"] += nbytes
+            st["retries"] += retries
+            if status is not None:
+                st["status"][str(status)] = st["status"].get(str(status), 0) + 1
+            if host:
+                h = self._hosts.setdefault(
+                    host, {"requests": 0, "bytes": 0, "seconds": 0.0, "retries": 0, "errors": 0, "status": {}}
+                )
+                h["requests"] += 1
+                h["bytes"] += nbytes
+                h["retries"] += retries
+                h["seconds"] += seconds
+                if status is not None:
+                    h["status"][str(status)] = h["status"].get(str(status), 0) + 1
+                    if not isinstance(status, int) or status >= 400:
+                        h["errors"] += 1
+
+    @staticmethod
+    def _stage_summary(st: dict) -> dict:
+        samples = sorted(st["samples"])
+        n = len(samples)
+        histogram = [0] * (len(PROFILE_BUCKETS_MS) + 1)
+        for s in samples:
+            ms = s * 1000
+            histogram[next((i for i, b in enumerate(PROFILE_BUCKETS_MS) if ms <= b), len(PROFILE_BUCKETS_MS))] += 1
+        return {
+            "count": n,
+            "total_s": round(sum(samples), 4),
+            "mean_ms": round(sum(samples) / n * 1000, 2) if n else 0.0,
+            "p50_ms": round(samples[n // 2] * 1000, 2) if n else 0.0,
+            "p95_ms": round(samples[min(n - 1, int(n * 0.95))] * 1000, 2) if n else 0.0,
+            "max_ms": round(samples[-1] * 1000, 2) if n else 0.0,
+            "bytes": st["bytes"],
+            "retries": st["retries"],
+            "status": dict(st["status"]),
+            "histogram_ms": {
+                **{f"<={b}": c for b, c in zip(PROFILE_BUCKETS_MS, histogram)},
+                f">{PROFILE_BUCKETS_MS[-1]}": histogram[-1],
+            },
+        }
+
+    def as_dict(self) -> dict:
+        """meta.json に書き出す形（段階・ホスト・区分ごとの時間）"""
+        with self._lock:
+            stages = {name: self._stage_summary(st) for name, st in self._stages.items()}
+            hosts = {
+                host: {**h, "seconds": round(h["seconds"], 4), "status": dict(h["status"])}
+                for host, h in self._hosts.items()
+            }
+        order = list(PROFILE_STAGES)
+        stages = dict(sorted(stages.items(), key=lambda kv: order.index(kv[0]) if kv[0] in order else len(order)))
+        time_by_kind: dict[str, float] = {}
+        for name, st in stages.items():
+            kind = PROFILE_STAGES.get(name, "other")
+            time_by_kind[kind] = round(time_by_kind.get(kind, 0.0) + st["total_s"], 4)
+        return {
+            "wall_s": round((self._stopped or time.perf_counter()) - self._started, 4),
+            "stages": stages,
+            "time_by_kind": time_by_kind,
+            "hosts": hosts,
+        }
+
+
+@contextmanager
+def profile_run(profile: RunProfile | None):
+    """このスレッド（と、ここから作るワーカー）で行う処理を profile に記録する"""
+    previous = getattr(_event_sink, "profile", None)
+    _event_sink.profile = profile
+    try:
+        yield profile
+    finally:
+        _event_sink.profile = previous
+
+
+@contextmanager
+def _timed(stage: str, host: str | None = None):
+    """stage の処理時間を記録する。yield した dict に bytes / status / retries を入れておくと一緒に記録する"""
+    profile = getattr(_event_sink, "profile", None)
+    record: dict = {}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        if profile is not None:
+            profile.observe(
+                stage,
+                time.perf_counter() - start,
+                nbytes=record.get("bytes", 0),
+                status=record.get("status"),
+                host=host,
+                retries=record.get("retries", 0),
+            )
+
+
+# 画像ディスクキャッシュの既定の上限（MB）。保存先は環境変数 MANGA_IMAGE_CACHE_DIR で変更できる
+IMAGE_CACHE_MAX_MB = 1024
+# キャッシュと画像ストアの間で本体を写すときの読み書きの単位
+IMAGE_CACHE_COPY_CHUNK = 256 * 1024
+
+
+def _get_image_cache_dir() -> str:
+    return os.environ.get("MANGA_IMAGE_CACHE_DIR") or os.path.join(_get_output_base_dir(), ".cache", "images")
+
+
+class ImageDiskCache:
+    """URL → sha256 のコンテンツアドレス型ディスクキャッシュ
+
+    画像本体は blobs/<sha256先頭2桁>/<sha256> に、URLごとの ETag / Last-Modified と
+    最終アクセス時刻は index.sqlite に保存する。同じ内容の画像は1ファイルを共有する。
+    ETag も Last-Modified も無い応答は再検証できない（使われない）ので保存しない。
+    合計サイズが max_bytes を超えたら最終アクセスが古いものから削除する（LRU）。
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self.stats = DownloadStats()
+        self._blob_dir = os.path.join(root, "blobs")
+        os.makedirs(self._blob_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(root, "index.sqlite"), timeout=CACHE_DB_TIMEOUT, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                url TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self._conn.commit()
+
+    @property
+    def total_bytes(self) -> int:
+        """blob の合計サイズ（同一内容の重複は1回だけ数える）"""
+        with self._lock:
+            row = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT sha256, size FROM entries)").fetchone()
+        return int(row[0])
+
+    def _blob_path(self, sha256: str) -> str:
+        return os.path.join(self._blob_dir, sha256[:2], sha256)
+
+    def lookup(self, url: str) -> dict | None:
+        """再検証に使えるキャッシュエントリ（ETag か Last-Modified があるもの）を返す"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sha256, size, etag, last_modified FROM entries WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if not row:
+            return None
+        sha256, size, etag, last_modified = row
+        if not (etag or last_modified) or not os.path.exists(self._blob_path(sha256)):
+            return None
+        return {"url": url, "sha256": sha256, "size": size, "etag": etag, "last_modified": last_modified}
+
+    @staticmethod
+    def conditional_headers(entry: dict) -> dict:
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def read_hit(self, entry: dict) -> bytes | None:
+        """304 を受けたときにキャッシュから本体を返す（本体が消えていれば None）"""
+        try:
+            with open(self._blob_path(entry["sha256"]), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        self._record_hit(entry, len(data))
+        return data
+
+    def put_hit(self, entry: dict, store: "ImageStore") -> "StoredImage | None":
+        """read_hit と同じだが、本体を少しずつ画像ストアへ写す（全体をメモリに読まない）"""
+        writer = store.writer()
+        try:
+            with open(self._blob_path(entry["sha256"]), "rb") as f:
+                for chunk in iter(lambda: f.read(IMAGE_CACHE_COPY_CHUNK), b""):
+                    writer.write(chunk)
+        except OSError:
+            writer.abort()
+            return None
+        stored = writer.commit()
+        self._record_hit(entry, stored.length)
+        return stored
+
+    def _record_hit(self, entry: dict, size: int) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE entries SET last_access = ? WHERE url = ?", (time.time(), entry["url"]))
+            self._conn.commit()
+        self.stats.add("hits")
+        self.stats.add("bytes_served", size)
+
+    def forget(self, url: str) -> None:
+        """URL の記録を消す（本体は他のURLから参照されていなければ消す）"""
+        with self._lock:
+            row = self._conn.execute("SELECT sha256 FROM entries WHERE url = ?", (url,)).fetchone()
+            if row:
+                self._conn.execute("DELETE FROM entries WHERE url = ?", (url,))
+                self._conn.commit()
+                self._remove_unused_blob_locked(row[0])
+
+    def store(self, url: str, data: "bytes | StoredImage", headers) -> None:
+        """200 で受け取った画像を保存（検証用ヘッダが無ければ保存せず、前の記録も消す）
+
+        StoredImage を渡すと、画像ストアから少しずつ写す（ディスクに置いた画像を丸ごとメモリに読まない）。
+        """
+        self.stats.add("misses")
+        if not (headers.get("ETag") or headers.get("Last-Modified")):
+            self.stats.add("uncacheable")
+            self.forget(url)
+            return
+        stored = data if isinstance(data, StoredImage) else StoredImage(len(data), data=data)
+        sha256 = stored.sha256 or hashlib.sha256(stored.read()).hexdigest()
+        path = self._blob_path(sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                for chunk in stored.iter_chunks(IMAGE_CACHE_COPY_CHUNK):
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (url, sha256, size, etag, last_modified, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (url, sha256, stored.length, headers.get("ETag"), headers.get("Last-Modified"), time.time()),
+            )
+            self._conn.commit()
+            evicted = self._evict_locked()
+        self.stats.add("bytes_stored", stored.length)
+        if evicted:
+            self.stats.add("evictions", evicted)
+
+    def _evict_locked(self) -> int:
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT sha256, size FROM entries)").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        evicted = 0
+        rows = self._conn.execute("SELECT url, sha256, size FROM entries ORDER BY last_access ASC").fetchall()
+        for url, sha256, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM entries WHERE url = ?", (url,))
+            evicted += 1
+            if self._remove_unused_blob_locked(sha256):
+                total -= size
+        self._conn.commit()
+        return evicted
+
+    def _remove_unused_blob_locked(self, sha256: str) -> bool:
+        """同じ内容を参照する他のURLが無くなったときだけ本体を消す"""
+        if self._conn.execute("SELECT 1 FROM entries WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone():
+            return False
+        try:
+            os.remove(self._blob_path(sha256))
+        except OSError:
+            pass
+        return True
+
+
+@functools.lru_cache(maxsize=None)
+def _get_image_cache(max_mb: int = IMAGE_CACHE_MAX_MB) -> ImageDiskCache:
+    return ImageDiskCache(_get_image_cache_dir(), max_bytes=int(max_mb) * 1024 * 1024)
+
+
+# 画像ストアでメモリ上に置く画像の合計上限（MB）。超えた分はディスクに書き出す
+IMAGE_STORE_MEMORY_BUDGET_MB = 64
+
+
+class StoredImage:
+    """画像本体への参照。メモリ上の bytes か、ディスク上のファイルの (path, offset, length)
+
+    ディスク上の参照は作成元の ImageStore を保持するので、参照が残っている間は一時ファイルが消えない。
+    """
+
+    __slots__ = ("path", "offset", "length", "sha256", "_data", "_owner")
+
+    def __init__(
+        self,
+        length: int,
+        data: bytes | None = None,
+        path: str | None = None,
+        offset: int = 0,
+        sha256: str = "",
+        owner: "ImageStore | None" = None,
+    ):
+        self.length = length
+        self.path = path
+        self.offset = offset
+        self.sha256 = sha256
+        self._data = data
+        self._owner = owner
+
+    @property
+    def on_disk(self) -> bool:
+        return self._data is None
+
+    def read(self) -> bytes:
+        """本体を bytes で返す（ディスク上ならメモリマップ経由で該当範囲だけ読む）"""
+        if self._data is not None:
+            return self._data
+        if self.length == 0:
+            return b""
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm[self.offset : self.offset + self.length]
+
+    def iter_chunks(self, chunk_size: int = 256 * 1024):
+        """本体を先頭から chunk_size ずつ返す"""
+        if self._data is not None:
+            yield self._data
+            return
+        remaining = self.length
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def open(self) -> BinaryIO:
+        """読み取り用のファイルオブジェクト（PIL のヘッダ解析など、全体を読まない用途向け）"""
+        if self._data is not None:
+            return BytesIO(self._data)
+        f = open(self.path, "rb")
+        f.seek(self.offset)
+        return f
+
+
+class _StoreWriter:
+    """1枚分の書き込み口。予算内ならメモリに、超えたらファイルに切り替えて追記する"""
+
+    def __init__(self, store: "ImageStore"):
+        self._store = store
+        self._buf: bytearray | None = bytearray()
+        self._file = None
+        self._path: str | None = None
+        self._hash = hashlib.sha256()
+        self.length = 0
+
+    def write(self, chunk: bytes) -> None:
+        self.length += len(chunk)
+        self._hash.update(chunk)
+        if self._file is None and not self._store._fits_in_memory(self.length):
+            self._path = self._store._new_path()
+            self._file = open(self._path, "wb")
+            self._file.write(self._buf)
+            self._buf = None
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._buf.extend(chunk)
+
+    def commit(self) -> StoredImage:
+        if self._file is not None:
+            self._file.close()
+            return StoredImage(self.length, path=self._path, sha256=self._hash.hexdigest(), owner=self._store)
+        return self._store._keep_in_memory(bytes(self._buf), self._hash.hexdigest())
+
+    def abort(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            try:
+                os.remove(self._path)
+            except OSError:
+                pass
+        self._buf = None
+
+
+class ImageStore:
+    """ダウンロードした画像の置き場所。
+
+    画像はチャンク単位で書き込まれ、memory_budget（バイト）を超える分は
+    一時ディレクトリのファイルに書き出す。memory_budget=None なら全てメモリ上、0 なら全てディスク。
+    ストアが破棄されると一時ディレクトリも削除される。
+    """
+
+    def __init__(self, memory_budget: int | None = None, root: str | None = None):
+        self.memory_budget = memory_budget
+        self.root = root
+        self._lock = threading.Lock()
+        self._memory_used = 0
+        self._finalizer = None
+
+    def _fits_in_memory(self, length: int) -> bool:
+        if self.memory_budget is None:
+            return True
+        with self._lock:
+            return self._memory_used + length <= self.memory_budget
+
+    def _keep_in_memory(self, data: bytes, sha256: str) -> StoredImage:
+        with self._lock:
+            self._memory_used += len(data)
+        return StoredImage(len(data), data=data, sha256=sha256)
+
+    def _new_path(self) -> str:
+        with self._lock:
+            if self.root is None:
+                self.root = tempfile.mkdtemp(prefix="manga_store_")
+                self._finalizer = weakref.finalize(self, shutil.rmtree, self.root, True)
+            # 既存のディレクトリ（再開したジョブ）に書き足しても名前がぶつからないようにする
+            fd, path = tempfile.mkstemp(dir=self.root, suffix=".bin")
+        os.close(fd)
+        return path
+
+    def writer(self) -> _StoreWriter:
+        return _StoreWriter(self)
+
+    def put(self, data: bytes) -> StoredImage:
+        writer = self.writer()
+        writer.write(data)
+        return writer.commit()
+
+    def discard(self, stored: StoredImage) -> None:
+        """検証で落ちた画像などを片付ける"""
+        if stored.on_disk:
+            try:
+                os.remove(stored.path)
+            except OSError:
+                pass
+        else:
+            with self._lock:
+                self._memory_used -= stored.length
+
+    def cleanup(self) -> None:
+        if self._finalizer is not None:
+            self._finalizer()
+
+    @property
+    def memory_used(self) -> int:
+        with self._lock:
+            return self._memory_used
+
+
+def iter_image_chunks(img: dict):
+    stored = img.get("stored")
+    if stored is not None:
+        yield from stored.iter_chunks()
+    else:
+        yield img.get("data") or b""
+
+
+def image_bytes(img: dict) -> bytes:
+    """抽出結果の1件から画像本体を取り出す（"stored" の参照、または旧形式の "data"）"""
+    stored = img.get("stored")
+    if stored is not None:
+        return stored.read()
+    return img.get("data") or b""
+
+
+def _image_request_headers(referer: str = "") -> dict:
+    return {
+        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+        "Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
+        "Referer": referer,
+    }
+
+
+def download_image(
+    url: str,
+    referer: str = "",
+    session: requests.Session | None = None,
+    cache: "ImageDiskCache | None" = None,
+) -> bytes | None:
+    headers = _image_request_headers(referer)
+    entry = cache.lookup(url) if cache else None
+    if entry:
+        headers.update(ImageDiskCache.conditional_headers(entry))
+    try:
+        response = _http_get(url, headers, session=session)
+        if entry and response.status_code == 304:
+            return cache.read_hit(entry)
+        response.raise_for_status()
+        img_data = response.content
+    except requests.RequestException:
+        return None
+    if cache:
+        cache.store(url, img_data, response.headers)
+    return img_data
+
+
+# 漫画画像とみなす最小の縦横サイズと最大アスペクト比（横/縦）
+MIN_IMAGE_SIDE = 200
+MAX_ASPECT_RATIO = 3
+
+# 先頭バイト判定（probe）の読み込み単位と、サイズが読めなければ諦めるまでのバイト数
+PROBE_CHUNK_SIZE = 8 * 1024
+PROBE_MAX_BYTES = 64 * 1024
+
+
+def _passes_dimension_filter(width: int, height: int) -> bool:
+    aspect_ratio = width / height if height > 0 else 0
+    if aspect_ratio > MAX_ASPECT_RATIO:
+        return False
+    return width >= MIN_IMAGE_SIDE and height >= MIN_IMAGE_SIDE
+
+
+def _probe_image_size(head: bytes | bytearray) -> tuple[int, int] | None:
+    """画像ファイル先頭のヘッダから (幅, 高さ) を読む。対応: JPEG/PNG/GIF/WebP/AVIF
+
+    まだ十分なバイト数が無い、または未対応形式の場合は None。
+    """
+    n = len(head)
+    if n >= 24 and head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+        return int.from_bytes(head[16:20], "big"), int.from_bytes(head[20:24], "big")
+
+    if n >= 10 and head[:6] in (b"GIF87a", b"GIF89a"):
+        return int.from_bytes(head[6:8], "little"), int.from_bytes(head[8:10], "little")
+
+    if n >= 16 and head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        chunk = head[12:16]
+        if chunk == b"VP8 " and n >= 30:
+            return int.from_bytes(head[26:28], "little") & 0x3FFF, int.from_bytes(head[28:30], "little") & 0x3FFF
+        if chunk == b"VP8L" and n >= 25:
+            b0, b1, b2, b3 = head[21], head[22], head[23], head[24]
+            width = 1 + (((b1 & 0x3F) << 8) | b0)
+            height = 1 + (((b3 & 0x0F) << 10) | (b2 << 2) | ((b1 & 0xC0) >> 6))
+            return width, height
+        if chunk == b"VP8X" and n >= 30:
+            return 1 + int.from_bytes(head[24:27], "little"), 1 + int.from_bytes(head[27:30], "little")
+        return None
+
+    if n >= 12 and head[4:8] == b"ftyp" and head[8:12] in (b"avif", b"avis", b"mif1", b"heic"):
+        # ISOBMFF: 最初の ispe ボックス（主画像の寸法）を探す
+        idx = head.find(b"ispe")
+        if idx >= 0 and n >= idx + 16:
+            return int.from_bytes(head[idx + 8 : idx + 12], "big"), int.from_bytes(head[idx + 12 : idx + 16], "big")
+        return None
+
+    if n >= 4 and head[:2] == b"\xff\xd8":
+        i = 2
+        while i + 4 <= n:
+            if head[i] != 0xFF:
+                i += 1
+                continue
+            marker = head[i + 1]
+            if marker == 0xFF:
+                i += 1
+                continue
+            if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+                i += 2
+                continue
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                if i + 9 > n:
+                    return None
+                height = int.from_bytes(head[i + 5 : i + 7], "big")
+                width = int.from_bytes(head[i + 7 : i + 9], "big")
+                return width, height
+            i += 2 + int.from_bytes(head[i + 2 : i + 4], "big")
+        return None
+
+    return None
+
+
+class _HeaderProbe:
+    """レスポンス本体の先頭だけを見て、フィルタで落ちる画像かを早期に判定する"""
+
+    def __init__(self, min_size: int, headers):
+        self.content_length: int | None = None
+        # 圧縮転送の場合 Content-Length は画像本体のサイズではない
+        if not headers.get("Content-Encoding"):
+            try:
+                self.content_length = int(headers.get("Content-Length") or "")
+            except ValueError:
+                pass
+        self.received = 0
+        self._min_size = min_size
+        self._head = bytearray()
+        self._decided = False
+
+    def rejects_by_length(self) -> bool:
+        return self.content_length is not None and self.content_length < self._min_size
+
+    def feed(self, chunk: bytes) -> bool:
+        """受信したチャンクを渡す。不合格が確定したら True"""
+        self.received += len(chunk)
+        if self._decided:
+            return False
+        self._head.extend(chunk)
+        dims = _probe_image_size(self._head)
+        if dims is None:
+            if len(self._head) >= PROBE_MAX_BYTES:
+                self._decided = True
+                self._head = bytearray()
+            return False
+        self._decided = True
+        self._head = bytearray()
+        return not _passes_dimension_filter(*dims)
+
+    @property
+    def bytes_saved(self) -> int:
+        if self.content_length is None:
+            return 0
+        return max(0, self.content_length - self.received)
+
+
+def _record_probe_reject(url: str, probe: _HeaderProbe, stats: DownloadStats | None) -> None:
+    if stats is None:
+        return
+    stats.reject(url)
+    stats.add("probe_rejected")
+    stats.add("bytes_saved", probe.bytes_saved)
+    stats.add("bytes_downloaded", probe.received)
+
+
+# ホストごとの同時接続数の自動調整（AIMD）。成功が続けば枠を広げ、429/503/タイムアウトで半分に絞る。
+# 最初に絞るまでは TCP のスロースタートと同様に成功1件ごとに +1（1往復でほぼ倍）、以降は1往復あたり +1
+ADAPTIVE_INITIAL_LIMIT = 2
+ADAPTIVE_DECREASE_FACTOR = 0.5
+# 応答までの時間がそのホストの最短の何倍以内なら「健全」とみなして枠を広げるか
+ADAPTIVE_LATENCY_TOLERANCE = 2.0
+HOST_BACKOFF_STATUSES = (429, 503, 504)
+HOST_OK = "ok"
+HOST_BACKOFF = "backoff"
+HOST_NEUTRAL = "neutral"
+
+
+def _host_outcome(status: int, retries: Retry | None = None) -> str:
+    """応答を同時接続数の調整用に分類（urllib3 が内部で再試行した分も見る）"""
+    history = retries.history if retries is not None else ()
+    if status in HOST_BACKOFF_STATUSES or any(h.status in HOST_BACKOFF_STATUSES or h.error for h in history):
+        return HOST_BACKOFF
+    if status < 400:
+        return HOST_OK
+    return HOST_NEUTRAL
+
+
+def parse_rate_limits(text: str) -> dict[str, float]:
+    """「ドメイン=リクエスト/秒」を1行ずつ書いたテキストを読む（不正な行は無視）"""
+    limits: dict[str, float] = {}
+    for line in (text or "").splitlines():
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        domain, _, rate = line.replace("=", " ").partition(" ")
+        try:
+            value = float(rate.strip())
+        except ValueError:
+            continue
+        if domain and value > 0:
+            limits[domain.strip().lower()] = value
+    return limits
+
+
+class _TokenBucket:
+    """rate 回/秒、最大 burst 回までためられるトークンバケット（呼び出し側でロックする）"""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """トークンを1つ取れたら 0、取れなければ次のトークンまでの秒数"""
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class _HostGate:
+    """1ホスト分の同時実行枠。スレッドからは acquire()、asyncio からは acquire_async() で待つ"""
+
+    def __init__(self, host: str, max_limit: int, initial: int, adaptive: bool, rate: float | None, clock_start: float):
+        self.host = host
+        self.max_limit = max(1, int(max_limit))
+        self.adaptive = adaptive
+        self.limit = float(min(initial, self.max_limit) if adaptive else self.max_limit)
+        self.in_flight = 0
+        self.backoffs = 0
+        self.trajectory: list[tuple[float, int]] = [(0.0, int(self.limit))]
+        self._bucket = _TokenBucket(rate) if rate else None
+        self._cond = threading.Condition()
+        self._async_waiters: list[asyncio.Future] = []
+        self._min_latency: float | None = None
+        self._slow_start = True
+        self._last_decrease = 0.0
+        self._clock_start = clock_start
+
+    def _try_acquire_locked(self) -> float | None:
+        """枠を取れたら 0、レート上限で待つなら秒数、枠が空くのを待つなら None"""
+        if self.in_flight >= int(self.limit):
+            return None
+        if self._bucket is not None:
+            delay = self._bucket.take(time.monotonic())
+            if delay > 0:
+                return delay
+        self.in_flight += 1
+        return 0.0
+
+    def try_acquire(self) -> tuple[float | None, float | None]:
+        """待たずに枠を取る。(開始時刻, None) か、取れなければ (None, レート上限で待つ秒数。枠が空くのを待つなら None)"""
+        with self._cond:
+            delay = self._try_acquire_locked()
+        if delay == 0.0:
+            return time.monotonic(), None
+        return None, delay
+
+    def acquire(self) -> float:
+        """枠が空くまで待って確保し、開始時刻（monotonic）を返す"""
+        with self._cond:
+            while True:
+                delay = self._try_acquire_locked()
+                if delay == 0.0:
+                    return time.monotonic()
+                self._cond.wait(timeout=delay)
+
+    async def acquire_async(self) -> float:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                delay = self._try_acquire_locked()
+                if delay == 0.0:
+                    return time.monotonic()
+                waiter = loop.create_future()
+                self._async_waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._cond:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+
+    def release(self, outcome: str, started: float, latency: float | None = None) -> None:
+        """枠を返し、結果に応じて枠の大きさを調整する。latency は応答ヘッダまでの秒数"""
+        with self._cond:
+            self.in_flight -= 1
+            saturated = self.in_flight + 1 >= int(self.limit)
+            before = int(self.limit)
+            if self.adaptive and outcome == HOST_BACKOFF:
+                # 前回絞った後に始まったリクエストの失敗だけを数える（同じ混雑で何度も半減しない）
+                if started >= self._last_decrease:
+                    self.limit = max(1.0, self.limit * ADAPTIVE_DECREASE_FACTOR)
+                    self._slow_start = False
+                    self._last_decrease = time.monotonic()
+                    self.backoffs += 1
+            elif self.adaptive and outcome == HOST_OK and latency is not None:
+                self._min_latency = latency if self._min_latency is None else min(self._min_latency, latency)
+                # 枠を使い切っていて応答も速いときだけ広げる
+                if saturated and latency <= self._min_latency * ADAPTIVE_LATENCY_TOLERANCE:
+                    step = 1.0 if self._slow_start else 1.0 / self.limit
+                    self.limit = min(float(self.max_limit), self.limit + step)
+            if int(self.limit) != before:
+                self.trajectory.append((round(time.monotonic() - self._clock_start, 3), int(self.limit)))
+            self._cond.notify_all()
+            for waiter in self._async_waiters:
+                waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+
+
+class HostConcurrencyController:
+    """ホストごとの同時接続数とリクエストレートを管理する
+
+    adaptive=True なら各ホストの枠を initial から始めて AIMD で max_per_host まで調整する。
+    rate_limits は {ドメイン: リクエスト/秒}。サブドメインにも適用される。
+    """
+
+    def __init__(
+        self,
+        max_per_host: int,
+        initial: int = ADAPTIVE_INITIAL_LIMIT,
+        adaptive: bool = True,
+        rate_limits: dict[str, float] | None = None,
+    ):
+        self.max_per_host = max(1, int(max_per_host))
+        self.initial = max(1, int(initial))
+        self.adaptive = adaptive
+        self.rate_limits = rate_limits or {}
+        self._gates: dict[str, _HostGate] = {}
+        self._lock = threading.Lock()
+        self._clock_start = time.monotonic()
+
+    def _rate_for(self, host: str) -> float | None:
+        for domain, rate in self.rate_limits.items():
+            if host == domain or host.endswith("." + domain):
+                return rate
+        return None
+
+    def gate(self, url: str) -> _HostGate:
+        host = (urlparse(url).hostname or "").lower()
+        with self._lock:
+            gate = self._gates.get(host)
+            if gate is None:
+                gate = _HostGate(
+                    host,
+                    self.max_per_host,
+                    self.initial,
+                    self.adaptive,
+                    self._rate_for(host),
+                    self._clock_start,
+                )
+                self._gates[host] = gate
+            return gate
+
+    def gates(self) -> list[_HostGate]:
+        with self._lock:
+            return list(self._gates.values())
+
+
+def _fetch_image_to_store(
+    url: str,
+    referer: str,
+    min_size: int,
+    store: ImageStore,
+    session: requests.Session | None = None,
+    probe: bool = False,
+    stats: DownloadStats | None = None,
+    cache: ImageDiskCache | None = None,
+    limiter: HostConcurrencyController | None = None,
+    gate_started: float | None = None,
+) -> StoredImage | None:
+    """画像をチャンク単位で受信し、そのまま画像ストアへ書き込む。
+
+    probe=True なら先頭数KBで画像サイズを判定し、フィルタに落ちるなら本体を受信せずに接続を切る。
+    limiter を渡すと、ホストごとの同時接続数・レートの枠を取ってからリクエストする
+    （gate_started を渡したときは呼び出し側が枠を取得済み。終わったら返すのはこちらで行う）。
+    """
+    headers = _image_request_headers(referer)
+    entry = cache.lookup(url) if cache else None
+    if entry:
+        headers.update(ImageDiskCache.conditional_headers(entry))
+    gate = limiter.gate(url) if limiter else None
+    with _timed("image_download", host=urlparse(url).netloc) as rec:
+        if gate_started is not None:
+            started = gate_started
+        else:
+            started = gate.acquire() if gate else 0.0
+        outcome, latency = HOST_BACKOFF, None
+        try:
+            response = _http_get(url, headers, session=session, stream=True)
+            if entry and response.status_code == 304:
+                response.close()
+                hit = cache.put_hit(entry, store)
+                if hit is not None:
+                    outcome = _host_outcome(response.status_code, getattr(response.raw, "retries", None))
+                    latency = response.elapsed.total_seconds()
+                    rec.update(status=304, retries=_retry_count(response))
+                    return hit
+                # 本体が消えていた（追い出し・削除）: 記録を消して、条件を付けずに取り直す
+                cache.forget(url)
+                response = _http_get(url, _image_request_headers(referer), session=session, stream=True)
+            with response:
+                outcome = _host_outcome(response.status_code, getattr(response.raw, "retries", None))
+                latency = response.elapsed.total_seconds()
+                rec.update(status=response.status_code, retries=_retry_count(response))
+                response.raise_for_status()
+                header_probe = _HeaderProbe(min_size, response.headers) if probe else None
+                if header_probe and header_probe.rejects_by_length():
+                    _record_probe_reject(url, header_probe, stats)
+                    return None
+                writer = store.writer()
+                try:
+                    for chunk in response.iter_content(PROBE_CHUNK_SIZE):
+                        writer.write(chunk)
+                        if header_probe and header_probe.feed(chunk):
+                            _record_probe_reject(url, header_probe, stats)
+                            writer.abort()
+                            return None
+                except BaseException:
+                    writer.abort()
+                    raise
+                stored = writer.commit()
+                response_headers = response.headers
+        except requests.RequestException:
+            rec.setdefault("status", "error")
+            return None
+        finally:
+            if gate:
+                gate.release(outcome, started, latency)
+        rec["bytes"] = stored.length
+        if stats is not None:
+            stats.add("bytes_downloaded", stored.length)
+        if cache:
+            cache.store(url, stored, response_headers)
+    return stored
+
+
+# 知覚ハッシュ（dHash）の一辺のビット数と、同じ画像とみなすハミング距離の上限（64ビット中）
+DHASH_SIZE = 8
+DEDUPE_MAX_DISTANCE = 5
+
+
+def _dhash(img: Image.Image) -> int:
+    """差分ハッシュ（dHash）。グレースケールで (DHASH_SIZE+1)xDHASH_SIZE に縮め、横に隣り合う画素の明暗を比べる"""
+    size = (DHASH_SIZE + 1, DHASH_SIZE)
+    # JPEG はデコード時に縮小しておき（draft）、全画素を展開しない
+    img.draft("L", (size[0] * 8, size[1] * 8))
+    small = img.convert("L").resize(size, Image.Resampling.BOX, reducing_gap=2.0)
+    px = np.asarray(small, dtype=np.int16)
+    return int.from_bytes(np.packbits(px[:, 1:] > px[:, :-1]).tobytes(), "big")
+
+
+def _validate_stored_image(
+    img_info: dict, stored: StoredImage, min_size: int, store: ImageStore, stats: DownloadStats | None = None
+) -> dict | None:
+    """取得済みの画像をバリデーション（サイズ/縦横/アスペクト比）し、重複判定用の dHash も計算する
+
+    不合格ならストアから削除し、stats に除外した画像として記録する。
+    """
+    with _timed("validate"):
+        result = None
+        if stored.length >= min_size:
+            try:
+                with stored.open() as f:
+                    img = Image.open(f)
+                    width, height = img.size
+                    if _passes_dimension_filter(width, height):
+                        try:
+                            dhash = _dhash(img)
+                        except Exception:
+                            dhash = None
+                        result = {
+                            **img_info,
+                            "stored": stored,
+                            "width": width,
+                            "height": height,
+                            "size": stored.length,
+                            "dhash": dhash,
+                        }
+            except Exception:
+                result = None
+        if result is None:
+            store.discard(stored)
+            if stats is not None:
+                stats.reject(img_info["url"])
+    return result
+
+
+def _download_and_validate_image(
+    img_info: dict,
+    min_size: int,
+    referer: str,
+    session: requests.Session | None = None,
+    probe: bool = False,
+    stats: DownloadStats | None = None,
+    cache: ImageDiskCache | None = None,
+    store: ImageStore | None = None,
+    limiter: HostConcurrencyController | None = None,
+    gate_started: float | None = None,
+    on_fetched: Callable[[StoredImage | None], None] | None = None,
+) -> dict | None:
+    """1枚の画像をダウンロードしてバリデーション（並列処理用）
+
+    on_fetched は受信が終わったとき（検証の前。失敗しても呼ぶ）に受信した画像を渡す。相乗りしている取得に中身を分けるのに使う。
+    """
+    store = store if store is not None else ImageStore()
+    stored = None
+    try:
+        stored = _fetch_image_to_store(
+            img_info["url"],
+            referer,
+            min_size,
+            store,
+            session=session,
+            probe=probe,
+            stats=stats,
+            cache=cache,
+            limiter=limiter,
+            gate_started=gate_started,
+        )
+    finally:
+        if on_fetched is not None:
+            on_fetched(stored)
+    if stored is None:
+        return None
+    return _validate_stored_image(img_info, stored, min_size, store, stats)
+
+
+DOWNLOAD_ENGINE_THREAD = "thread"
+DOWNLOAD_ENGINE_ASYNCIO = "asyncio"
+
+# asyncio エンジンの既定値
+ASYNC_MAX_IN_FLIGHT = 100
+ASYNC_PER_HOST_LIMIT = 16
+ASYNC_DECODE_WORKERS = 4
+ASYNC_ENGINE_AVAILABLE = aiohttp is not None
+
+
+def _retry_delay(attempt: int, retry_after: str | None = None) -> float:
+    """asyncio エンジン用の待ち時間（urllib3側の _JitteredRetry と同じ方針）"""
+    if retry_after:
+        try:
+            return min(Retry().parse_retry_after(retry_after), HTTP_RETRY_AFTER_MAX)
+        except Exception:
+            pass
+    backoff = min(HTTP_BACKOFF_FACTOR * (2**attempt), HTTP_BACKOFF_MAX)
+    return random.uniform(backoff / 2, backoff)
+
+
+class SingleFlight:
+    """同じキー（URL・Referer・最小サイズ・先頭バイト判定）の取得を同時に1回だけ行う
+
+    最初に来た取得（リーダー）だけが通信し、終わるまでに同じキーで来た取得（フォロワー）は
+    join() の Future でその中身（bytes。取れなければ None）を受け取る。フォロワーは待つ間スレッドを使わない。
+    終わった後に来た取得は改めて通信する（結果は保持しない）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: dict[tuple, list[Future]] = {}
+        self.coalesced = 0
+
+    def join(self, key: tuple) -> Future | None:
+        """取得中のものがあれば、その中身を受け取る Future を返す。None ならリーダーとして取得し、finish() を呼ぶ"""
+        with self._lock:
+            followers = self._flights.get(key)
+            if followers is None:
+                self._flights[key] = []
+                return None
+            future: Future = Future()
+            followers.append(future)
+            self.coalesced += 1
+            return future
+
+    def finish(self, key: tuple, stored: StoredImage | None) -> None:
+        """リーダーの取得が終わった。待っているフォロワーがいれば中身を読んで渡す"""
+        with self._lock:
+            followers = self._flights.pop(key)
+        if not followers:
+            return
+        try:
+            data = stored.read() if stored is not None else None
+        except Exception:
+            data = None
+        for future in followers:
+            # 取り消されたフォロワー（asyncio 側のタスクの取り消し）には渡さない
+            if future.set_running_or_notify_cancel():
+                future.set_result(data)
+
+
+def _copy_future_outcome(source: Future, target: Future) -> None:
+    """source の結果・例外を target に移す。source が取り消されていれば target には CancelledError を設定する"""
+    if source.cancelled():
+        target.set_exception(CancelledError())
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+# プロセス全体で同時に実行する画像ダウンロードの上限（全セッション・全ジョブの合計）
+DOWNLOAD_SCHEDULER_MAX_WORKERS = 32
+# ホストの枠待ちのクライアントを見直す最長間隔（秒）。枠は処理が終わるたびにも見直す
+SCHEDULER_GATE_POLL = 0.5
+
+
+class DownloadScheduler:
+    """プロセス全体で共有する画像ダウンロードの実行枠
+
+    ダウンロードを行う側（ジョブ・セッションごとの _ThreadDownloader）は open() でクライアントとして登録し、
+    クライアントごとの待ち行列から順番に1件ずつ取り出して実行する（公平に分け合う）。
+    同時に実行するのは全体で max_workers 件、クライアントごとには open() で指定した件数まで。
+    submit() に gate（ホストの枠）を渡した処理は、枠を取れてからワーカーに渡す。枠・レートの上限に
+    達しているクライアントは飛ばすので、絞られたクライアントが全体のワーカーを待たせて占有することはない。
+    処理が Future を返したら（SingleFlight で他の取得の終わりを待つとき）、ワーカーと枠はすぐ返し、
+    その Future の結果を submit() の Future に移す。
+    reserve() / release() はワーカーを使わずに枠だけを取る（asyncio エンジン用。全体の上限は同じ）。
+    flights（SingleFlight）で、別のクライアントが同時に取得している同じ画像は1回の通信にまとめる。
+    """
+
+    def __init__(self, max_workers: int = DOWNLOAD_SCHEDULER_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.flights = SingleFlight()
+        self._cond = threading.Condition()
+        self._clients: deque[dict] = deque()
+        self._running = 0
+        for i in range(max_workers):
+            threading.Thread(target=self._worker, name=f"download-{i}", daemon=True).start()
+
+    def open(self, max_workers: int) -> dict:
+        """クライアントを登録する。呼び出し元の実行コンテキスト（イベント・計測）を実行時に引き継ぐ"""
+        client = {
+            "limit": max(1, max_workers),
+            "queue": deque(),
+            "running": 0,
+            "waiting": 0,
+            "attach": _thread_context_hook() if _thread_context_hook is not None else None,
+            "events": getattr(_event_sink, "events", None),
+            "profile": getattr(_event_sink, "profile", None),
+        }
+        with self._cond:
+            self._clients.append(client)
+        return client
+
+    def submit(self, client: dict, fn: Callable, *args, gate: _HostGate | None = None) -> Future:
+        """gate を渡すと、取得した枠の開始時刻を fn に gate_started= で渡す（枠を返すのは fn の側）"""
+        future: Future = Future()
+        with self._cond:
+            client["queue"].append((future, fn, args, gate))
+            self._cond.notify()
+        return future
+
+    def reserve(self, client: dict) -> Future:
+        """ワーカーを使わずに実行枠を1つ取る。枠を取れたら Future が完了する（使い終わったら release()）"""
+        future: Future = Future()
+        with self._cond:
+            client["queue"].append((future, None, (), None))
+            self._cond.notify()
+        return future
+
+    def release(self, client: dict) -> None:
+        """reserve() で取った枠を返す"""
+        with self._cond:
+            client["running"] -= 1
+            self._running -= 1
+            self._cond.notify_all()
+
+    def close(self, client: dict) -> None:
+        """まだ始まっていない分を取り消し、実行中・他の取得待ちの分が終わるのを待ってから登録を外す"""
+        with self._cond:
+            while True:
+                # 他の取得待ちが終わると続きの処理が投入されるので、待つたびに取り消し直す
+                while client["queue"]:
+                    client["queue"].popleft()[0].cancel()
+                if not client["running"] and not client["waiting"]:
+                    break
+                self._cond.wait()
+            self._clients.remove(client)
+
+    def counts(self) -> dict:
+        """実行中の件数・待っている件数・他の取得の終わりを待っている件数・登録中のクライアント数・相乗りした件数"""
+        with self._cond:
+            return {
+                "running": self._running,
+                "queued": sum(len(c["queue"]) for c in self._clients),
+                "waiting": sum(c["waiting"] for c in self._clients),
+                "clients": len(self._clients),
+                "max_workers": self.max_workers,
+                "coalesced": self.flights.coalesced,
+            }
+
+    def _next_task(self) -> tuple[tuple | None, float | None]:
+        """待ち行列のあるクライアントを順番に回り、枠の空いている最初のクライアントから1件取り出す
+
+        戻り値は ((client, task, gate_started), None)。取り出せなければ (None, 見直すまでの秒数)。
+        ホストの枠が空くのを待つクライアントしか無いときは SCHEDULER_GATE_POLL 秒後に見直す。
+        """
+        # reserve() で取った枠はワーカーを使わないので、ワーカーが空いていても全体の上限を超えないようにする
+        if self._running >= self.max_workers:
+            return None, None
+        retry = None
+        for _ in range(len(self._clients)):
+            client = self._clients[0]
+            self._clients.rotate(-1)
+            if not client["queue"] or client["running"] >= client["limit"]:
+                continue
+            gate = client["queue"][0][3]
+            gate_started = None
+            if gate is not None:
+                gate_started, delay = gate.try_acquire()
+                if gate_started is None:
+                    delay = SCHEDULER_GATE_POLL if delay is None else min(delay, SCHEDULER_GATE_POLL)
+                    retry = delay if retry is None else min(retry, delay)
+                    continue
+            client["running"] += 1
+            self._running += 1
+            return (client, client["queue"].popleft(), gate_started), None
+        return None, retry
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                task, retry = self._next_task()
+                while task is None:
+                    self._cond.wait(timeout=retry)
+                    task, retry = self._next_task()
+            client, (future, fn, args, gate), gate_started = task
+            if fn is None:
+                # reserve() の枠: 取れたことを知らせ、release() まで持ったままにする
+                if future.set_running_or_notify_cancel():
+                    future.set_result(None)
+                else:
+                    self.release(client)
+                continue
+            try:
+                if future.set_running_or_notify_cancel():
+                    if client["attach"] is not None:
+                        client["attach"]()
+                    _event_sink.events = client["events"]
+                    _event_sink.profile = client["profile"]
+                    kwargs = {"gate_started": gate_started} if gate is not None else {}
+                    try:
+                        result = fn(*args, **kwargs)
+                    except BaseException as e:
+                        future.set_exception(e)
+                    else:
+                        if isinstance(result, Future):
+                            self._follow(client, future, result)
+                        else:
+                            future.set_result(result)
+                elif gate is not None:
+                    gate.release(HOST_NEUTRAL, gate_started)
+            finally:
+                _event_sink.events = None
+                _event_sink.profile = None
+                with self._cond:
+                    client["running"] -= 1
+                    self._running -= 1
+                    self._cond.notify_all()
+
+    def _follow(self, client: dict, future: Future, pending: Future) -> None:
+        """pending（他の取得の終わりを待つ Future）が終わったら結果を future に移す。待つ間ワーカーは使わない"""
+
+        def done(_: Future) -> None:
+            _copy_future_outcome(pending, future)
+            with self._cond:
+                client["waiting"] -= 1
+                self._cond.notify_all()
+
+        with self._cond:
+            client["waiting"] += 1
+        pending.add_done_callback(done)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_download_scheduler() -> DownloadScheduler:
+    return DownloadScheduler()
+
+
+# fork した子プロセスには親のワーカースレッドが無いので、使うときに作り直す
+os.register_at_fork(after_in_child=_get_download_scheduler.cache_clear)
+
+
+class _ThreadDownloader:
+    """画像をダウンロード・検証する（従来方式）。実行はプロセス共有の DownloadScheduler で行う
+
+    max_workers はこのダウンローダーが同時に使える枠の数（全体の上限は DOWNLOAD_SCHEDULER_MAX_WORKERS）。
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        probe: bool = False,
+        stats: DownloadStats | None = None,
+        cache: ImageDiskCache | None = None,
+        store: ImageStore | None = None,
+        limiter: HostConcurrencyController | None = None,
+    ):
+        self._session = _get_http_session(max_workers)
+        self._scheduler = _get_download_scheduler()
+        self._client = self._scheduler.open(max_workers)
+        self._probe = probe
+        self._stats = stats
+        self._cache = cache
+        self._store = store if store is not None else ImageStore()
+        self._limiter = limiter
+
+    def __enter__(self) -> "_ThreadDownloader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._scheduler.close(self._client)
+
+    def submit(self, img_info: dict, min_size: int, referer: str) -> Future:
+        return self._scheduler.submit(
+            self._client,
+            self._download,
+            img_info,
+            min_size,
+            referer,
+            gate=self._limiter.gate(img_info["url"]) if self._limiter else None,
+        )
+
+    def _download(self, img_info: dict, min_size: int, referer: str, gate_started: float | None = None) -> "dict | None | Future":
+        """スケジューラのワーカーで実行する。同じ画像を別の取得が通信中なら、相乗りして結果を待つ Future を返す"""
+        flights = self._scheduler.flights
+        key = (img_info["url"], referer, min_size, self._probe)
+        shared = flights.join(key)
+        if shared is None:
+            return _download_and_validate_image(
+                img_info,
+                min_size,
+                referer,
+                self._session,
+                self._probe,
+                self._stats,
+                self._cache,
+                self._store,
+                self._limiter,
+                gate_started=gate_started,
+                on_fetched=functools.partial(flights.finish, key),
+            )
+        # 通信しないので、取得済みのホストの枠はすぐ返す
+        if gate_started is not None:
+            self._limiter.gate(img_info["url"]).release(HOST_NEUTRAL, gate_started)
+        if self._stats is not None:
+            self._stats.add("coalesced")
+        result: Future = Future()
+
+        def on_shared(_: Future) -> None:
+            data = shared.result()
+            if data is None:
+                result.set_result(None)
+                return
+            # 受け取った中身の保存と検証は、このダウンローダーの枠で行う（リーダーのワーカーを使わない）
+            validated = self._scheduler.submit(self._client, self._validate_shared, img_info, data, min_size)
+            validated.add_done_callback(lambda f: _copy_future_outcome(f, result))
+
+        shared.add_done_callback(on_shared)
+        return result
+
+    def _validate_shared(self, img_info: dict, data: bytes, min_size: int) -> dict | None:
+        return _validate_stored_image(img_info, self._store.put(data), min_size, self._store, self._stats)
+
+
+class _AsyncDownloader:
+    """asyncio + aiohttp で大量の画像リクエストを同時に処理する。
+
+    イベントループは専用スレッドで回し、submit() は concurrent.futures.Future を返すので
+    呼び出し側は _ThreadDownloader と同じように as_completed で待てる。
+    PIL でのヘッダ解析だけを小さなスレッドプールに逃がす。
+    リクエストは _ThreadDownloader と同じくプロセス共有の DownloadScheduler の枠（reserve）を取ってから送り、
+    別の取得が通信中の同じ画像は SingleFlight で相乗りする。
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = ASYNC_MAX_IN_FLIGHT,
+        per_host_limit: int = ASYNC_PER_HOST_LIMIT,
+        decode_workers: int = ASYNC_DECODE_WORKERS,
+        probe: bool = False,
+        stats: DownloadStats | None = None,
+        cache: ImageDiskCache | None = None,
+        store: ImageStore | None = None,
+        limiter: HostConcurrencyController | None = None,
+    ):
+        if aiohttp is None:
+            raise RuntimeError("asyncio エンジンには aiohttp が必要です（pip install aiohttp）")
+        self._probe = probe
+        self._stats = stats
+        self._cache = cache
+        self._store = store if store is not None else ImageStore()
+        self._limiter = limiter
+        self._max_in_flight = max(1, int(max_in_flight))
+        self._per_host_limit = max(1, int(per_host_limit))
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="async-downloader", daemon=True)
+        self._decode_pool = _thread_pool(decode_workers)
+        self._profile = getattr(_event_sink, "profile", None)
+        self._session = None
+        self._scheduler = _get_download_scheduler()
+        self._client: dict | None = None
+
+    def __enter__(self) -> "_AsyncDownloader":
+        self._client = self._scheduler.open(self._max_in_flight)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._open(), self._loop).result()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        try:
+            asyncio.run_coroutine_threadsafe(self._close(), self._loop).result()
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._decode_pool.shutdown(wait=True)
+            self._scheduler.close(self._client)
+
+    async def _open(self) -> None:
+        # イベントループのスレッドにも呼び出し元の計測先を引き継ぐ
+        _event_sink.profile = self._profile
+        connector = aiohttp.TCPConnector(
+            limit=self._max_in_flight,
+            limit_per_host=self._per_host_limit,
+            ttl_dns_cache=300,
+        )
+        self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+
+    async def _close(self) -> None:
+        # 取り消されずに残ったタスクを片付けてからセッションを閉じる
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+
+    @asynccontextmanager
+    async def _slot(self):
+        """プロセス全体のダウンロード枠を1つ取って持つ（スレッドのワーカーは使わない）"""
+        ticket = self._scheduler.reserve(self._client)
+        try:
+            await asyncio.wrap_future(ticket)
+        except asyncio.CancelledError:
+            # 取り消しが間に合わなかった（枠を取れた・取れる途中）なら返しておく
+            if not ticket.cancel():
+                self._scheduler.release(self._client)
+            raise
+        try:
+            yield
+        finally:
+            self._scheduler.release(self._client)
+
+    async def _read_body(self, url: str, response, min_size: int) -> StoredImage | None:
+        header_probe = _HeaderProbe(min_size, response.headers) if self._probe else None
+        if header_probe and header_probe.rejects_by_length():
+            _record_probe_reject(url, header_probe, self._stats)
+            return None
+        writer = self._store.writer()
+        try:
+            async for chunk in response.content.iter_chunked(PROBE_CHUNK_SIZE):
+                writer.write(chunk)
+                if header_probe and header_probe.feed(chunk):
+                    _record_probe_reject(url, header_probe, self._stats)
+                    writer.abort()
+                    return None
+        except BaseException:
+            writer.abort()
+            raise
+        stored = writer.commit()
+        if self._stats is not None:
+            self._stats.add("bytes_downloaded", stored.length)
+        if self._cache:
+            # sqlite/ファイル書き込みはイベントループを塞がないようにスレッドで
+            await self._loop.run_in_executor(
+                self._decode_pool,
+                lambda: self._cache.store(url, stored, response.headers),
+            )
+        return stored
+
+    async def _download(self, url: str, referer: str, min_size: int, rec: dict) -> StoredImage | None:
+        headers = _image_request_headers(referer)
+        entry = self._cache.lookup(url) if self._cache else None
+        if entry:
+            headers.update(ImageDiskCache.conditional_headers(entry))
+        gate = self._limiter.gate(url) if self._limiter else None
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            retry_after = None
+            started = await gate.acquire_async() if gate else 0.0
+            outcome, latency = HOST_BACKOFF, None
+            try:
+                async with self._slot(), self._session.get(url, headers=headers) as response:
+                    outcome = _host_outcome(response.status)
+                    latency = time.monotonic() - started
+                    rec.update(status=response.status, retries=attempt)
+                    if entry and response.status == 304:
+                        hit = await self._loop.run_in_executor(self._decode_pool, self._cache.put_hit, entry, self._store)
+                        if hit is not None:
+                            return hit
+                        # 本体が消えていた: 記録を消して、条件を付けずに取り直す（待たずに次の試行へ）
+                        await self._loop.run_in_executor(self._decode_pool, self._cache.forget, url)
+                        entry, headers = None, _image_request_headers(referer)
+                        continue
+                    if response.status in HTTP_RETRY_STATUSES and attempt < HTTP_MAX_RETRIES:
+                        retry_after = response.headers.get("Retry-After")
+                    elif response.status >= 400:
+                        return None
+                    else:
+                        stored = await self._read_body(url, response, min_size)
+                        rec["bytes"] = stored.length if stored is not None else 0
+                        return stored
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                rec["status"] = "error"
+                if attempt >= HTTP_MAX_RETRIES:
+                    return None
+            except asyncio.CancelledError:
+                # 上限到達などで取り消されたものはサーバー側の混雑とはみなさない
+                outcome = HOST_NEUTRAL
+                raise
+            finally:
+                if gate:
+                    gate.release(outcome, started, latency)
+            await asyncio.sleep(_retry_delay(attempt, retry_after))
+        return None
+
+    async def _download_and_validate(self, img_info: dict, min_size: int, referer: str) -> dict | None:
+        flights = self._scheduler.flights
+        key = (img_info["url"], referer, min_size, self._probe)
+        shared = flights.join(key)
+        if shared is not None:
+            # 別の取得が通信中: 終わるのを待って中身を分けてもらう
+            if self._stats is not None:
+                self._stats.add("coalesced")
+            data = await asyncio.wrap_future(shared)
+            if data is None:
+                return None
+            stored = await self._loop.run_in_executor(self._decode_pool, self._store.put, data)
+        else:
+            stored = None
+            try:
+                with _timed("image_download", host=urlparse(img_info["url"]).netloc) as rec:
+                    stored = await self._download(img_info["url"], referer, min_size, rec)
+            finally:
+                flights.finish(key, stored)
+            if stored is None:
+                return None
+        return await self._loop.run_in_executor(
+            self._decode_pool,
+            _validate_stored_image,
+            img_info,
+            stored,
+            min_size,
+            self._store,
+            self._stats,
+        )
+
+    def submit(self, img_info: dict, min_size: int, referer: str) -> Future:
+        return asyncio.run_coroutine_threadsafe(self._download_and_validate(img_info, min_size, referer), self._loop)
+
+
+def _open_downloader(
+    engine: str = DOWNLOAD_ENGINE_THREAD,
+    max_workers: int = 10,
+    per_host_limit: int = ASYNC_PER_HOST_LIMIT,
+    probe: bool = False,
+    stats: DownloadStats | None = None,
+    cache: ImageDiskCache | None = None,
+    store: ImageStore | None = None,
+    limiter: HostConcurrencyController | None = None,
+):
+    """ダウンロードエンジンを生成（with で使う）。asyncio の場合 max_workers は同時リクエスト数。
+
+    probe=True なら先頭バイトで寸法を判定し、フィルタに落ちる画像は本体を受信しない。
+    cache を渡すとディスクキャッシュを使い、キャッシュ済みの画像は条件付きリクエストで再検証する。
+    store は画像本体の置き場所（省略時は全てメモリ上）。
+    limiter（HostConcurrencyController）を渡すと、ホストごとの同時接続数とレートをそちらで制御する。
+    """
+    if engine == DOWNLOAD_ENGINE_ASYNCIO:
+        return _AsyncDownloader(
+            max_in_flight=max_workers,
+            per_host_limit=per_host_limit,
+            probe=probe,
+            stats=stats,
+            cache=cache,
+            store=store,
+            limiter=limiter,
+        )
+    return _ThreadDownloader(max_workers, probe=probe, stats=stats, cache=cache, store=store, limiter=limiter)
+
+
+def _future_result(future: Future) -> dict | None:
+    """完了済みの Future の結果（取り消し・例外・フィルタ除外なら None）"""
+    if not future.done() or future.cancelled() or future.exception() is not None:
+        return None
+    return future.result()
+
+
+class PerceptualHashIndex:
+    """dHash の近傍検索（ハミング距離 max_distance 以内）
+
+    ハッシュを max_distance+1 個のブロックに分けてブロックごとに索引を作る。距離が max_distance 以内なら
+    どれかのブロックは完全に一致する（鳩の巣原理）ので、同じブロック値を持つものだけを比べればよい。
+    """
+
+    def __init__(self, max_distance: int = DEDUPE_MAX_DISTANCE, bits: int = DHASH_SIZE * DHASH_SIZE):
+        self.max_distance = max_distance
+        n = max_distance + 1
+        bounds = [round(i * bits / n) for i in range(n + 1)]
+        self._blocks = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(bounds, bounds[1:])]
+        self._buckets: list[dict[int, list[int]]] = [{} for _ in self._blocks]
+        self._hashes: list[int] = []
+        self._values: list[int] = []
+
+    @property
+    def size(self) -> int:
+        return len(self._hashes)
+
+    def find(self, h: int) -> int | None:
+        """距離が max_distance 以内の登録済みハッシュのうち、最初に登録したものの値（なければ None）"""
+        best = None
+        seen: set[int] = set()
+        for (shift, mask), buckets in zip(self._blocks, self._buckets):
+            for i in buckets.get((h >> shift) & mask, ()):
+                if i in seen:
+                    continue
+                seen.add(i)
+                if (self._hashes[i] ^ h).bit_count() <= self.max_distance and (best is None or i < best):
+                    best = i
+        return self._values[best] if best is not None else None
+
+    def add(self, h: int, value: int) -> None:
+        i = len(self._hashes)
+        self._hashes.append(h)
+        self._values.append(value)
+        for (shift, mask), buckets in zip(self._blocks, self._buckets):
+            buckets.setdefault((h >> shift) & mask, []).append(i)
+
+
+def _similar_aspect(a: dict, b: dict, tolerance: float = 0.1) -> bool:
+    """縦横比がほぼ同じか（縮小版どうしは同じ、構図の似た別ページはたいてい違う）"""
+    ra = a["width"] / max(1, a["height"])
+    rb = b["width"] / max(1, b["height"])
+    return abs(ra - rb) <= tolerance * max(ra, rb)
+
+
+class _OrderedBudget:
+    """投入順に並んだダウンロード結果を先頭から数え、検証済みの画像が limit 枚そろったかを判定する
+
+    未完了のものがあればそこで数えるのをやめるので、打ち切っても先頭 limit 枚は必ずそろう。
+    limit=None なら上限なし。dedupe（PerceptualHashIndex）を渡すと、先に出てきた画像と
+    見た目がほぼ同じ画像は duplicates（位置 → 残す方の位置）に入れて数えない。
+    on_ready を渡すと、数え進めた画像（重複・上限より後ろを除く）を投入順にそのつど渡す。
+    """
+
+    def __init__(
+        self,
+        limit: int | None = None,
+        dedupe: PerceptualHashIndex | None = None,
+        on_ready: Callable[[list[dict]], None] | None = None,
+    ):
+        self.limit = limit
+        self.dedupe = dedupe
+        self.on_ready = on_ready
+        self.futures: list[Future] = []
+        self.duplicates: dict[int, int] = {}
+        self.cutoff: int | None = None
+        self._scanned = 0
+        self._found = 0
+
+    @property
+    def reached(self) -> bool:
+        return self.cutoff is not None
+
+    def add(self, future: Future) -> None:
+        self.futures.append(future)
+
+    def update(self) -> bool:
+        """完了済みの先頭部分を数え進め、上限に達していれば cutoff（これより後ろは不要）を確定する"""
+        if (self.limit is None and self.dedupe is None and self.on_ready is None) or self.cutoff is not None:
+            return self.reached
+        ready: list[dict] = []
+        while self._scanned < len(self.futures) and self.futures[self._scanned].done():
+            idx = self._scanned
+            self._scanned += 1
+            result = _future_result(self.futures[idx])
+            if not result or self._is_duplicate(idx, result):
+                continue
+            self._found += 1
+            ready.append(result)
+            if self.limit is not None and self._found >= self.limit:
+                self.cutoff = self._scanned
+                break
+        if ready and self.on_ready is not None:
+            self.on_ready(ready)
+        return self.reached
+
+    def _is_duplicate(self, idx: int, result: dict) -> bool:
+        h = result.get("dhash")
+        if self.dedupe is None or h is None:
+            return False
+        kept = self.dedupe.find(h)
+        if kept is not None and _similar_aspect(result, _future_result(self.futures[kept])):
+            self.duplicates[idx] = kept
+            return True
+        self.dedupe.add(h, idx)
+        return False
+
+    def satisfied(self, block: bool = False) -> bool:
+        """上限に達したか。block=True なら、投入済みの分だけで上限に届きうる間はその完了を待つ
+
+        巡回側から呼ぶと、足りるかどうか分かるまで次のページ・次の話を取りに行かない。
+        """
+        self.update()
+        while block and self.limit is not None and not self.reached:
+            unscanned = self.futures[self._scanned :]
+            possible = sum(1 for f in unscanned if not f.done() or _future_result(f))
+            if self._found + possible < self.limit:
+                break
+            wait([f for f in unscanned if not f.done()], return_when=FIRST_COMPLETED)
+            self.update()
+        return self.reached
+
+    def cancel_rest(self) -> int:
+        """cutoff より後ろの未着手・実行中のダウンロードを取り消し、取り消せた件数を返す"""
+        if self.cutoff is None:
+            return 0
+        return sum(1 for f in self.futures[self.cutoff :] if f.cancel())
+
+    def discard_rest(self, store: ImageStore | None) -> None:
+        """cutoff より後ろで取り消しが間に合わず完了した画像をストアから片付ける"""
+        if self.cutoff is None or store is None:
+            return
+        for f in self.futures[self.cutoff :]:
+            result = _future_result(f)
+            if result:
+                store.discard(result["stored"])
+
+    def discard_duplicates(self, store: ImageStore | None, stats: DownloadStats | None, debug: bool) -> None:
+        """重複として数えなかった画像をストアから片付け、まとめた件数を記録する"""
+        if not self.duplicates:
+            return
+        for idx in self.duplicates:
+            result = _future_result(self.futures[idx])
+            if store is not None and result:
+                store.discard(result["stored"])
+            if stats is not None and result:
+                stats.reject(result["url"])
+        if stats is not None:
+            stats.add("duplicates_collapsed", len(self.duplicates))
+        if debug:
+            _emit(f"🔁 見た目がほぼ同じ画像 {len(self.duplicates)}件をまとめました")
+
+
+def _record_budget_stop(budget: _OrderedBudget, stats: DownloadStats | None, debug: bool) -> None:
+    cancelled = budget.cancel_rest()
+    if stats is not None:
+        stats.add("budget_reached")
+        stats.add("budget_cancelled", cancelled)
+    if debug:
+        _emit(f"⏹️ 画像が上限の{budget.limit}枚に達したため、残り{cancelled}件のダウンロードを取り消しました")
+
+
+def _submit_download(
+    downloader,
+    img_info: dict,
+    min_size: int,
+    referer: str,
+    store: ImageStore | None = None,
+    checkpoint: "ExtractionCheckpoint | None" = None,
+) -> Future:
+    """1枚分のダウンロードを投入する。チェックポイントに記録済みの画像は完了済みの Future で返す"""
+    if checkpoint is not None and store is not None:
+        restored = checkpoint.restore_result(img_info, store)
+        if restored is not None:
+            future: Future = Future()
+            future.set_result(restored)
+            return future
+    future = downloader.submit(img_info, min_size, referer)
+    if checkpoint is not None:
+        future.add_done_callback(lambda f: checkpoint.record_future(img_info["url"], f))
+    return future
+
+
+def filter_manga_images(
+    images: list[dict],
+    min_size: int = 50_000,
+    referer: str = "",
+    debug: bool = False,
+    max_workers: int = 10,
+    progress_callback=None,
+    engine: str = DOWNLOAD_ENGINE_THREAD,
+    per_host_limit: int = ASYNC_PER_HOST_LIMIT,
+    probe: bool = False,
+    stats: DownloadStats | None = None,
+    cache: ImageDiskCache | None = None,
+    store: ImageStore | None = None,
+    max_images: int | None = None,
+    limiter: HostConcurrencyController | None = None,
+    checkpoint: "ExtractionCheckpoint | None" = None,
+    dedupe: bool = False,
+    on_ready: Callable[[list[dict]], None] | None = None,
+) -> list[dict]:
+    """漫画画像をフィルタリング（サイズ/縦横/アスペクト比）- 並列ダウンロード対応
+
+    engine="asyncio" の場合、max_workers は同時リクエスト数（スレッド数ではない）。
+    probe=True で先頭バイトによる事前判定を行う。stats を渡すと転送量などを集計する。
+    cache を渡すとディスクキャッシュ（ImageDiskCache）経由で取得する。
+    結果の "stored" は画像本体への参照（StoredImage）。store を渡すとメモリ上限を超えた分はディスクに置く。
+    max_images を渡すと、先頭から数えて max_images 枚そろった時点で残りのダウンロードを取り消す。
+    limiter を渡すとホストごとの同時接続数を自動調整する。
+    checkpoint を渡すとダウンロード結果を記録し、記録済みの画像は取得し直さない。
+    dedupe=True なら、先に出てきた画像と見た目がほぼ同じ画像（知覚ハッシュが近いもの）を除く。
+    on_ready を渡すと、結果に入る画像を、それより前の候補がすべて終わった時点で投入順に少しずつ渡す（プレビューの逐次表示用）。
+    """
+    manga_images: list[dict] = []
+    total = len(images)
+    completed = 0
+    budget = _OrderedBudget(max_images, PerceptualHashIndex() if dedupe else None, on_ready)
+
+    with _open_downloader(engine, max_workers, per_host_limit, probe=probe, stats=stats, cache=cache, store=store, limiter=limiter) as downloader:
+        future_to_img = {}
+        for img_info in images:
+            future = _submit_download(downloader, img_info, min_size, referer, store, checkpoint)
+            future_to_img[future] = img_info
+            budget.add(future)
+
+        for future in as_completed(future_to_img):
+            img_info = future_to_img[future]
+            completed += 1
+
+            if progress_callback:
+                progress_callback(completed, total)
+
+            try:
+                result = future.result()
+                if result:
+                    if debug:
+                        _emit(f"✅ 取得成功: {img_info['url'][:60]}...")
+                else:
+                    if debug:
+                        _emit(f"❌ フィルタ除外: {img_info['url'][:60]}...")
+            except Exception as e:
+                if debug:
+                    _emit(f"⚠️ エラー: {img_info['url'][:60]}... - {e}")
+
+            if budget.update():
+                _record_budget_stop(budget, stats, debug)
+                break
+    budget.update()
+    budget.discard_rest(store)
+    budget.discard_duplicates(store, stats, debug)
+
+    # as_completed より先に budget 側で数え終わった分もあるので、結果は Future から投入順に集める
+    for idx, future in enumerate(budget.futures[: budget.cutoff]):
+        result = _future_result(future)
+        if result and idx not in budget.duplicates:
+            manga_images.append(result)
+
+    if checkpoint is not None:
+        checkpoint.save(force=True)
+    return manga_images
+
+
+def extract_manga_images(
+    url: str,
+    num_episodes: int,
+    min_size: int = 50_000,
+    referer: str = "",
+    debug: bool = False,
+    max_workers: int = 10,
+    progress_callback=None,
+    engine: str = DOWNLOAD_ENGINE_THREAD,
+    per_host_limit: int = ASYNC_PER_HOST_LIMIT,
+    probe: bool = False,
+    stats: DownloadStats | None = None,
+    cache: ImageDiskCache | None = None,
+    store: ImageStore | None = None,
+    max_images: int | None = None,
+    limiter: HostConcurrencyController | None = None,
+    checkpoint: "ExtractionCheckpoint | None" = None,
+    dedupe: bool = False,
+    site_profiles: SiteProfileCache | None = None,
+    completed_episodes: list[dict] | None = None,
+    on_episode=None,
+    exclude_urls: set[str] | None = None,
+    on_ready: Callable[[list[dict]], None] | None = None,
+    page_cache: PageCache | None = None,
+    srcset_width: int | None = SRCSET_TARGET_WIDTH,
+) -> tuple[list[dict], list[dict]]:
+    """ページ巡回と画像ダウンロードを重ねて実行するパイプライン。
+
+    「次の話」を辿る巡回はこのスレッドで進め、ページごとに見つかった候補画像を
+    その場でダウンロード用スレッドプールに投入する。
+    progress_callback(completed, total, stage=...) の stage は "crawl"（巡回中）か "download"（巡回後）。
+    max_images を渡すと、先頭から数えて max_images 枚そろった時点で巡回を止め、残りのダウンロードを取り消す。
+    checkpoint を渡すと巡回済みの話とダウンロード結果を記録し、記録済みの分は取得し直さない。
+    dedupe=True なら、先に出てきた画像と見た目がほぼ同じ画像（別URLの扉絵・告知バナーなど）を除く。
+    site_profiles・completed_episodes・on_episode・page_cache・srcset_width は巡回（get_multiple_episodes_images）に渡す
+    （checkpoint があれば completed_episodes・on_episode はチェックポイントのものを使う）。
+    exclude_urls に含まれる URL の画像は候補に入れない（更新モードで取得済みの画像）。
+    on_ready は filter_manga_images と同じ（結果に入る画像を話・ページ順に少しずつ渡す）。
+    戻り値は (候補画像一覧, 漫画画像一覧)。どちらも話・ページ順。
+    """
+    candidates: list[dict] = []
+    budget = _OrderedBudget(max_images, PerceptualHashIndex() if dedupe else None, on_ready)
+    futures = budget.futures
+
+    def report(stage: str) -> None:
+        if progress_callback:
+            completed = sum(1 for f in futures if f.done())
+            progress_callback(completed, len(futures), stage=stage)
+
+    with _open_downloader(engine, max_workers, per_host_limit, probe=probe, stats=stats, cache=cache, store=store, limiter=limiter) as downloader:
+
+        def on_images(page_images: list[dict]) -> None:
+            for img_info in page_images:
+                if exclude_urls and img_info["url"] in exclude_urls:
+                    continue
+                candidates.append(img_info)
+                budget.add(_submit_download(downloader, img_info, min_size, referer, store, checkpoint))
+            budget.update()
+            report("crawl")
+
+        get_multiple_episodes_images(
+            url,
+            num_episodes,
+            debug=debug,
+            on_images=on_images,
+            should_stop=lambda: budget.satisfied(block=True),
+            completed_episodes=checkpoint.episodes if checkpoint is not None else completed_episodes,
+            on_episode=checkpoint.add_episode if checkpoint is not None else on_episode,
+            site_profiles=site_profiles,
+            page_cache=page_cache,
+            srcset_width=srcset_width,
+        )
+
+        total = len(futures)
+        completed = sum(1 for f in futures if f.done())
+        if progress_callback and total:
+            progress_callback(completed, total, stage="download")
+        if not budget.update():
+            pending = [f for f in futures if not f.done()]
+            for _ in as_completed(pending):
+                completed += 1
+                if progress_callback:
+                    progress_callback(completed, total, stage="download")
+                if budget.update():
+                    break
+        if budget.reached:
+            _record_budget_stop(budget, stats, debug)
+    budget.update()
+    budget.discard_rest(store)
+    budget.discard_duplicates(store, stats, debug)
+
+    manga_images: list[dict] = []
+    for idx, (img_info, future) in enumerate(zip(candidates[: budget.cutoff], futures[: budget.cutoff])):
+        try:
+            result = future.result()
+        except Exception as e:
+            if debug:
+                _emit(f"⚠️ エラー: {img_info['url'][:60]}... - {e}")
+            continue
+        if idx in budget.duplicates:
+            if debug:
+                _emit(f"🔁 重複のため除外: {img_info['url'][:60]}...（{budget.duplicates[idx] + 1}件目と同じ画像）")
+        elif result:
+            manga_images.append(result)
+            if debug:
+                _emit(f"✅ 取得成功: {img_info['url'][:60]}...")
+        elif debug:
+            _emit(f"❌ フィルタ除外: {img_info['url'][:60]}...")
+
+    if checkpoint is not None:
+        checkpoint.save(force=True)
+    return candidates, manga_images
+
+
+def _guess_ext(img_file: bytes | BinaryIO, fallback_ext: str = ".jpg") -> str:
+    try:
+        img = Image.open(BytesIO(img_file) if isinstance(img_file, bytes) else img_file)
+        fmt = (img.format or "").upper()
+        if fmt == "JPEG":
+            return ".jpg"
+        if fmt == "PNG":
+            return ".png"
+        if fmt == "WEBP":
+            return ".webp"
+        if fmt == "GIF":
+            return ".gif"
+        if fmt == "AVIF":
+            return ".avif"
+    except Exception:
+        pass
+    return fallback_ext
+
+
+# 既に圧縮済みの形式は再圧縮しても縮まないので無圧縮（ZIP_STORED）で格納する
+PRECOMPRESSED_EXTS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif"}
+
+
+def _zip_compression_for(rel_path: str) -> int:
+    ext = os.path.splitext(rel_path)[1].lower()
+    return zipfile.ZIP_STORED if ext in PRECOMPRESSED_EXTS else zipfile.ZIP_DEFLATED
+
+
+def _image_rel_path(img: dict, idx: int) -> str:
+    """ZIP・output/ 共通のファイル名（images/ep01_p001_0001.jpg など）"""
+    ep = int(img.get("episode", 1) or 1)
+    page = int(img.get("page", 1) or 1)
+    stored = img.get("stored")
+    with stored.open() if stored is not None else BytesIO(img.get("data") or b"") as f:
+        ext = _guess_ext(f)
+    return f"images/ep{ep:02d}_p{page:03d}_{idx:04d}{ext}"
+
+
+def image_name_map(manga_images: list[dict]) -> dict[str, str]:
+    """filename_map[url]=zip内パス（ZIP を作らずに output/ へ保存するとき用）"""
+    return {img.get("url", f"idx:{idx}"): _image_rel_path(img, idx) for idx, img in enumerate(manga_images, start=1)}
+
+
+def write_images_zip(manga_images: list[dict], fp) -> dict[str, str]:
+    """画像を1枚ずつ fp（書き込み可能なファイル）へZIPとして書き出す。戻り値は filename_map[url]=zip内パス"""
+    name_map: dict[str, str] = {}
+
+    with _timed("zip") as rec, zipfile.ZipFile(fp, mode="w") as zf:
+        for idx, img in enumerate(manga_images, start=1):
+            rel = _image_rel_path(img, idx)
+            zinfo = zipfile.ZipInfo(rel, date_time=time.localtime()[:6])
+            zinfo.compress_type = _zip_compression_for(rel)
+            zinfo.external_attr = 0o644 << 16
+            # ディスク上の画像はチャンク単位でコピーし、1枚分もまとめてメモリに載せない
+            with zf.open(zinfo, mode="w") as dst:
+                for chunk in iter_image_chunks(img):
+                    dst.write(chunk)
+            rec["bytes"] = rec.get("bytes", 0) + zinfo.file_size
+            name_map[img.get("url", f"idx:{idx}")] = rel
+
+    return name_map
+
+
+def build_images_zip(manga_images: list[dict]) -> tuple[bytes, dict[str, str]]:
+    """画像をZIP化して返す。戻り値は(zip_bytes, filename_map[url]=zip内パス)"""
+    buf = BytesIO()
+    name_map = write_images_zip(manga_images, buf)
+    return buf.getvalue(), name_map
+
+
+def build_images_zip_file(manga_images: list[dict]) -> tuple[BinaryIO, dict[str, str]]:
+    """画像ZIPを一時ファイルに書き出し、読み取り用に開いたファイルを返す（ZIP全体をメモリに持たない）
+
+    Streamlit の download_button はディスク上のファイル（BufferedReader）をそのまま受け取れる。
+    """
+    fd, path = tempfile.mkstemp(prefix="manga_images_", suffix=".zip")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            name_map = write_images_zip(manga_images, f)
+        zip_file = open(path, "rb")
+    finally:
+        # 開いたハンドルは削除後も読める（削除できない環境では一時ディレクトリに残る）
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return zip_file, name_map
+
+
+# プレビュー用サムネイルの JPEG 品質・キャッシュ上限・生成プロセス数
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_CACHE_MAX_MB = 64
+THUMBNAIL_WORKERS = 4
+
+
+def image_sha256(img: dict) -> str:
+    stored = img.get("stored")
+    if stored is not None:
+        return stored.sha256
+    return hashlib.sha256(img.get("data") or b"").hexdigest()
+
+
+def _image_source(img: dict):
+    """プロセスプールに渡す元データ。ディスク上の画像はパスだけ渡し、本体をプロセス間で送らない"""
+    stored = img.get("stored")
+    if stored is not None and stored.on_disk:
+        return (stored.path, stored.offset, stored.length)
+    return image_bytes(img)
+
+
+def _read_image_source(src: bytes | tuple[str, int, int]) -> bytes:
+    if isinstance(src, tuple):
+        path, offset, length = src
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+    return src
+
+
+def _make_thumbnail(src: bytes | tuple[str, int, int], width: int) -> bytes | None:
+    """幅 width に縮小した JPEG を返す（プロセスプールから呼ぶのでトップレベルに置く）"""
+    try:
+        img = Image.open(BytesIO(_read_image_source(src)))
+        if img.width > width:
+            size = (width, max(1, round(img.height * width / img.width)))
+            # JPEG はデコード時に 1/2〜1/8 へ縮小し（draft）、残りは整数倍の縮小（reduce）で詰める
+            img.draft("RGB", size)
+            factor = min(img.width // size[0], img.height // size[1])
+            if factor >= 2:
+                img = img.reduce(factor)
+            img = img.resize(size, Image.Resampling.LANCZOS)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = BytesIO()
+        img.save(out, format="JPEG", quality=THUMBNAIL_QUALITY)
+        return out.getvalue()
+    except Exception:
+        return None
+
+
+class ThumbnailCache:
+    """(内容の sha256, 幅) → サムネイルのメモリ上 LRU キャッシュ"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = int(max_bytes)
+        self._items: OrderedDict[tuple[str, int], bytes] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple[str, int]) -> bytes | None:
+        with self._lock:
+            thumb = self._items.get(key)
+            if thumb is not None:
+                self._items.move_to_end(key)
+            return thumb
+
+    def put(self, key: tuple[str, int], thumb: bytes) -> None:
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._items[key] = thumb
+            self._bytes += len(thumb)
+            while self._bytes > self.max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_thumbnail_cache(max_mb: int = THUMBNAIL_CACHE_MAX_MB) -> ThumbnailCache:
+    return ThumbnailCache(int(max_mb) * 1024 * 1024)
+
+
+def _new_process_pool(max_workers: int):
+    """画像処理用のプロセスプール（fork が使えない環境ではスレッドプール）"""
+    if "fork" in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("fork"))
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_thumbnail_pool(max_workers: int = THUMBNAIL_WORKERS):
+    """サムネイル生成用のプロセスプール"""
+    return _new_process_pool(max_workers)
+
+
+def make_thumbnails(
+    images: list[dict],
+    width: int,
+    cache: ThumbnailCache | None = None,
+    executor=None,
+) -> list[bytes | None]:
+    """画像ごとのサムネイル（生成に失敗したものは None）。キャッシュに無いものだけ並列に生成する"""
+    executor = executor if executor is not None else _get_thumbnail_pool()
+    thumbs: list[bytes | None] = [None] * len(images)
+    pending: dict[int, tuple[tuple[str, int], Future]] = {}
+    for i, img in enumerate(images):
+        key = (image_sha256(img), int(width))
+        thumb = cache.get(key) if cache else None
+        if thumb is not None:
+            thumbs[i] = thumb
+        else:
+            pending[i] = (key, executor.submit(_make_thumbnail, _image_source(img), int(width)))
+    for i, (key, future) in pending.items():
+        try:
+            thumb = future.result()
+        except Exception:
+            thumb = None
+        thumbs[i] = thumb
+        if thumb is not None and cache:
+            cache.put(key, thumb)
+    return thumbs
+
+
+# 出力画像の再エンコード（変換先の形式・既定の品質・プロセス数）
+TRANSCODE_WEBP = "webp"
+TRANSCODE_AVIF = "avif"
+TRANSCODE_FORMATS = (TRANSCODE_WEBP, TRANSCODE_AVIF)
+TRANSCODE_QUALITY = 80
+TRANSCODE_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+# 白黒とみなす色のばらつき（RGB の最大値と最小値の差の 99 パーセンタイル）
+MONOCHROME_TOLERANCE = 16
+
+
+def transcode_available(fmt: str) -> bool:
+    """この環境の Pillow で fmt に書き出せるか（AVIF は Pillow 11.2 以降かつ libavif 付きのビルドが必要）"""
+    try:
+        return fmt in TRANSCODE_FORMATS and bool(features.check(fmt))
+    except ValueError:
+        return False
+
+
+def _is_monochrome(img: Image.Image) -> bool:
+    """色がほぼ無い（白黒の漫画ページなど）か。縮小してから RGB の差を見る"""
+    if img.mode in ("1", "L"):
+        return True
+    if img.mode not in ("RGB", "P", "YCbCr", "CMYK"):
+        return False
+    small = img.convert("RGB")
+    small.thumbnail((256, 256))
+    rgb = np.asarray(small, dtype=np.int16)
+    spread = rgb.max(axis=2) - rgb.min(axis=2)
+    return float(np.percentile(spread, 99)) <= MONOCHROME_TOLERANCE
+
+
+def _transcode_image(
+    src: bytes | tuple[str, int, int], fmt: str, quality: int, max_width: int | None, grayscale: bool
+) -> dict | None:
+    """fmt で再エンコードした結果（data・幅・高さ・白黒にしたか・処理秒数）。アニメーションや読めない画像は None
+
+    プロセスプールから呼ぶのでトップレベルに置く。
+    """
+    started = time.perf_counter()
+    try:
+        img = Image.open(BytesIO(_read_image_source(src)))
+        if getattr(img, "is_animated", False):
+            return None
+        if max_width and img.width > max_width:
+            size = (max_width, max(1, round(img.height * max_width / img.width)))
+            img.draft("RGB", size)
+            img = img.resize(size, Image.Resampling.LANCZOS)
+        mono = grayscale and _is_monochrome(img)
+        if mono:
+            img = img.convert("L")
+        elif img.mode not in ("RGB", "RGBA", "L", "LA"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+        out = BytesIO()
+        img.save(out, format=fmt.upper(), quality=int(quality))
+        return {
+            "data": out.getvalue(),
+            "width": img.width,
+            "height": img.height,
+            "grayscale": mono,
+            "seconds": time.perf_counter() - started,
+        }
+    except Exception:
+        return None
+
+
+def transcode_images(
+    manga_images: list[dict],
+    fmt: str = TRANSCODE_WEBP,
+    quality: int = TRANSCODE_QUALITY,
+    max_width: int | None = None,
+    grayscale: bool = True,
+    store: ImageStore | None = None,
+    executor=None,
+    progress_callback=None,
+) -> dict:
+    """抽出した画像を fmt（WebP / AVIF）に再エンコードして差し替える（ZIP・保存の前に呼ぶ）
+
+    プロセスプールで並列に変換し、元より小さくなった画像だけを置き換える（元の大きさは "original_size" に残す）。
+    grayscale=True なら色の無いページをグレースケールで書き出し、max_width を渡すとそれより広い画像を縮小する。
+    戻り値は変換前後の合計バイト数と処理速度の集計。
+    """
+    if not transcode_available(fmt):
+        raise RuntimeError(f"{fmt} への変換はこの環境の Pillow では使えません")
+    store = store if store is not None else ImageStore()
+    executor = executor if executor is not None else _get_transcode_pool()
+    profile = getattr(_event_sink, "profile", None)
+    summary = {"format": fmt, "images": len(manga_images), "transcoded": 0, "grayscale": 0, "kept_original": 0, "skipped": 0}
+    bytes_before = bytes_after = 0
+    started = time.perf_counter()
+    futures = [
+        executor.submit(_transcode_image, _image_source(img), fmt, int(quality), max_width, grayscale)
+        for img in manga_images
+    ]
+    for i, (img, future) in enumerate(zip(manga_images, futures), start=1):
+        original_size = int(img.get("size") or len(image_bytes(img)))
+        try:
+            result = future.result()
+        except Exception:
+            result = None
+        bytes_before += original_size
+        if result is None:
+            summary["skipped"] += 1
+            bytes_after += original_size
+        elif len(result["data"]) >= original_size:
+            # 元の方が小さければそのまま使う
+            summary["kept_original"] += 1
+            bytes_after += original_size
+        else:
+            # 元画像は消さない（ジョブではチェックポイントから参照されている）
+            img["stored"] = store.put(result["data"])
+            img.pop("data", None)
+            img.update(
+                size=len(result["data"]),
+                width=result["width"],
+                height=result["height"],
+                original_size=original_size,
+                transcoded=fmt,
+            )
+            summary["transcoded"] += 1
+            summary["grayscale"] += int(result["grayscale"])
+            bytes_after += len(result["data"])
+        if result is not None and profile is not None:
+            profile.observe("transcode", result["seconds"], nbytes=len(result["data"]))
+        if progress_callback:
+            progress_callback(i, len(manga_images), stage="transcode")
+    elapsed = time.perf_counter() - started
+    summary.update(
+        bytes_before=bytes_before,
+        bytes_after=bytes_after,
+        reduction=round(1 - bytes_after / bytes_before, 4) if bytes_before else 0.0,
+        seconds=round(elapsed, 3),
+        images_per_s=round(len(manga_images) / elapsed, 2) if elapsed else 0.0,
+        mb_per_s=round(bytes_before / elapsed / 1024 / 1024, 2) if elapsed else 0.0,
+    )
+    return summary
+
+
+@functools.lru_cache(maxsize=None)
+def _get_transcode_pool(max_workers: int = TRANSCODE_WORKERS):
+    """再エンコード用のプロセスプール"""
+    return _new_process_pool(max_workers)
+
+
+def count_episode_images(manga_images: list[dict]) -> dict[int, int]:
+    """話数ごとの枚数"""
+    counts: dict[int, int] = {}
+    for img in manga_images:
+        ep = int(img.get("episode", 1) or 1)
+        counts[ep] = counts.get(ep, 0) + 1
+    return counts
+
+
+def build_image_items(manga_images: list[dict], name_map: dict[str, str]) -> list[dict]:
+    """images.json 用の一覧（URLとメタ情報）"""
+    items = []
+    for img in manga_images:
+        items.append(
+            {
+                "episode": int(img.get("episode", 1) or 1),
+                "page": int(img.get("page", 1) or 1),
+                "url": img.get("url", ""),
+                "alt": img.get("alt", ""),
+                "width": int(img.get("width", 0) or 0),
+                "height": int(img.get("height", 0) or 0),
+                "size_bytes": int(img.get("size", 0) or 0),
+                "zip_path": name_map.get(img.get("url", ""), ""),
+            }
+        )
+    return items
+
+
+def save_run_output(
+    run_dir: str,
+    manga_images: list[dict],
+    name_map: dict[str, str],
+    meta: dict,
+    profile: RunProfile | None = None,
+) -> None:
+    """output/<run_id>/ に images/・images.json・meta.json を書き出す（profile を渡すと meta.json に "profile" として含める）"""
+    img_dir = os.path.join(run_dir, "images")
+    os.makedirs(img_dir, exist_ok=True)
+
+    with profile_run(profile or getattr(_event_sink, "profile", None)), _timed("save") as rec:
+        # 画像ファイル保存
+        for img in manga_images:
+            zp = name_map.get(img.get("url", ""), "")
+            if not zp.startswith("images/"):
+                continue
+            rel_name = zp[len("images/") :]
+            out_path = os.path.join(img_dir, rel_name)
+            with open(out_path, "wb") as f:
+                for chunk in iter_image_chunks(img):
+                    f.write(chunk)
+                rec["bytes"] = rec.get("bytes", 0) + f.tell()
+
+        with open(os.path.join(run_dir, "images.json"), "w", encoding="utf-8") as f:
+            json.dump(build_image_items(manga_images, name_map), f, ensure_ascii=False, indent=2)
+    if profile is not None:
+        meta = {**meta, "profile": profile.as_dict()}
+    with open(os.path.join(run_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+
+# 連載ごとの話の一覧の保存先。環境変数 MANGA_SERIES_INDEX_DIR で変更できる
+def _get_series_index_dir() -> str:
+    return os.environ.get("MANGA_SERIES_INDEX_DIR") or os.path.join(_get_output_base_dir(), ".cache", "series")
+
+
+class SeriesIndex:
+    """連載ごとの話の一覧（話のURLの連なり・ページ・画像URLとハッシュ・最初と最後に見た時刻）を記録する JSON ファイル
+
+    開始URLごとに1ファイル。更新モードでは、最後に記録した話から巡回し直して新しい話と画像だけを取得する
+    （最後の話は「次の話」リンクが増えているかもしれないので取り直す）。
+    """
+
+    def __init__(self, path: str, start_url: str = ""):
+        self.path = path
+        self.start_url = start_url
+        self.episodes: list[dict] = []
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.start_url = data.get("start_url") or start_url
+            self.episodes = data.get("episodes", [])
+        except (OSError, ValueError):
+            pass
+
+    @classmethod
+    def for_url(cls, start_url: str) -> "SeriesIndex":
+        return cls(os.path.join(_get_series_index_dir(), _sha256_text(start_url)[:16] + ".json"), start_url)
+
+    @staticmethod
+    def _settled(img: dict) -> bool:
+        """取得済み（sha256 あり）か、フィルタで除いた画像。失敗・取り消しになった画像は更新モードで取り直す"""
+        return bool(img.get("sha256") or img.get("rejected"))
+
+    def image_urls(self) -> set[str]:
+        """更新モードで候補から外す画像の URL（取得済みか、フィルタで除いたもの）"""
+        with self._lock:
+            return {img["url"] for record in self.episodes for img in record.get("images", []) if self._settled(img)}
+
+    def update_plan(self, num_new_episodes: int) -> tuple[list[dict], int]:
+        """更新モードの (completed_episodes, 巡回する話数)。最後の話を除く記録済みの話を "known" として渡す
+
+        "known" の記録の images は、前回取得できなかった画像（取り直す候補）だけにする。
+        """
+        with self._lock:
+            known = [
+                {
+                    **record,
+                    "known": True,
+                    "images": [
+                        {"url": img["url"], "page": img.get("page"), "page_url": img.get("page_url"), "episode": record["episode"]}
+                        for img in record.get("images", [])
+                        if not self._settled(img)
+                    ],
+                }
+                for record in self.episodes[:-1]
+            ]
+            return known, len(self.episodes) + int(num_new_episodes) if self.episodes else int(num_new_episodes)
+
+    def update_plan_for(self, num_new_episodes: int) -> dict:
+        """ジョブの params に記録する更新モードの計画（JSON にできる形）。再開しても同じ計画で続ける"""
+        known, num_episodes = self.update_plan(num_new_episodes)
+        with self._lock:
+            episode_urls = [record["url"] for record in self.episodes]
+        return {
+            "completed_episodes": known,
+            "num_episodes": num_episodes,
+            "exclude_urls": sorted(self.image_urls()),
+            "episode_urls": episode_urls,
+        }
+
+    def merge(
+        self,
+        records: list[dict],
+        manga_images: list[dict],
+        plan: dict | None = None,
+        rejected_urls: set[str] | None = None,
+    ) -> dict:
+        """巡回した話の記録（on_episode の形）と抽出結果を取り込む。戻り値は記録済みの話数と、新しく増えた話・画像の件数
+
+        plan（update_plan_for の戻り値）を渡すと、取り込む前の記録ではなくジョブを作ったときの記録と比べて数える
+        （再開したジョブが、前回取り込んだ自分の分を「増えていない」と数えないように）。
+        rejected_urls（DownloadStats.rejected_urls）の画像は "rejected" として記録し、更新モードでも取り直さない。
+        """
+        accepted = {img["url"]: img for img in manga_images}
+        rejected_urls = rejected_urls or set()
+        now = datetime.now().isoformat(timespec="seconds")
+        new_episodes = 0
+        with self._lock:
+            if plan is not None:
+                known_urls = set(plan["exclude_urls"])
+                known_episode_urls = set(plan["episode_urls"])
+            else:
+                known_urls = {img["url"] for record in self.episodes for img in record.get("images", []) if self._settled(img)}
+                known_episode_urls = {record["url"] for record in self.episodes}
+            by_url = {record["url"]: record for record in self.episodes}
+            for record in records:
+                if record.get("known"):
+                    continue
+                old = by_url.get(record["url"])
+                old_images = {img["url"]: img for img in old.get("images", [])} if old else {}
+                images = []
+                for img in record["images"]:
+                    # 今回ダウンロードしていない画像（取得済みで候補から外したもの）は前回の記録を引き継ぐ
+                    images.append(
+                        {
+                            **old_images.get(img["url"], {}),
+                            "url": img["url"],
+                            "page": img.get("page"),
+                            "page_url": img.get("page_url"),
+                        }
+                    )
+                by_url[record["url"]] = {
+                    "episode": record["episode"],
+                    "url": record["url"],
+                    "next_url": record.get("next_url"),
+                    "pages": record.get("pages", []),
+                    "images": images,
+                    "first_seen": old.get("first_seen", now) if old else now,
+                    "last_seen": now,
+                }
+                new_episodes += record["url"] not in known_episode_urls
+            self.episodes = sorted(by_url.values(), key=lambda r: r["episode"])
+            # 取り直した画像は巡回し直していない話（"known"）にもあるので、結果は全話の記録に当てはめる
+            for record in self.episodes:
+                for entry in record["images"]:
+                    kept = accepted.get(entry["url"])
+                    if kept is not None:
+                        entry.pop("rejected", None)
+                        entry.update(
+                            sha256=image_sha256(kept),
+                            size=int(kept.get("size", 0) or 0),
+                            width=int(kept.get("width", 0) or 0),
+                            height=int(kept.get("height", 0) or 0),
+                        )
+                    elif entry["url"] in rejected_urls:
+                        entry["rejected"] = True
+            return {
+                "known_episodes": len(self.episodes) - new_episodes,
+                "new_episodes": new_episodes,
+                "new_images": sum(1 for url in accepted if url not in known_urls),
+            }
+
+    def save(self) -> None:
+        with self._lock:
+            data = {
+                "start_url": self.start_url,
+                "updated_at": datetime.now().isoformat(timespec="seconds"),
+                "episodes": self.episodes,
+            }
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+
+# バックグラウンドジョブの作業場所（output/.jobs/<job_id>/）と、終わったジョブを残しておく時間・件数
+JOBS_DIR_NAME = ".jobs"
+JOB_RETENTION_HOURS = 24
+JOBS_KEEP_IN_MEMORY = 8
+# チェックポイントを書き出す最短間隔（秒）。話の区切りと終了時は必ず書き出す
+CHECKPOINT_SAVE_INTERVAL = 1.0
+JOB_MODE_PIPELINE = "pipeline"
+JOB_MODE_TWO_STAGE = "two_stage"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_ERROR = "error"
+
+
+def _get_jobs_dir() -> str:
+    return os.path.join(_get_output_base_dir(), JOBS_DIR_NAME)
+
+
+class ExtractionCheckpoint:
+    """1回の抽出の途中経過（巡回済みの話・ページと、ダウンロード済みの画像）を記録する JSON ファイル
+
+    画像はチェックポイントと同じディレクトリ配下のファイルを相対パスで記録する（メモリ上の画像は記録しない）。
+    終わったジョブは最終結果（outputs）も記録し、読み込み直したときに再実行せずそのまま返せるようにする。
+    書き込みは一時ファイル経由で置き換えるので、途中で落ちても前回の内容は壊れない。
+    """
+
+    def __init__(self, path: str, params: dict | None = None):
+        self.path = path
+        self.root = os.path.dirname(path)
+        self.params = dict(params or {})
+        self.status = JOB_RUNNING
+        self.episodes: list[dict] = []
+        self.results: dict[str, dict] = {}
+        self.outputs: dict = {}
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.params = data.get("params") or self.params
+            self.status = data.get("status", JOB_RUNNING)
+            self.episodes = data.get("episodes", [])
+            self.results = data.get("results", {})
+            self.outputs = data.get("outputs", {})
+
+    def save(self, force: bool = False) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_save < CHECKPOINT_SAVE_INTERVAL:
+                return
+            self._last_save = now
+            data = {
+                "params": self.params,
+                "status": self.status,
+                "updated_at": datetime.now().isoformat(timespec="seconds"),
+                "episodes": self.episodes,
+                "results": self.results,
+                "outputs": self.outputs,
+            }
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+    def add_episode(self, record: dict) -> None:
+        """巡回し終えた1話分（get_multiple_episodes_images の on_episode）"""
+        with self._lock:
+            self.episodes.append({**record, "images": [dict(img) for img in record["images"]]})
+        self.save(force=True)
+
+    def record_future(self, url: str, future: Future) -> None:
+        """ダウンロードが終わった画像を記録（取り消し・失敗・フィルタ除外は記録せず、再開時に取り直す）"""
+        if future.cancelled():
+            return
+        result = _future_result(future)
+        if not result or not result["stored"].on_disk:
+            return
+        stored = result["stored"]
+        with self._lock:
+            self.results[url] = {
+                "path": os.path.relpath(stored.path, self.root),
+                "length": stored.length,
+                "sha256": stored.sha256,
+                "width": result.get("width"),
+                "height": result.get("height"),
+                "size": result.get("size"),
+                "dhash": result.get("dhash"),
+            }
+        self.save()
+
+    def restore_result(self, img_info: dict, store: ImageStore) -> dict | None:
+        """記録済みでファイルも残っていれば、ダウンロード結果と同じ形の dict を返す"""
+        with self._lock:
+            entry = self.results.get(img_info["url"])
+        if entry is None:
+            return None
+        path = os.path.join(self.root, entry["path"])
+        try:
+            if os.path.getsize(path) < entry["length"]:
+                return None
+        except OSError:
+            return None
+        stored = StoredImage(entry["length"], path=path, sha256=entry.get("sha256", ""), owner=store)
+        return {
+            **img_info,
+            "stored": stored,
+            "width": entry["width"],
+            "height": entry["height"],
+            "size": entry["size"],
+            "dhash": entry.get("dhash"),
+        }
+
+    def dump_images(self, images: list[dict]) -> list[dict]:
+        """結果の画像を JSON に書ける形にする（画像の中身は相対パスで参照）"""
+        dumped = []
+        for img in images:
+            entry = {k: v for k, v in img.items() if k not in ("stored", "data")}
+            stored = img.get("stored")
+            if stored is not None and stored.on_disk:
+                entry["stored"] = {
+                    "path": os.path.relpath(stored.path, self.root),
+                    "length": stored.length,
+                    "sha256": stored.sha256,
+                }
+            dumped.append(entry)
+        return dumped
+
+    def load_images(self, entries: list[dict], store: ImageStore) -> list[dict]:
+        """dump_images の逆。ファイルが消えている画像は落とす"""
+        images = []
+        for entry in entries:
+            img = dict(entry)
+            stored = img.pop("stored", None)
+            if stored is not None:
+                path = os.path.join(self.root, stored["path"])
+                if not os.path.exists(path):
+                    continue
+                img["stored"] = StoredImage(stored["length"], path=path, sha256=stored["sha256"], owner=store)
+            images.append(img)
+        return images
+
+    def finish(self, status: str, outputs: dict | None = None) -> None:
+        self.status = status
+        if outputs is not None:
+            self.outputs = outputs
+        self.save(force=True)
+
+
+class ExtractionJob:
+    """抽出をバックグラウンドのスレッドで実行するジョブ
+
+    画像は job_dir/store/ に書き出し、途中経過は job_dir/checkpoint.json に記録する。
+    params を省略すると既存のチェックポイントの設定で続きから再開する（プロセスが落ちた後など）。
+    チェックポイントが終わったジョブのものなら、記録した結果を読み込むだけで実行はしない。
+    """
+
+    def __init__(self, job_id: str, job_dir: str, params: dict | None = None):
+        self.job_id = job_id
+        self.job_dir = job_dir
+        store_dir = os.path.join(job_dir, "store")
+        os.makedirs(store_dir, exist_ok=True)
+        self.checkpoint = ExtractionCheckpoint(os.path.join(job_dir, "checkpoint.json"), params)
+        self.params = self.checkpoint.params
+        self.resumed = bool(self.checkpoint.episodes or self.checkpoint.results)
+        if params is not None and self.params.get("update"):
+            # 更新モードの計画は作成時に決めて残す（再開時に、取り込み済みの自分の分まで除外しないように）
+            self._plan_update()
+        self.status = JOB_RUNNING
+        self.error: str | None = None
+        self.progress = {"stage": "crawl", "completed": 0, "total": 0}
+        self.candidates: list[dict] = []
+        self.manga_images: list[dict] = []
+        self.preview: list[dict] = []  # 実行中に、結果に入ると決まった画像（話・ページ順）
+        self.first_image_at: float | None = None
+        self.events: list[tuple[str, str]] = []
+        self.stats = DownloadStats()
+        self.profile = RunProfile()
+        self.store = ImageStore(memory_budget=0, root=store_dir)
+        self.limiter: HostConcurrencyController | None = None
+        self.cache: ImageDiskCache | None = None
+        self.cache_counts_before: dict[str, int] = {}
+        self.site_profiles: SiteProfileCache | None = None
+        self.page_cache: PageCache | None = None
+        self.page_cache_counts_before: dict[str, int] = {}
+        self.transcode_summary: dict | None = None
+        self.series_update: dict | None = None
+        self.started_at = time.time()
+        self.finished_at: float | None = None
+        self._zip: tuple[str, dict[str, str]] | None = None
+        self._zip_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=f"extract-{job_id}", daemon=True)
+        if self.checkpoint.status != JOB_RUNNING:
+            self._restore_outputs()
+
+    @property
+    def done(self) -> bool:
+        return self.status != JOB_RUNNING
+
+    def start(self) -> "ExtractionJob":
+        if self.done:
+            return self
+        self.checkpoint.save(force=True)
+        self._thread.start()
+        return self
+
+    def _plan_update(self) -> dict:
+        plan = SeriesIndex.for_url(self.params["url"]).update_plan_for(int(self.params.get("num_episodes", 1)))
+        self.params["update_plan"] = plan
+        if not self.checkpoint.episodes:
+            self.checkpoint.episodes = list(plan["completed_episodes"])
+        return plan
+
+    def _restore_outputs(self) -> None:
+        """終わったジョブの結果をチェックポイントから読み込む（読み取り専用）"""
+        out = self.checkpoint.outputs
+        self.resumed = False
+        self.status = self.checkpoint.status
+        self.error = out.get("error")
+        self.candidates = out.get("candidates", [])
+        self.manga_images = self.checkpoint.load_images(out.get("manga_images", []), self.store)
+        self.preview = list(self.manga_images)
+        self.events = [tuple(event) for event in out.get("events", [])]
+        for key, value in out.get("stats", {}).items():
+            self.stats.add(key, value)
+        self.transcode_summary = out.get("transcode_summary")
+        self.series_update = out.get("series_update")
+        self.started_at = out.get("started_at", self.started_at)
+        self.finished_at = out.get("finished_at", self.started_at)
+        self.first_image_at = out.get("first_image_at")
+        self.progress = {"stage": "download", "completed": len(self.manga_images), "total": len(self.manga_images)}
+        self.profile.stop()
+
+    def _outputs(self) -> dict:
+        return {
+            "error": self.error,
+            "candidates": self.candidates,
+            "manga_images": self.checkpoint.dump_images(self.manga_images),
+            "events": self.events,
+            "stats": self.stats.as_dict(),
+            "transcode_summary": self.transcode_summary,
+            "series_update": self.series_update,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "first_image_at": self.first_image_at,
+        }
+
+    def join(self, timeout: float | None = None) -> None:
+        if self._thread.ident is not None:
+            self._thread.join(timeout)
+
+    def images_zip(self) -> tuple[str, dict[str, str]]:
+        """結果の画像ZIP（job_dir/images.zip）のパスと name_map。画面の再実行のたびに作り直さないよう初回だけ書き出す"""
+        with self._zip_lock:
+            if self._zip is None:
+                path = os.path.join(self.job_dir, "images.zip")
+                with open(path + ".tmp", "wb") as f, profile_run(self.profile):
+                    name_map = write_images_zip(self.manga_images, f)
+                os.replace(path + ".tmp", path)
+                self._zip = (path, name_map)
+            return self._zip
+
+    def _on_progress(self, completed: int, total: int, stage: str = "download") -> None:
+        self.progress = {"stage": stage, "completed": completed, "total": total}
+
+    def _on_ready(self, images: list[dict]) -> None:
+        if self.first_image_at is None:
+            self.first_image_at = time.time()
+        self.preview.extend(images)
+
+    def _run(self) -> None:
+        _event_sink.events = self.events
+        _event_sink.profile = self.profile
+        try:
+            self._extract()
+            self.status = JOB_DONE
+        except Exception as e:
+            logger.exception("ジョブが失敗しました: %s", self.params.get("url"))
+            self.error = str(e)
+            self.status = JOB_ERROR
+        finally:
+            self.finished_at = time.time()
+            self.profile.stop()
+            self.checkpoint.finish(self.status, self._outputs())
+            _event_sink.events = None
+            _event_sink.profile = None
+
+    def _extract(self) -> None:
+        p = self.params
+        url = p["url"]
+        debug = bool(p.get("debug", False))
+        engine = p.get("engine", DOWNLOAD_ENGINE_THREAD)
+        max_workers = int(p.get("max_workers", 10))
+        per_host_limit = int(p.get("per_host_limit", ASYNC_PER_HOST_LIMIT))
+        srcset_width = int(p.get("srcset_width", SRCSET_TARGET_WIDTH))
+        rate_limits = p.get("rate_limits") or {}
+        if p.get("adaptive", True) or rate_limits:
+            self.limiter = HostConcurrencyController(
+                max_per_host=per_host_limit if engine == DOWNLOAD_ENGINE_ASYNCIO else max_workers,
+                adaptive=bool(p.get("adaptive", True)),
+                rate_limits=rate_limits,
+            )
+        if p.get("cache", True):
+            self.cache = _get_image_cache(int(p.get("cache_mb", IMAGE_CACHE_MAX_MB)))
+            self.cache_counts_before = self.cache.stats.as_dict()
+        if p.get("site_profiles", True):
+            self.site_profiles = _get_site_profiles()
+        if p.get("page_cache", True):
+            self.page_cache = _get_page_cache()
+            self.page_cache_counts_before = self.page_cache.stats.as_dict()
+        if self.resumed and debug:
+            _emit(f"♻️ チェックポイントから再開します（記録済みの画像 {len(self.checkpoint.results)}件）")
+
+        # 更新モード: 記録済みの話は巡回せず、最後の話から新しい話・画像だけを取得する
+        series_index = SeriesIndex.for_url(url)
+        num_episodes = int(p.get("num_episodes", 1))
+        exclude_urls = None
+        plan = None
+        if p.get("update"):
+            # 計画の無い古いチェックポイントはここで決める
+            plan = p.get("update_plan") or self._plan_update()
+            num_episodes = plan["num_episodes"]
+            exclude_urls = set(plan["exclude_urls"])
+            self.checkpoint.save(force=True)
+            if debug and plan["episode_urls"]:
+                _emit(f"🔄 記録済みの{len(plan['episode_urls'])}話目から更新分を取得します")
+
+        options = dict(
+            min_size=int(p.get("min_size_kb", 30)) * 1000,
+            referer=url,
+            debug=debug,
+            max_workers=max_workers,
+            progress_callback=self._on_progress,
+            engine=engine,
+            per_host_limit=per_host_limit,
+            probe=bool(p.get("probe", True)),
+            stats=self.stats,
+            cache=self.cache,
+            store=self.store,
+            max_images=int(p.get("max_images", 120)),
+            limiter=self.limiter,
+            checkpoint=self.checkpoint,
+            dedupe=bool(p.get("dedupe", True)),
+            on_ready=self._on_ready,
+        )
+        if p.get("mode", JOB_MODE_PIPELINE) == JOB_MODE_TWO_STAGE:
+            self.candidates = get_multiple_episodes_images(
+                url,
+                num_episodes=num_episodes,
+                debug=debug,
+                completed_episodes=self.checkpoint.episodes,
+                on_episode=self.checkpoint.add_episode,
+                site_profiles=self.site_profiles,
+                page_cache=self.page_cache,
+                srcset_width=srcset_width,
+            )
+            if exclude_urls:
+                self.candidates = [img for img in self.candidates if img["url"] not in exclude_urls]
+            self.progress = {"stage": "download", "completed": 0, "total": len(self.candidates)}
+            self.manga_images = filter_manga_images(self.candidates, **options) if self.candidates else []
+        else:
+            self.candidates, self.manga_images = extract_manga_images(
+                url,
+                num_episodes,
+                site_profiles=self.site_profiles,
+                exclude_urls=exclude_urls,
+                page_cache=self.page_cache,
+                srcset_width=srcset_width,
+                **options,
+            )
+        if self.site_profiles is not None:
+            self.site_profiles.save(force=True)
+        self.series_update = series_index.merge(self.checkpoint.episodes, self.manga_images, plan, self.stats.rejected_urls())
+        series_index.save()
+        if p.get("transcode") and self.manga_images:
+            self.transcode_summary = transcode_images(
+                self.manga_images,
+                fmt=p["transcode"],
+                quality=int(p.get("transcode_quality", TRANSCODE_QUALITY)),
+                max_width=int(p.get("transcode_max_width") or 0) or None,
+                grayscale=bool(p.get("transcode_grayscale", True)),
+                store=self.store,
+                progress_callback=self._on_progress,
+            )
+
+
+_jobs: dict[str, ExtractionJob] = {}
+_jobs_lock = threading.Lock()
+
+
+def _valid_job_id(job_id: str) -> bool:
+    return bool(job_id) and all(c.isascii() and (c.isalnum() or c in "_-") for c in job_id)
+
+
+def _prune_jobs() -> None:
+    """終わったジョブのうち古いものをメモリから外し、保持期間を過ぎた作業ディレクトリを消す"""
+    with _jobs_lock:
+        finished = sorted((j for j in _jobs.values() if j.done), key=lambda j: j.finished_at or 0)
+        for job in finished[: max(0, len(finished) - JOBS_KEEP_IN_MEMORY)]:
+            del _jobs[job.job_id]
+        running = {job_id for job_id, job in _jobs.items() if not job.done}
+    jobs_dir = _get_jobs_dir()
+    if not os.path.isdir(jobs_dir):
+        return
+    expire = time.time() - JOB_RETENTION_HOURS * 3600
+    for name in os.listdir(jobs_dir):
+        path = os.path.join(jobs_dir, name)
+        try:
+            if name not in running and os.path.getmtime(path) < expire:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def start_job(params: dict) -> ExtractionJob:
+    """抽出ジョブをバックグラウンドで開始する"""
+    _prune_jobs()
+    job_id = _make_run_id()
+    job = ExtractionJob(job_id, os.path.join(_get_jobs_dir(), job_id), params)
+    with _jobs_lock:
+        _jobs[job_id] = job
+    return job.start()
+
+
+def get_job(job_id: str) -> ExtractionJob | None:
+    """実行中・実行済みのジョブ。メモリに無くてもチェックポイントが残っていれば読み込む（途中のものは続きから再開する）"""
+    if not _valid_job_id(job_id):
+        return None
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            return job
+        job_dir = os.path.join(_get_jobs_dir(), job_id)
+        if not os.path.exists(os.path.join(job_dir, "checkpoint.json")):
+            return None
+        try:
+            job = ExtractionJob(job_id, job_dir)
+        except (OSError, ValueError) as e:
+            logger.warning("チェックポイントを読み込めません: %s (%s)", job_dir, e)
+            return None
+        _jobs[job_id] = job
+    return job.start()
+
+
+def discard_job(job_id: str) -> None:
+    """終わったジョブをメモリとディスクから片付ける（実行中なら何もしない）"""
+    if not _valid_job_id(job_id):
+        return
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None and not job.done:
+            return
+        _jobs.pop(job_id, None)
+    shutil.rmtree(os.path.join(_get_jobs_dir(), job_id), ignore_errors=True)
@@ -0,0 +1,40 @@
+"""テスト共通: スタンドインサーバーと、キャッシュ・ジョブの置き場所を一時ディレクトリに切り替える fixture"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import manga_extractor  # noqa: E402
+from standin_site import SiteConfig, start_site  # noqa: E402
+
+_CACHED_GETTERS = (
+    manga_extractor._get_site_profiles,
+    manga_extractor._get_page_cache,
+    manga_extractor._get_image_cache,
+)
+
+
+@pytest.fixture
+def output_dir(tmp_path, monkeypatch):
+    """output/ 配下（キャッシュ・連載の記録・ジョブ）を tmp_path に向ける"""
+    for name in ("MANGA_SITE_PROFILES_PATH", "MANGA_PAGE_CACHE_DIR", "MANGA_IMAGE_CACHE_DIR", "MANGA_SERIES_INDEX_DIR"):
+        monkeypatch.delenv(name, raising=False)
+    base = str(tmp_path / "output")
+    monkeypatch.setattr(manga_extractor, "_get_output_base_dir", lambda: base)
+    for getter in _CACHED_GETTERS:
+        getter.cache_clear()
+    yield base
+    for getter in _CACHED_GETTERS:
+        getter.cache_clear()
+
+
+@pytest.fixture
+def site():
+    site = start_site(SiteConfig(episodes=3, pages=2, images_per_page=2, image_width=400, image_height=600))
+    yield site
+    site.shutdown()
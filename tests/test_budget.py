@@ -0,0 +1,51 @@
+import manga_extractor as m
+from standin_site import SiteConfig, start_site
+
+
+def _candidates(site) -> list[dict]:
+    # 漫画画像の間にフィルタで落ちる小さい画像を挟む（数えない候補が先頭側にあっても順序が崩れないこと）
+    images = []
+    for episode in (1, 2):
+        for i in range(6):
+            images.append({"url": f"{site.url}/wp-content/uploads/ep{episode}/p1_{i}.jpg"})
+            if i % 2 == 0:
+                images.append({"url": f"{site.url}/wp-content/uploads/icon-{episode}-{i}.png"})
+    return images
+
+
+def test_budget_returns_the_same_ordered_prefix_as_an_unbounded_run(site):
+    candidates = _candidates(site)
+    unbounded = [img["url"] for img in m.filter_manga_images(candidates, min_size=1000, referer=site.url)]
+    assert len(unbounded) == 12
+
+    for limit in (1, 5, 11):
+        bounded = m.filter_manga_images(candidates, min_size=1000, referer=site.url, max_images=limit)
+        assert [img["url"] for img in bounded] == unbounded[:limit]
+
+    url = site.url + "/archives/1/"
+    _, crawled = m.extract_manga_images(url, 3, min_size=1000, referer=site.url)
+    _, bounded = m.extract_manga_images(url, 3, min_size=1000, referer=site.url, max_images=5)
+    assert [img["url"] for img in bounded] == [img["url"] for img in crawled][:5]
+
+
+def test_cancel_rest_cancels_only_downloads_past_the_cutoff():
+    # 1本ずつ遅く返すので、上限に達した時点で後ろの候補はまだ始まっていない
+    site = start_site(SiteConfig(image_width=400, image_height=600, latency=0.1))
+    try:
+        candidates = _candidates(site)
+        budget = m._OrderedBudget(3)
+        with m._ThreadDownloader(1) as downloader:
+            for img in candidates:
+                budget.add(downloader.submit(img, 1000, site.url))
+            assert budget.satisfied(block=True)
+            cancelled = budget.cancel_rest()
+    finally:
+        site.shutdown()
+
+    kept, rest = budget.futures[: budget.cutoff], budget.futures[budget.cutoff :]
+    # 先頭は漫画画像・アイコン・漫画画像・漫画画像の順なので、3枚目で打ち切る
+    assert budget.cutoff == 4
+    assert all(f.done() and not f.cancelled() for f in kept)
+    assert [bool(m._future_result(f)) for f in kept] == [True, False, True, True]
+    assert cancelled == sum(1 for f in rest if f.cancelled())
+    assert cancelled >= len(rest) - 1
@@ -0,0 +1,38 @@
+import random
+
+import manga_extractor as m
+
+
+def test_hash_index_matches_brute_force():
+    rng = random.Random(0)
+    index = m.PerceptualHashIndex()
+    hashes = []
+    for i in range(2000):
+        if hashes and rng.random() < 0.3:
+            # 登録済みのハッシュの数ビットを反転した近い画像
+            h = rng.choice(hashes)
+            for bit in rng.sample(range(64), rng.randint(0, 8)):
+                h ^= 1 << bit
+        else:
+            h = rng.getrandbits(64)
+        expected = next((j for j, old in enumerate(hashes) if (old ^ h).bit_count() <= m.DEDUPE_MAX_DISTANCE), None)
+        assert index.find(h) == expected
+        index.add(h, i)
+        hashes.append(h)
+
+
+def test_filter_collapses_the_same_image_under_different_urls(site):
+    # スタンドインサイトの画像は少ない種類の使い回しなので、URLが違っても同じ内容のものがある
+    candidates = [{"url": f"{site.url}/wp-content/uploads/ep1/p{p}_{i}.jpg"} for p in range(1, 4) for i in range(4)]
+    plain = m.filter_manga_images(candidates, min_size=1000, referer=site.url)
+    distinct = []
+    for img in plain:
+        if m.image_sha256(img) not in distinct:
+            distinct.append(m.image_sha256(img))
+    assert len(distinct) < len(plain)
+
+    stats = m.DownloadStats()
+    collapsed = m.filter_manga_images(candidates, min_size=1000, referer=site.url, dedupe=True, stats=stats)
+
+    assert [m.image_sha256(img) for img in collapsed] == distinct
+    assert stats.as_dict()["duplicates_collapsed"] == len(plain) - len(distinct)
@@ -0,0 +1,75 @@
+import glob
+import os
+
+import pytest
+
+import manga_extractor as m
+from bench_html_extract import FIXTURE_DIR, FIXTURE_URL, _legacy_extract, _profiled_extract, _single_pass_extract
+
+PARSERS = ["html.parser"] + (["lxml"] if m.HTML_PARSER == "lxml" else [])
+
+_IMGS = '<img src="/wp-content/uploads/a.jpg"><img src="/wp-content/uploads/b.jpg">'
+# 1回走査で選び方が変わりやすい形（本文・ページ送り・次話の候補が複数ある、どれも無い）
+PAGES = {
+    "nested_content": f'<body><img src="/x/side.jpg"><div class="content"><article>{_IMGS}</article></div></body>',
+    "later_content_first": f'<body><div class="post-body"><img src="/x/c.jpg"></div><div class="entry-content">{_IMGS}</div></body>',
+    "no_content": f"<body>{_IMGS}<p>本文なし</p></body>",
+    "no_body": _IMGS,
+    "nav_next": (
+        f"<body><article>{_IMGS}</article>"
+        '<nav class="navigation post-navigation"><div class="nav-previous"><a href="/archives/1">前</a></div>'
+        '<div class="nav-next"><a href="/archives/3">次</a></div></nav></body>'
+    ),
+    "next_div": (
+        f'<body><article>{_IMGS}</article><div class="page-text-body">次の話へ</div>'
+        '<p><a href="/archives/9">読む</a></p><a href="/archives/8">次話</a></body>'
+    ),
+    "next_div_in_link": f'<body><article>{_IMGS}</article><a href="/archives/7"><div class="page-text-body">次の話</div></a></body>',
+    "rel_next": (
+        f'<head><link rel="next" href="{FIXTURE_URL}/2"></head>'
+        f'<body><article>{_IMGS}<a href="{FIXTURE_URL}/3">3</a></article></body>'
+    ),
+    "pagination_and_numbers": (
+        f'<body><article>{_IMGS}</article><div class="pager"><a href="{FIXTURE_URL}/2">2</a>'
+        f'<a href="{FIXTURE_URL}/3">次へ</a></div><a href="{FIXTURE_URL}/4">4</a></body>'
+    ),
+    "next_page_text": f'<body><article>{_IMGS}</article><a href="{FIXTURE_URL}/2">次のページ</a></body>',
+}
+
+
+def _inputs():
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, "*.html"))):
+        with open(path, "rb") as f:
+            yield pytest.param(f.read(), id=os.path.basename(path))
+    for name, html in PAGES.items():
+        yield pytest.param(html.encode(), id=name)
+
+
+@pytest.mark.parametrize("parser", PARSERS)
+@pytest.mark.parametrize("html", list(_inputs()))
+def test_single_pass_scan_matches_select_one_cascade(html, parser):
+    # 画像（＝本文エリアの選び方）・ページ送り・次話リンクが従来のセレクタ順の照合と同じになる
+    expected = _legacy_extract(FIXTURE_URL, html)
+    assert _single_pass_extract(FIXTURE_URL, html, parser) == expected
+    assert _profiled_extract(FIXTURE_URL, html, parser) == expected
+
+
+def test_lazy_loaded_images_with_a_data_placeholder_use_the_real_attribute():
+    # 遅延読み込みのサイトは src に data: URI のダミーを置き、本物を data-src などに入れる
+    placeholder = "data:image/gif;base64,R0lGODlhAQABAAAAACw="
+    html = (
+        "<body><article>"
+        f'<img src="{placeholder}" data-src="/wp-content/uploads/a.jpg">'
+        f'<img src="{placeholder}" data-lazy-srcset="/wp-content/uploads/b.jpg 800w">'
+        f'<img src="{placeholder}">'
+        '<img src="/wp-content/uploads/c.jpg" data-src="/wp-content/uploads/c-large.jpg">'
+        "</article></body>"
+    ).encode()
+    images, _, _ = _single_pass_extract(FIXTURE_URL, html, PARSERS[-1])
+    assert images == [f"https://example.com/wp-content/uploads/{name}.jpg" for name in ("a", "b", "c")]
+
+    img = m._make_soup(html).find("img")
+    assert m._img_src(img) == ("/wp-content/uploads/a.jpg", "data-src")
+    assert m._img_src(img, "src") == ("/wp-content/uploads/a.jpg", "data-src")
+    # 他に本物が無ければダミーのまま返す（呼び出し側で除く）
+    assert m._img_src(m._make_soup(html).find_all("img")[2]) == (placeholder, "src")
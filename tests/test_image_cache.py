@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+import manga_extractor as m
+from standin_site import SiteConfig, start_site
+
+
+def _image_url(site, i: int = 0) -> str:
+    return f"{site.url}/wp-content/uploads/ep1/p1_{i}.jpg"
+
+
+def _blob_count(cache: m.ImageDiskCache) -> int:
+    return sum(len(files) for _, _, files in os.walk(os.path.join(cache.root, "blobs")))
+
+
+def test_image_cache_revalidates_with_etag(tmp_path, site):
+    cache = m.ImageDiskCache(str(tmp_path), max_bytes=64 * 1024 * 1024)
+    url = _image_url(site)
+    first = m._fetch_image_to_store(url, site.url, 1000, m.ImageStore(), cache=cache)
+    before = site.counters()["bytes"]
+    second = m._fetch_image_to_store(url, site.url, 1000, m.ImageStore(), cache=cache)
+
+    assert second.read() == first.read()
+    assert site.counters()["bytes"] == before
+    assert cache.stats.as_dict()["hits"] == 1
+
+
+def test_image_cache_skips_responses_without_validators(tmp_path):
+    site = start_site(SiteConfig(image_width=400, image_height=600, image_etags=False))
+    try:
+        cache = m.ImageDiskCache(str(tmp_path), max_bytes=64 * 1024 * 1024)
+        for _ in range(2):
+            assert m._fetch_image_to_store(_image_url(site), site.url, 1000, m.ImageStore(), cache=cache)
+    finally:
+        site.shutdown()
+
+    assert cache.lookup(_image_url(site)) is None
+    assert cache.total_bytes == 0 and _blob_count(cache) == 0
+    assert cache.stats.as_dict() == {"misses": 2, "uncacheable": 2}
+
+
+def test_image_cache_evicts_least_recently_used(tmp_path):
+    cache = m.ImageDiskCache(str(tmp_path), max_bytes=2500)
+    for i in range(3):
+        cache.store(f"https://example.com/{i}.jpg", bytes([i]) * 1000, {"ETag": f'"{i}"'})
+
+    assert cache.lookup("https://example.com/0.jpg") is None
+    assert cache.lookup("https://example.com/2.jpg") is not None
+    assert cache.total_bytes == 2000 and _blob_count(cache) == 2
+    assert cache.stats.as_dict()["evictions"] == 1
+
+
+def _delete_blobs(cache: m.ImageDiskCache) -> None:
+    for root, _, files in os.walk(os.path.join(cache.root, "blobs")):
+        for name in files:
+            os.remove(os.path.join(root, name))
+
+
+@pytest.mark.parametrize("engine", [m.DOWNLOAD_ENGINE_THREAD, m.DOWNLOAD_ENGINE_ASYNCIO])
+def test_image_cache_refetches_when_the_blob_is_gone(tmp_path, site, engine):
+    if engine == m.DOWNLOAD_ENGINE_ASYNCIO and not m.ASYNC_ENGINE_AVAILABLE:
+        pytest.skip("aiohttp が無い")
+    cache = m.ImageDiskCache(str(tmp_path), max_bytes=64 * 1024 * 1024)
+    url = _image_url(site)
+    assert m._fetch_image_to_store(url, site.url, 1000, m.ImageStore(), cache=cache)
+    lookup = cache.lookup
+
+    def lookup_then_evict(u):
+        # 再検証を始めた直後に、別のプロセスが本体を追い出した状態を再現する
+        entry = lookup(u)
+        _delete_blobs(cache)
+        return entry
+
+    cache.lookup = lookup_then_evict
+
+    before = site.counters()["requests"]
+    with m._open_downloader(engine, max_workers=2, cache=cache) as downloader:
+        result = downloader.submit({"url": url}, 1000, site.url).result(30)
+
+    del cache.lookup
+
+    # 304 の後に条件なしで取り直し、キャッシュにも入れ直す
+    assert result is not None
+    assert site.counters()["requests"] - before == 2
+    assert cache.lookup(url) is not None and _blob_count(cache) == 1
+
+
+def test_image_cache_copies_from_disk_without_reading_whole_images(tmp_path, site, monkeypatch):
+    cache = m.ImageDiskCache(str(tmp_path / "cache"), max_bytes=64 * 1024 * 1024)
+    store = m.ImageStore(memory_budget=0, root=str(tmp_path))
+    monkeypatch.setattr(m.StoredImage, "read", lambda self: pytest.fail("画像全体を読んだ"))
+    url = _image_url(site)
+
+    stored = m._fetch_image_to_store(url, site.url, 1000, store, cache=cache)
+    hit = m._fetch_image_to_store(url, site.url, 1000, store, cache=cache)
+
+    assert stored.on_disk and hit.on_disk
+    assert b"".join(hit.iter_chunks()) == b"".join(stored.iter_chunks())
+    assert cache.stats.as_dict()["hits"] == 1
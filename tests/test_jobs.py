@@ -0,0 +1,116 @@
+import cli
+import manga_extractor as m
+
+
+def _run_job(params: dict) -> m.ExtractionJob:
+    job = m.start_job(params)
+    job.join(60)
+    assert job.status == m.JOB_DONE, job.error
+    return job
+
+
+def _evict(job_id: str) -> None:
+    with m._jobs_lock:
+        del m._jobs[job_id]
+
+
+def _mark_running(job: m.ExtractionJob) -> None:
+    """途中で落ちたジョブ（status が running のまま）に見せかける"""
+    checkpoint = m.ExtractionCheckpoint(job.checkpoint.path)
+    checkpoint.status = m.JOB_RUNNING
+    checkpoint.outputs = {}
+    checkpoint.save(force=True)
+
+
+def test_finished_job_is_restored_from_checkpoint_without_rerun(output_dir, site):
+    job = _run_job({"url": site.url + "/archives/1/", "num_episodes": 2, "min_size_kb": 5})
+    assert job.manga_images
+    _evict(job.job_id)
+
+    before = site.counters()["requests"]
+    restored = m.get_job(job.job_id)
+    restored.join(5)
+
+    assert restored is not job
+    assert restored.done and restored.status == m.JOB_DONE
+    assert not restored.resumed
+    assert site.counters()["requests"] == before
+    assert [img["url"] for img in restored.candidates] == [img["url"] for img in job.candidates]
+    assert [img["url"] for img in restored.manga_images] == [img["url"] for img in job.manga_images]
+    assert [m.image_bytes(img) for img in restored.manga_images] == [m.image_bytes(img) for img in job.manga_images]
+    assert restored.stats.as_dict() == job.stats.as_dict()
+    assert restored.series_update == job.series_update
+
+
+def test_running_checkpoint_is_resumed(output_dir, site):
+    job = _run_job({"url": site.url + "/archives/1/", "num_episodes": 1, "min_size_kb": 5})
+    _evict(job.job_id)
+    _mark_running(job)
+
+    resumed = m.get_job(job.job_id)
+    resumed.join(60)
+
+    assert resumed.resumed
+    assert resumed.status == m.JOB_DONE
+    assert [img["url"] for img in resumed.manga_images] == [img["url"] for img in job.manga_images]
+
+
+def test_update_job_keeps_its_delta_when_resumed(output_dir, site):
+    url = site.url + "/archives/1/"
+    site.config.episodes = 2
+    _run_job({"url": url, "num_episodes": 2, "min_size_kb": 5})
+
+    site.config.episodes = 3
+    job = _run_job({"url": url, "num_episodes": 1, "min_size_kb": 5, "update": True})
+    new_urls = {img["url"] for img in job.manga_images}
+    per_episode = site.config.pages * site.config.images_per_page
+    assert job.series_update["new_episodes"] == 1
+    assert job.series_update["new_images"] == per_episode
+    assert len(new_urls) == per_episode and all("/ep3/" in u for u in new_urls)
+
+    # 連載の記録に取り込んだ後で再開しても、作成時の計画で同じ差分を返す
+    _evict(job.job_id)
+    _mark_running(job)
+    resumed = m.get_job(job.job_id)
+    resumed.join(60)
+    assert resumed.resumed
+    assert {img["url"] for img in resumed.manga_images} == new_urls
+    assert resumed.series_update == job.series_update
+
+
+def test_update_job_retries_images_that_failed_before(output_dir, site):
+    url = site.url + "/archives/1/"
+    # 1話目（更新時は巡回し直さない話）と最終話の画像が1枚ずつ取れなかった
+    missing = ("/wp-content/uploads/ep1/p1_0.jpg", "/wp-content/uploads/ep3/p2_1.jpg")
+    site.config.missing_images = missing
+    first = _run_job({"url": url, "num_episodes": 3, "min_size_kb": 5, "dedupe": False})
+    kept = {img["url"] for img in first.manga_images}
+    assert not kept & {site.url + path for path in missing}
+
+    site.config.missing_images = ()
+    job = _run_job({"url": url, "num_episodes": 1, "min_size_kb": 5, "dedupe": False, "update": True})
+
+    # 取れなかった画像だけを取り直し、取得済みの画像・フィルタで除いた画像（小さいサムネイル）は候補にしない
+    assert {img["url"] for img in job.manga_images} == {site.url + path for path in missing}
+    assert not {img["url"] for img in job.candidates} & kept
+    assert not any("thumb-small" in img["url"] for img in job.candidates)
+    assert job.series_update["new_images"] == len(missing)
+
+    index = m.SeriesIndex.for_url(url)
+    images = [img for record in index.episodes for img in record["images"]]
+    assert all(img.get("sha256") for img in images if "/ep" in img["url"])
+    assert all(img.get("rejected") for img in images if "thumb-small" in img["url"])
+    assert index.image_urls() == {img["url"] for img in images}
+
+
+def test_cli_update_retries_images_that_failed_before(output_dir, site):
+    url = site.url + "/archives/1/"
+    missing = "/wp-content/uploads/ep1/p2_0.jpg"
+    site.config.missing_images = (missing,)
+    assert cli.run_job({"url": url, "num_episodes": 3, "min_size_kb": 5, "dedupe": False}, output_dir)["ok"]
+
+    site.config.missing_images = ()
+    summary = cli.run_job({"url": url, "num_episodes": 1, "min_size_kb": 5, "dedupe": False, "update": True}, output_dir)
+    assert summary["ok"] and summary["images"] == 1
+    assert summary["update"]["new_images"] == 1
+    assert site.url + missing in m.SeriesIndex.for_url(url).image_urls()
@@ -0,0 +1,30 @@
+import manga_extractor as m
+
+
+def test_page_cache_revalidates_pages_with_304(tmp_path, site):
+    cache = m.PageCache(str(tmp_path), max_bytes=1024 * 1024)
+    url = site.url + "/archives/1/"
+    first = m.get_multiple_episodes_images(url, 3, page_cache=cache)
+    before = site.counters()["bytes"]
+    second = m.get_multiple_episodes_images(url, 3, page_cache=cache)
+
+    assert [img["url"] for img in second] == [img["url"] for img in first]
+    assert site.counters()["bytes"] == before
+    counts = cache.stats.as_dict()
+    assert counts["hits"] == counts["misses"] > 0
+
+
+def _page(url: str) -> m.PageExtract:
+    return m.PageExtract(url=url, images=[{"url": url + "/a.jpg", "alt": "x" * 500}], pagination_urls=[url])
+
+
+def test_page_cache_limit_holds_across_processes(tmp_path):
+    # 同じファイルを使う2つのインスタンス（CLI のジョブの別プロセス）に交互に書き込む
+    # （1件およそ700バイト。インスタンスごとに数えると、どちらも上限に届かない）
+    caches = [m.PageCache(str(tmp_path), max_bytes=2100) for _ in range(2)]
+    for i in range(6):
+        caches[i % 2].store(_page(f"https://example.com/{i}"), {"ETag": f'"{i}"'}, 1000, True, False)
+
+    assert m.PageCache(str(tmp_path), max_bytes=2100).total_bytes <= 2100
+    assert caches[0].lookup("https://example.com/0") is None
+    assert caches[1].lookup("https://example.com/5") is not None
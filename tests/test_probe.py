@@ -0,0 +1,105 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image, features
+
+import manga_extractor as m
+
+
+def _encode(fmt: str, size: tuple[int, int], **options) -> bytes:
+    buf = BytesIO()
+    mode = "RGBA" if options.pop("alpha", False) else "RGB"
+    Image.new(mode, size, (200, 120, 40)).save(buf, fmt, **options)
+    return buf.getvalue()
+
+
+def _jpeg_with_standalone_markers(size: tuple[int, int]) -> bytes:
+    """SOF の前に単独マーカー（RST）と詰め物の 0xFF を挟んだ JPEG"""
+    data = _encode("JPEG", size)
+    return data[:2] + b"\xff\xd0\xff\xd7\xff\xff" + data[2:]
+
+
+def _avif_header(size: tuple[int, int]) -> bytes:
+    """ISOBMFF の ftyp と ispe ボックスだけの AVIF の先頭部分"""
+    ftyp = (20).to_bytes(4, "big") + b"ftypavif" + b"\x00\x00\x00\x00avif"
+    ispe = (20).to_bytes(4, "big") + b"ispe" + b"\x00\x00\x00\x00" + size[0].to_bytes(4, "big") + size[1].to_bytes(4, "big")
+    return ftyp + b"\x00\x00\x00\x10meta\x00\x00\x00\x00" + ispe
+
+
+FORMATS = {
+    "jpeg": lambda size: _encode("JPEG", size),
+    "jpeg_progressive": lambda size: _encode("JPEG", size, progressive=True),
+    "jpeg_exif": lambda size: _encode("JPEG", size, exif=b"Exif\x00\x00" + b"\x00" * 2000),
+    "jpeg_standalone_markers": _jpeg_with_standalone_markers,
+    "png": lambda size: _encode("PNG", size),
+    "gif": lambda size: _encode("GIF", size),
+    "webp_vp8": lambda size: _encode("WEBP", size, quality=80),
+    "webp_vp8l": lambda size: _encode("WEBP", size, lossless=True),
+    "webp_vp8x": lambda size: _encode("WEBP", size, alpha=True, quality=80),
+    "avif": lambda size: _encode("AVIF", size),
+}
+
+
+def _make(fmt: str, size: tuple[int, int]) -> bytes:
+    if fmt == "avif" and not features.check("avif"):
+        pytest.skip("Pillow に AVIF のエンコーダが無い")
+    return FORMATS[fmt](size)
+
+
+SIZES = [(400, 600), (150, 600), (900, 250), (200, 200), (16383, 300)]
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+@pytest.mark.parametrize("size", SIZES)
+def test_probe_reads_dimensions(fmt, size):
+    if fmt.startswith("webp") and max(size) > 16383:
+        pytest.skip("WebP の上限を超える")
+    data = _make(fmt, size)
+    assert m._probe_image_size(data[: m.PROBE_MAX_BYTES]) == size == Image.open(BytesIO(data)).size
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_probe_skips_tem_marker(size):
+    # TEM（0xFF01）は Pillow が開けないので、先頭バイト判定だけを確かめる
+    data = _encode("JPEG", size)
+    assert m._probe_image_size(data[:2] + b"\xff\x01" + data[2:]) == size
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_probe_reads_avif_ispe(size):
+    assert m._probe_image_size(_avif_header(size)) == size
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+def test_probe_waits_for_more_bytes(fmt):
+    data = _make(fmt, (400, 600))
+    assert m._probe_image_size(data[:8]) is None
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+@pytest.mark.parametrize("size", SIZES[:4])
+def test_probe_decision_matches_full_download(fmt, size):
+    data = _make(fmt, size)
+    probe = m._HeaderProbe(0, {"Content-Length": str(len(data))})
+    rejected = any(probe.feed(data[i : i + 64]) for i in range(0, len(data), 64))
+    assert rejected == (not m._passes_dimension_filter(*Image.open(BytesIO(data)).size))
+
+
+@pytest.mark.parametrize(
+    "headers, rejected",
+    [
+        ({"Content-Length": "999"}, True),
+        ({"Content-Length": "1000"}, False),
+        ({"Content-Length": "999", "Content-Encoding": "gzip"}, False),
+        ({"Content-Length": "abc"}, False),
+        ({}, False),
+    ],
+)
+def test_probe_rejects_by_content_length(headers, rejected):
+    assert m._HeaderProbe(1000, headers).rejects_by_length() == rejected
+
+
+def test_probe_gives_up_on_unknown_formats():
+    probe = m._HeaderProbe(0, {})
+    assert not probe.feed(b"\x00" * m.PROBE_MAX_BYTES)
+    assert not probe.feed(b"\x00" * 10)
@@ -0,0 +1,132 @@
+import threading
+import time
+
+import pytest
+
+import manga_extractor as m
+from standin_site import SiteConfig, start_site
+
+
+def _images(site, episode: int, count: int) -> list[dict]:
+    return [{"url": f"{site.url}/wp-content/uploads/ep{episode}/p1_{i}.jpg"} for i in range(count)]
+
+
+def test_rate_limited_sessions_do_not_starve_other_sessions(site):
+    throttled = []
+    try:
+        for episode in (1, 2):
+            limiter = m.HostConcurrencyController(max_per_host=16, adaptive=False, rate_limits={"127.0.0.1": 2})
+            downloader = m._ThreadDownloader(16, limiter=limiter).__enter__()
+            futures = [downloader.submit(img, 1000, site.url) for img in _images(site, episode, 20)]
+            throttled.append((downloader, futures))
+        time.sleep(0.3)
+        running = m._get_download_scheduler().counts()["running"]
+
+        started = time.perf_counter()
+        with m._ThreadDownloader(10) as downloader:
+            futures = [downloader.submit(img, 1000, site.url) for img in _images(site, 3, 10)]
+            results = [future.result(30) for future in futures]
+        elapsed = time.perf_counter() - started
+    finally:
+        for downloader, _ in throttled:
+            downloader.__exit__(None, None, None)
+
+    # 絞られたセッションは枠を取れた分しかワーカーを使わない
+    assert running <= 4
+    assert all(results)
+    assert elapsed < 2.0
+
+
+def test_coalesced_downloads_share_one_request():
+    # 応答を遅くして、3セッションの取得が確実に重なるようにする
+    site = start_site(SiteConfig(image_width=400, image_height=600, latency=0.3))
+    images = _images(site, 1, 4)
+    barrier = threading.Barrier(3)
+    results = []
+
+    def run():
+        with m._ThreadDownloader(4) as downloader:
+            barrier.wait()
+            results.append([future.result(30) for future in [downloader.submit(img, 1000, site.url) for img in images]])
+
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    site.shutdown()
+
+    assert len(results) == 3 and all(all(r) for r in results)
+    assert site.counters()["requests"] == len(images)
+
+
+def _small_scheduler(monkeypatch, max_workers: int) -> m.DownloadScheduler:
+    scheduler = m.DownloadScheduler(max_workers)
+    monkeypatch.setattr(m, "_get_download_scheduler", lambda: scheduler)
+    return scheduler
+
+
+def test_coalesced_downloads_wait_without_holding_a_worker(monkeypatch):
+    # ワーカー2本のうち1本を取得中の画像が使う。相乗りの3セッションは待つ間ワーカーを使わないので、別の画像がすぐ取れる
+    scheduler = _small_scheduler(monkeypatch, 2)
+    site = start_site(SiteConfig(image_width=400, image_height=600, latency=0.5))
+    shared, other = _images(site, 1, 2)
+    downloaders = [m._ThreadDownloader(1).__enter__() for _ in range(5)]
+    try:
+        leader = downloaders[0].submit(shared, 1000, site.url)
+        time.sleep(0.1)
+        followers = [d.submit(shared, 1000, site.url) for d in downloaders[1:4]]
+        time.sleep(0.1)
+        waiting = scheduler.counts()["waiting"]
+        started = time.perf_counter()
+        assert downloaders[4].submit(other, 1000, site.url).result(30)
+        elapsed = time.perf_counter() - started
+        assert leader.result(30) and all(f.result(30) for f in followers)
+    finally:
+        for downloader in downloaders:
+            downloader.__exit__(None, None, None)
+        site.shutdown()
+
+    assert waiting == 3
+    # 相乗りがワーカーを持ったままなら、別の画像は取得中の画像が終わるまで始まらない
+    assert elapsed < 0.8
+    assert site.counters()["requests"] == 2
+    assert scheduler.counts()["waiting"] == 0
+
+
+@pytest.mark.skipif(not m.ASYNC_ENGINE_AVAILABLE, reason="aiohttp が必要")
+def test_asyncio_engine_runs_under_the_global_cap(monkeypatch):
+    scheduler = _small_scheduler(monkeypatch, 2)
+    site = start_site(SiteConfig(image_width=400, image_height=600, latency=0.2))
+    peak = 0
+    try:
+        with m._AsyncDownloader(max_in_flight=8) as downloader:
+            futures = [downloader.submit(img, 1000, site.url) for img in _images(site, 1, 6)]
+            while not all(f.done() for f in futures):
+                peak = max(peak, scheduler.counts()["running"])
+                time.sleep(0.01)
+            results = [f.result() for f in futures]
+    finally:
+        site.shutdown()
+
+    assert all(results)
+    # asyncio エンジンの通信もスレッド方式と同じ全体の上限に収まる
+    assert peak == 2
+    assert scheduler.counts()["clients"] == 0
+
+
+@pytest.mark.skipif(not m.ASYNC_ENGINE_AVAILABLE, reason="aiohttp が必要")
+def test_asyncio_and_thread_engines_coalesce_the_same_image(monkeypatch):
+    _small_scheduler(monkeypatch, 8)
+    site = start_site(SiteConfig(image_width=400, image_height=600, latency=0.3))
+    images = _images(site, 1, 4)
+    try:
+        with m._AsyncDownloader(max_in_flight=4) as downloader, m._ThreadDownloader(4) as threads:
+            futures = [downloader.submit(img, 1000, site.url) for img in images]
+            futures += [threads.submit(img, 1000, site.url) for img in images]
+            results = [f.result(30) for f in futures]
+    finally:
+        site.shutdown()
+
+    assert all(results)
+    assert site.counters()["requests"] == len(images)
@@ -0,0 +1,56 @@
+import json
+
+import manga_extractor as m
+
+
+def test_profiles_saved_from_several_processes_are_merged(tmp_path):
+    # CLI のジョブ（別プロセス）と同じく、同じファイルを別々のインスタンスから保存する
+    path = str(tmp_path / "site_profiles.json")
+    first, second = m.SiteProfileCache(path), m.SiteProfileCache(path)
+    first.record("https://a.example/1", {"content": "article"}, hit=True)
+    second.record("https://b.example/1", {"content": ".entry-content"}, hit=False)
+    first.record("https://a.example/2", {}, hit=True)
+    second.record("https://a.example/3", {}, hit=False)
+    first.save(force=True)
+    second.save(force=True)
+
+    with open(path, encoding="utf-8") as f:
+        profiles = json.load(f)
+    assert profiles["a.example"]["content"] == "article"
+    assert (profiles["a.example"]["hits"], profiles["a.example"]["misses"]) == (2, 1)
+    assert profiles["b.example"]["content"] == ".entry-content"
+    assert (profiles["b.example"]["hits"], profiles["b.example"]["misses"]) == (0, 1)
+    # 保存したインスタンスは他のプロセスの記録も読み込んでいる
+    assert first.lookup("https://b.example/2")["content"] == ".entry-content"
+
+
+_PAGE = (
+    '<body><div class="entry-content"><img src="/wp-content/uploads/side.jpg"></div>'
+    '<article><img src="/wp-content/uploads/a.jpg"><img src="/wp-content/uploads/b.jpg"></article></body>'
+)
+
+
+def test_profile_misses_when_a_higher_priority_content_selector_matches():
+    # 以前は .entry-content だけのページだったサイトに、優先度の高い article が現れた
+    url = "https://example.com/archives/1"
+    profile = {"content": ".entry-content"}
+    page, found = m._extract_from_soup(url, m._make_soup(_PAGE.encode()), False, True, profile)
+    full, _ = m._extract_from_soup(url, m._make_soup(_PAGE.encode()), False, True)
+
+    assert found["content"] == "article"
+    assert not m._site_profile_matches(profile, found, True)
+    assert [img["url"] for img in page.images] == [img["url"] for img in full.images]
+
+
+def test_stale_profile_is_relearned_on_the_stand_in_site(output_dir, site):
+    # スタンドインサイトの本文は article の中の .entry-content。記録が下位のセレクタのままなら判定し直す
+    profiles = m.SiteProfileCache(m._get_site_profiles_path())
+    url = site.url + "/archives/1/"
+    profiles.record(url, {"content": ".entry-content"})
+    page = m.extract_page(url, site_profiles=profiles)
+    expected = m.extract_page(url)
+
+    profile = profiles.lookup(url)
+    assert profile["content"] == "article"
+    assert profile["misses"] == 1
+    assert [img["url"] for img in page.images] == [img["url"] for img in expected.images]
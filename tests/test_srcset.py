@@ -0,0 +1,104 @@
+import pytest
+
+import manga_extractor as m
+from standin_site import SiteConfig, start_site
+
+GIF = "data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP,/yH5BAEAAAAALAAAAAABAAEAAAIBRAA7"
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("a.jpg 300w, b.jpg 600w", [("a.jpg", 300, None), ("b.jpg", 600, None)]),
+        ("a.jpg 1x, b.jpg 2x", [("a.jpg", None, 1.0), ("b.jpg", None, 2.0)]),
+        ("a.jpg 1.5x", [("a.jpg", None, 1.5)]),
+        ("a.jpg", [("a.jpg", None, None)]),
+        ("a.jpg, b.jpg 2x", [("a.jpg", None, None), ("b.jpg", None, 2.0)]),
+        # 空白の無いカンマは URL の一部（HTML の分割規則）
+        ("a.jpg,b.jpg 2x", [("a.jpg,b.jpg", None, 2.0)]),
+        ("  a.jpg   300w ,\n b.jpg 600w  ", [("a.jpg", 300, None), ("b.jpg", 600, None)]),
+        # URL 中のカンマは区切りではない（data: URI や ?size=1,2）
+        (f"{GIF} 1x, real.jpg 800w", [(GIF, None, 1.0), ("real.jpg", 800, None)]),
+        ("img.php?size=1,2 400w, c.jpg 800w", [("img.php?size=1,2", 400, None), ("c.jpg", 800, None)]),
+        # 読めない記述子は無視する
+        ("a.jpg bogusw, b.jpg 2x", [("a.jpg", None, None), ("b.jpg", None, 2.0)]),
+        ("", []),
+    ],
+)
+def test_parse_srcset(value, expected):
+    assert m._parse_srcset(value) == expected
+
+
+def _candidates(*widths):
+    return [(f"{w or 'orig'}.jpg", "srcset", w) for w in widths]
+
+
+@pytest.mark.parametrize(
+    "candidates, target, expected",
+    [
+        # 目標の幅以上で最小のもの
+        (_candidates(300, 1024, 1536), 1000, "1024.jpg"),
+        (_candidates(1536, 300, 1000), 1000, "1000.jpg"),
+        (_candidates(300, 768, 1024), 500, "768.jpg"),
+        # 足りなければ幅の分からない候補（元画像のことが多い）、それも無ければ最大のもの
+        (_candidates(None, 300, 768), 1000, "orig.jpg"),
+        (_candidates(300, 768), 1000, "768.jpg"),
+        # 目標が無い・小さすぎるときは MIN_IMAGE_SIDE 以上で最小のもの
+        (_candidates(150, 300, 1024), None, "300.jpg"),
+        (_candidates(150, 300, 1024), 0, "300.jpg"),
+    ],
+)
+def test_choose_src_candidate(candidates, target, expected):
+    assert m._choose_src_candidate(candidates, target)[0] == expected
+
+
+@pytest.mark.parametrize(
+    "tag, target, expected",
+    [
+        ('<img src="a.jpg" srcset="a-300x450.jpg 300w, a-1024x1536.jpg 1024w, a.jpg 2048w">', 1000, "a-1024x1536.jpg"),
+        ('<img src="a.jpg" srcset="a-300x450.jpg 300w, a-1024x1536.jpg 1024w, a.jpg 2048w">', 250, "a-300x450.jpg"),
+        # x 記述子は表示幅（width 属性）から幅にする
+        ('<img width="600" srcset="a-1x.jpg 1x, a-2x.jpg 2x">', 1000, "a-2x.jpg"),
+        # 記述子の無い縮小版はファイル名の -<幅>x<高さ> を使う
+        ('<img src="a-150x225.jpg" data-srcset="a-1024x1536.jpg, a-768x1152.jpg">', 700, "a-768x1152.jpg"),
+        # srcset 内の data: URI は候補にしない
+        (f'<img src="{GIF}" data-srcset="{GIF} 1x, a-1024x1536.jpg 1024w">', 1000, "a-1024x1536.jpg"),
+    ],
+)
+def test_img_src_picks_the_srcset_candidate_for_the_target_width(tag, target, expected):
+    img = m._make_soup(tag.encode()).find("img")
+    assert m._img_src(img, target_width=target)[0] == expected
+
+
+@pytest.fixture
+def srcset_site():
+    config = SiteConfig(episodes=1, pages=1, images_per_page=2, image_width=1200, image_height=1800, srcset_widths=(300, 768, 1024))
+    site = start_site(config)
+    yield site
+    site.shutdown()
+
+
+def _episode_urls(images: list[dict]) -> list[str]:
+    return [img["url"] for img in images if "/ep1/" in img["url"]]
+
+
+def test_srcset_width_is_part_of_the_page_cache_entry(tmp_path, srcset_site):
+    cache = m.PageCache(str(tmp_path), max_bytes=1024 * 1024)
+    url = srcset_site.url + "/archives/1/"
+    large = m.extract_page(url, page_cache=cache)
+    small = m.extract_page(url, page_cache=cache, srcset_width=500)
+    cached = m.extract_page(url, page_cache=cache, srcset_width=500)
+
+    assert all(u.endswith("-1024x1536.jpg") for u in _episode_urls(large.images))
+    # 目標の幅が違えば選ぶ画像も違うので、前回の抽出結果は使わない
+    assert all(u.endswith("-768x1152.jpg") for u in _episode_urls(small.images))
+    assert _episode_urls(cached.images) == _episode_urls(small.images)
+    assert cache.stats.as_dict()["hits"] == 1
+
+
+def test_job_passes_srcset_width_to_the_crawl(output_dir, srcset_site):
+    job = m.start_job({"url": srcset_site.url + "/archives/1/", "min_size_kb": 1, "srcset_width": 2000})
+    job.join(60)
+    assert job.status == m.JOB_DONE, job.error
+    # 目標に届く縮小版が無ければ元画像
+    assert _episode_urls(job.candidates) == [f"{srcset_site.url}/wp-content/uploads/ep1/p1_{i}.jpg" for i in range(2)]